@@ -0,0 +1,118 @@
+"""
+Indexes battles converted with outdated registries (missing a few units and artifacts of the recorded sample) in the
+fake Elasticsearch (see `fake_servers`), along with up to date ones, then runs `backfill_unknown_names` with the current
+registries and checks that every battle is the same as when converted with the current registries.
+
+The fake Elasticsearch ignores queries, so the whole index is scanned here: the battles that were not affected must
+not be updated.
+
+Usage: python -m benchmarks.backfill_names [--battles 20000]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from elasticsearch import AsyncElasticsearch
+
+from benchmarks.convert_battles import load_sample_battles, root_dir
+from benchmarks.fake_servers import start_fake_servers
+from benchmarks.ingestion import wait_for_server
+from commands.backfill_names import backfill_unknown_names
+from commands.battle_conversion import convert_raw_battle_source
+from src import ArtefactRegistry, Indexer, UnitRegistry
+from src.crawl_state import CrawlState
+
+season = "pvp_rta_ss12"
+
+
+def outdated_registries(directory: str, raw_battles) -> tuple[UnitRegistry, ArtefactRegistry]:
+    """
+    Registries without the unit picked first and the artifact of the first unit, in the first battle.
+    """
+    with open(os.path.join(root_dir, "data/static/units.json"), "r") as units_file:
+        units = json.load(units_file)
+    with open(os.path.join(root_dir, "data/static/artefacts.json"), "r") as artefacts_file:
+        artefacts = json.load(artefacts_file)
+    units.pop(raw_battles[0].my_deck.hero_list[0].hero_code)
+    artefacts.pop(json.loads("{" + raw_battles[0].teamBettleInfo + "}")["my_team"][0]["artifact"])
+
+    units_file_path = os.path.join(directory, "units.json")
+    artefacts_file_path = os.path.join(directory, "artefacts.json")
+    with open(units_file_path, "w") as units_file:
+        json.dump(units, units_file)
+    with open(artefacts_file_path, "w") as artefacts_file:
+        json.dump(artefacts, artefacts_file)
+    return UnitRegistry(units_file_path), ArtefactRegistry(artefacts_file_path)
+
+
+async def run(battle_count: int, port: int):
+    base_url = f'http://127.0.0.1:{port}'
+    await wait_for_server(base_url)
+    client = AsyncElasticsearch(base_url)
+    indexer = Indexer(client=client)
+    await indexer.create_battle_index(season=season)
+
+    raw_battles = load_sample_battles()
+    unit_registry = UnitRegistry(os.path.join(root_dir, "data/static/units.json"))
+    artefact_registry = ArtefactRegistry(os.path.join(root_dir, "data/static/artefacts.json"))
+    directory = tempfile.mkdtemp(prefix="backfill_names_")
+    try:
+        outdated_unit_registry, outdated_artefact_registry = outdated_registries(directory, raw_battles)
+        expected = [convert_raw_battle_source(raw, unit_registry, artefact_registry) for raw in raw_battles]
+        outdated = [convert_raw_battle_source(raw, outdated_unit_registry, outdated_artefact_registry)
+                    for raw in raw_battles]
+        affected = [position for position in range(len(raw_battles)) if outdated[position] != expected[position]]
+        assert len(affected) > 0
+
+        for start in range(0, battle_count, 5000):
+            await indexer.insert_battles([
+                {**outdated[battle_id % len(raw_battles)], "battle_id": battle_id}
+                for battle_id in range(start, min(start + 5000, battle_count))
+            ], season)
+        affected_count = sum(1 for battle_id in range(battle_count) if battle_id % len(raw_battles) in affected)
+
+        crawl_state = CrawlState(os.path.join(directory, "crawl.sqlite"))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            updated = await backfill_unknown_names(indexer, season, unit_registry, artefact_registry,
+                                                   crawl_state=crawl_state, batch_size=1000,
+                                                   max_updates_per_second=0)
+        elapsed = time.perf_counter() - start
+        assert updated == affected_count, f'{updated} battles updated, {affected_count} affected'
+        assert crawl_state.result("checkpoint") is None
+        crawl_state.close()
+
+        checked = 0
+        async for battle in indexer.iter_battles(season):
+            assert battle == {**expected[battle["battle_id"] % len(raw_battles)], "battle_id": battle["battle_id"],
+                              "indexed_at": battle["indexed_at"]}
+            checked += 1
+        assert checked == battle_count
+        print(f'backfill: {updated} of {battle_count} battles updated in {elapsed:.2f}s '
+              f'({battle_count / elapsed:.0f} battles scanned/s), all battles match the current registries')
+    finally:
+        shutil.rmtree(directory)
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=20000)
+    parser.add_argument("--port", type=int, default=18766)
+    args = parser.parse_args()
+
+    server = start_fake_servers(args.port, season, pool_size=1, battles_per_player=1, api_latency=0, es_latency=0)
+    try:
+        asyncio.run(run(args.battles, args.port))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Fills a `BattleStore` with battles converted from the recorded sample (with new battle ids), checks that they are
+read back unchanged (and expanded back to the same documents) and that an interrupted append is rolled back, then
+measures the append rate, the size per battle (against the json documents), the time to scan a full season (per unit
+pick and win counts) and the rate the battles are expanded back to documents, for a reindex.
+
+Usage: python -m benchmarks.battle_store [--battles 500000]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.convert_battles import load_sample_battles, root_dir
+from commands.battle_conversion import convert_raw_battle_source
+from src import ArtefactRegistry, UnitRegistry
+from src.battle_store import BattleStore
+
+batch_size = 5000
+
+
+unit_registry = UnitRegistry(filepath=os.path.join(root_dir, "data/static/units.json"))
+artefact_registry = ArtefactRegistry(filepath=os.path.join(root_dir, "data/static/artefacts.json"))
+
+
+def sample_documents() -> list[dict]:
+    return [convert_raw_battle_source(raw, unit_registry, artefact_registry) for raw in load_sample_battles()]
+
+
+def normalized(document: dict) -> dict:
+    # the conversion builds `prebans` from a set
+    return {**document, "prebans": sorted(document["prebans"], key=lambda unit: unit["id"])}
+
+
+def battles(documents: list[dict], count: int):
+    for battle_id in range(count):
+        yield {**documents[battle_id % len(documents)], "battle_id": battle_id + 1}
+
+
+def check_round_trip(store: BattleStore, documents: list[dict]):
+    p1_picks = store.decode("unit", store["p1_picks"][:len(documents)])
+    details_artifacts = store.decode("artifact", store["details_artifact"][:len(documents)])
+    for row, document in enumerate(documents):
+        # battles ended during the draft have less picks, the missing ones are decoded as None
+        assert [unit_id for unit_id in p1_picks[row] if unit_id is not None] == \
+               [unit["id"] for unit in document["p1_picks"]]
+        assert bool(store["p1_win"][row]) == document["p1_win"]
+        assert int(store["battle_date"][row]) == document["battle_date"]
+        p2_postban = store["p2_postban"][row]
+        assert store.decode("unit", p2_postban) == (document["p2_postban"] or {}).get("id")
+        assert sorted(artifact_id for artifact_id in details_artifacts[row] if artifact_id is not None) == \
+               sorted(detail["artifact_id"] for detail in document["units_details"])
+    expanded = store.battles(unit_registry, artefact_registry, stop=len(documents))
+    for battle, document in zip(expanded, documents):
+        assert normalized(battle) == normalized(document), battle["battle_id"]
+
+
+def check_recovery(directory: str, documents: list[dict]):
+    store = BattleStore(directory)
+    row_count = len(store)
+    # simulate a crash in the middle of an append: bytes written, meta not updated
+    with open(os.path.join(directory, "p1_picks.bin"), "ab") as column_file:
+        column_file.write(b"\x00" * 7)
+    store = BattleStore(directory)
+    assert len(store) == row_count
+    assert store.append([{**documents[0], "battle_id": 10 ** 12}]) == 1
+    assert store["battle_id"][-1] == 10 ** 12
+    # appending the same battles again is a no-op
+    assert store.append(list(battles(documents, len(documents)))) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=500000)
+    args = parser.parse_args()
+
+    documents = sample_documents()
+    directory = tempfile.mkdtemp(prefix="battle_store_")
+    try:
+        store = BattleStore(directory)
+        json_bytes = sum(len(json.dumps(document)) for document in documents) / len(documents)
+        start = time.perf_counter()
+        batch = []
+        for battle in battles(documents, args.battles):
+            batch.append(battle)
+            if len(batch) >= batch_size:
+                store.append(batch)
+                batch = []
+        store.append(batch)
+        elapsed = time.perf_counter() - start
+        store_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f'append: {len(store)} battles in {elapsed:.1f}s ({len(store) / elapsed:.0f} battles/s), '
+              f'{store_bytes / len(store):.0f} bytes per battle (json documents: {json_bytes:.0f})')
+
+        check_round_trip(BattleStore(directory), list(battles(documents, len(documents))))
+        check_recovery(directory, documents)
+        print('round trip and recovery: ok')
+
+        # a fresh reader, as a training job would open it
+        start = time.perf_counter()
+        store = BattleStore(directory)
+        num_units = len(store.dictionaries["unit"])
+        p1_picks, p2_picks = store["p1_picks"], store["p2_picks"]
+        p1_win = np.asarray(store["p1_win"])
+        picks = np.zeros(num_units, dtype=np.int64)
+        wins = np.zeros(num_units, dtype=np.int64)
+        for team, team_wins in [(p1_picks, p1_win), (p2_picks, ~p1_win)]:
+            team = np.asarray(team)
+            valid = team >= 0
+            picks += np.bincount(team[valid], minlength=num_units)
+            wins += np.bincount(team[valid], weights=np.broadcast_to(team_wins[:, None], team.shape)[valid],
+                                minlength=num_units).astype(np.int64)
+        elapsed = time.perf_counter() - start
+        print(f'scan: pick and win counts of {num_units} units over {len(store)} battles in {elapsed * 1000:.0f}ms')
+
+        start = time.perf_counter()
+        expanded = sum(1 for _ in store.battles(unit_registry, artefact_registry))
+        elapsed = time.perf_counter() - start
+        print(f'expand: {expanded} battles back to documents in {elapsed:.1f}s ({expanded / elapsed:.0f} battles/s)')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
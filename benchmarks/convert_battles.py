@@ -0,0 +1,70 @@
+"""
+Compares `convert_raw_battle` with its fast path `convert_raw_battle_source`.
+
+Checks that both produce the same documents for the recorded sample, then measures battles/sec on a single core.
+
+Usage: python -m benchmarks.convert_battles [--iterations 50]
+"""
+import argparse
+import json
+import os
+import time
+
+from rta_api.model import GetBattleListResponse
+from commands.battle_conversion import convert_raw_battle, convert_raw_battle_source
+from src import UnitRegistry, ArtefactRegistry
+
+root_dir = os.path.join(os.path.dirname(__file__), "..")
+
+
+def load_sample_battles():
+    with open(os.path.join(root_dir, "rta_api/samples/getBattleList.json"), "r") as sample_file:
+        response = GetBattleListResponse(**json.load(sample_file))
+    return response.result_body.battle_list
+
+
+def check_parity(raw_battles, unit_registry, artefact_registry):
+    for raw in raw_battles:
+        expected = convert_raw_battle(raw, unit_registry, artefact_registry).model_dump()
+        actual = convert_raw_battle_source(raw, unit_registry, artefact_registry)
+        if expected != actual:
+            mismatches = [key for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key)]
+            raise AssertionError(f'battle {raw.battle_seq}: fields differ: {sorted(mismatches)}')
+    print(f'parity ok on {len(raw_battles)} battles')
+
+
+def measure(name, convert, raw_battles, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for raw in raw_battles:
+            convert(raw)
+    elapsed = time.perf_counter() - start
+    rate = iterations * len(raw_battles) / elapsed
+    print(f'{name}: {rate:,.0f} battles/sec')
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    unit_registry = UnitRegistry(filepath=os.path.join(root_dir, "data/static/units.json"))
+    artefact_registry = ArtefactRegistry(filepath=os.path.join(root_dir, "data/static/artefacts.json"))
+    raw_battles = load_sample_battles()
+
+    check_parity(raw_battles, unit_registry, artefact_registry)
+
+    baseline = measure(
+        "convert_raw_battle + model_dump",
+        lambda raw: convert_raw_battle(raw, unit_registry, artefact_registry).model_dump(),
+        raw_battles, args.iterations)
+    fast = measure(
+        "convert_raw_battle_source",
+        lambda raw: convert_raw_battle_source(raw, unit_registry, artefact_registry),
+        raw_battles, args.iterations)
+    print(f'speedup: x{fast / baseline:.1f}')
+
+
+if __name__ == "__main__":
+    main()
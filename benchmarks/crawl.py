@@ -0,0 +1,109 @@
+"""
+Compares the upstream calls of the two pass crawl (`fetch-users`, then `sync-battles` on the players it found) with the
+single pass `crawl`, for the same number of players, against the local fake game api and Elasticsearch
+(see `fake_servers`).
+
+Usage: python -m benchmarks.crawl [--players 300]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from elasticsearch import AsyncElasticsearch
+
+from benchmarks.fake_servers import start_fake_servers
+from benchmarks.ingestion import server_call, wait_for_server
+from commands import crawl, fetch_player_list, sync_players_battles
+from rta_api import api as rta_api, call_stats, rate_limiter
+from src import ArtefactRegistry, Indexer, KnownPlayers, UnitRegistry
+from src.indexer import battle_index, player_index
+
+season = "pvp_rta_ss12"
+
+
+async def no_players():
+    return
+    yield
+
+
+async def run_scenario(scenario: str, players: int, port: int) -> str:
+    base_url = f'http://127.0.0.1:{port}'
+    await wait_for_server(base_url)
+    rta_api.api_base_url = f'{base_url}/gameApi'
+    rate_limiter.configure(rate=1000000, burst=1000000)
+    call_stats.clear()
+
+    client = AsyncElasticsearch(base_url)
+    indexer = Indexer(client=client)
+    await indexer.create_player_index(season=season)
+    await indexer.create_battle_index(season=season)
+    indexer.start_bulk_writer()
+    unit_registry = UnitRegistry(filepath="data/static/units.json")
+    artefact_registry = ArtefactRegistry(filepath="data/static/artefacts.json")
+
+    start = time.perf_counter()
+    # the workers are very verbose
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scenario == "two pass":
+            await fetch_player_list(indexer=indexer, season=season, known_players=KnownPlayers(), num_worker=10,
+                                    max_users=players)
+            await sync_players_battles(
+                indexer=indexer,
+                unit_registry=unit_registry,
+                artefact_registry=artefact_registry,
+                players_to_sync=indexer.iter_users_to_refresh(players, season),
+                known_players=KnownPlayers(),
+                season=season,
+                sync_discovered_players=False,
+                num_worker=10,
+            )
+        else:
+            # the recommended players are synced along with the discovered ones
+            await crawl(
+                indexer=indexer,
+                unit_registry=unit_registry,
+                artefact_registry=artefact_registry,
+                season=season,
+                players_to_refresh=no_players(),
+                known_players=KnownPlayers(),
+                max_discovered_players=players,
+                num_worker=10,
+            )
+    await indexer.close_bulk_writer()
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    stats = await server_call(base_url, "GET", "/_bench/stats")
+    player_count = stats["documents"].get(player_index(season), 0)
+    battle_count = stats["documents"].get(battle_index(season), 0)
+    calls = {endpoint: call_stats.calls(endpoint) for endpoint in call_stats.outcomes}
+    battle_list_calls = calls.get("getBattleList", 0)
+    return (f'{scenario:<10}{player_count:>9}{battle_count:>10}{battle_list_calls:>16}'
+            f'{calls.get("getRecommendList", 0):>18}{battle_count / max(battle_list_calls, 1):>18.1f}'
+            f'{elapsed:>9.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=300)
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--port", type=int, default=18767)
+    args = parser.parse_args()
+
+    print(f'{"scenario":<10}{"players":>9}{"battles":>10}{"getBattleList":>16}{"getRecommendList":>18}'
+          f'{"battles per call":>18}{"time":>10}')
+    for offset, scenario in enumerate(["two pass", "crawl"]):
+        # a fresh fake cluster for each scenario
+        port = args.port + offset
+        server = start_fake_servers(port, season, pool_size=args.players * 4, battles_per_player=50,
+                                    api_latency=args.api_latency, es_latency=0)
+        try:
+            print(asyncio.run(run_scenario(scenario, args.players, port)))
+        finally:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
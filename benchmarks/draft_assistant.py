@@ -0,0 +1,112 @@
+"""
+Measures the latency of `DraftAssistant.suggest` on random partial drafts at every step of the draft, with the whole
+unit list as candidates, using a predictor and stats trained on synthetic battles (see the `win_predictor` and
+`draft_stats` benchmarks), with its p99 and max against the budget, in wall and cpu time. Also checks the
+suggestions against a brute force scoring of the immediate next action.
+
+Usage: python -m benchmarks.draft_assistant [--drafts 2000] [--budget-ms 10]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from benchmarks import draft_stats as draft_stats_benchmark
+from benchmarks import win_predictor as win_predictor_benchmark
+from src import ArtefactRegistry, UnitRegistry
+from src.draft_assistant import DraftAssistant, next_action, pick_order
+from src.draft_stats import DraftStats
+from src.win_predictor import WinPredictor, draft_from_battle
+
+
+def random_partial_draft(unit_ids: list[str], rng: random.Random) -> dict:
+    """
+    A draft stopped at a random step: prebans, picks or postbans.
+    """
+    units = rng.sample(unit_ids, 14)
+    step = rng.randrange(4 + len(pick_order) + 2)
+    prebans = units[10:14][:step]
+    pick_count = max(0, min(len(pick_order), step - 4))
+    p1_picks = [unit for unit, side in zip(units[:10], pick_order[:pick_count]) if side == "p1"]
+    p2_picks = [unit for unit, side in zip(units[:10], pick_order[:pick_count]) if side == "p2"]
+    postban_count = max(0, step - 4 - len(pick_order))
+    return {
+        "p1_picks": p1_picks,
+        "p2_picks": p2_picks,
+        "p1_prebans": prebans[:2],
+        "p2_prebans": prebans[2:4],
+        "p2_postban": rng.choice(p2_picks) if postban_count > 0 else None,
+        "p1_grade": "legend",
+        "p2_grade": "legend",
+    }
+
+
+def check_immediate_ranking(predictor: WinPredictor, unit_ids: list[str], rng: random.Random):
+    """
+    Without lookahead nor interactions, the suggestions must be the best units by predicted win rate.
+    """
+    assistant = DraftAssistant(predictor, max_depth=1)
+    for _ in range(50):
+        draft = random_partial_draft(unit_ids, rng)
+        result = assistant.suggest(draft, top_n=3)
+        state = assistant.encode_state(draft)
+        side, action = next_action(state)
+        if action != "pick":
+            continue
+        used = set(draft["p1_picks"] + draft["p2_picks"] + draft["p1_prebans"] + draft["p2_prebans"])
+        candidates = [unit_id for unit_id in unit_ids if unit_id not in used]
+        field = f'{side}_picks'
+        probabilities = predictor.predict([{**draft, field: draft[field] + [unit_id]} for unit_id in candidates])
+        if side == "p2":
+            probabilities = 1 - probabilities
+        expected = [candidates[position] for position in np.argsort(-probabilities)[:3]]
+        assert [suggestion["unit_id"] for suggestion in result["suggestions"]] == expected, (result, expected)
+        assert abs(result["suggestions"][0]["win_rate"] - probabilities.max()) < 1e-4
+
+
+def budget_status(latency_ms: float, budget_ms: float) -> str:
+    return "ok" if latency_ms <= budget_ms else "over budget"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drafts", type=int, default=2000)
+    parser.add_argument("--battles", type=int, default=50000)
+    parser.add_argument("--budget-ms", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    unit_ids = list(UnitRegistry(filepath="data/static/units.json").ids)
+    artifact_ids = list(ArtefactRegistry(filepath="data/static/artefacts.json").ids)
+    battles, _ = win_predictor_benchmark.synthetic_battles(unit_ids, artifact_ids, args.battles, args.seed)
+    predictor = WinPredictor(unit_ids, artifact_ids)
+    predictor.train([draft_from_battle(battle) for battle in battles],
+                    np.array([battle["p1_win"] for battle in battles]), epochs=5)
+    stats = DraftStats(unit_ids)
+    stats.add_battles(draft_stats_benchmark.synthetic_battles(unit_ids, args.battles, args.seed))
+
+    rng = random.Random(args.seed)
+    check_immediate_ranking(predictor, unit_ids, rng)
+    print('immediate ranking: ok')
+
+    assistant = DraftAssistant(predictor, stats=stats)
+    drafts = [random_partial_draft(unit_ids, rng) for _ in range(args.drafts)]
+    for name in ["cold cache", "warm cache"]:
+        latencies, cpu_times = [], []
+        for draft in drafts:
+            start, cpu_start = time.perf_counter(), time.process_time()
+            assistant.suggest(draft)
+            latencies.append(time.perf_counter() - start)
+            cpu_times.append(time.process_time() - cpu_start)
+        print(f'{name}: {len(drafts)} drafts over {len(unit_ids)} units')
+        # the wall time also counts the delays where the process is not scheduled, which the cpu time leaves out
+        for clock, durations in [("wall", latencies), ("cpu", cpu_times)]:
+            p50, p99, worst = np.percentile(durations, [50, 99, 100]) * 1000
+            over_budget = sum(duration * 1000 > args.budget_ms for duration in durations)
+            print(f'  {clock}: p50 {p50:.2f}ms / p99 {p99:.2f}ms ({budget_status(p99, args.budget_ms)}) / '
+                  f'max {worst:.2f}ms ({budget_status(worst, args.budget_ms)}), {over_budget} over {args.budget_ms:g}ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Checks the vectorized `DraftStats` aggregation against a naive one, on synthetic battles drawn from the unit list,
+then measures the aggregation throughput and the draft feature lookup latency.
+
+Usage: python -m benchmarks.draft_stats [--battles 200000]
+"""
+import argparse
+import random
+import time
+from collections import Counter
+
+import numpy as np
+
+from src import UnitRegistry
+from src.draft_stats import DraftStats
+
+batch_size = 5000
+
+
+def synthetic_battles(unit_ids: list[str], count: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    # a few popular units, as in the real meta
+    weights = [1 / (rank + 1) for rank in range(len(unit_ids))]
+    battles = []
+    for battle_id in range(count):
+        units = []
+        while len(units) < 14:
+            unit_id = rng.choices(unit_ids, weights=weights)[0]
+            if unit_id not in units:
+                units.append(unit_id)
+        p1_picks, p2_picks, prebans = units[0:5], units[5:10], units[10:14]
+        battles.append({
+            "battle_id": 1000000 + battle_id,
+            "battle_date": 1700000000000 + battle_id * 1000,
+            "p1_win": rng.random() < 0.52,
+            "p1_picks": [{"id": unit_id} for unit_id in p1_picks],
+            "p2_picks": [{"id": unit_id} for unit_id in p2_picks],
+            "p1_prebans": [{"id": unit_id} for unit_id in prebans[0:2]],
+            "p2_prebans": [{"id": unit_id} for unit_id in prebans[2:4]],
+            "p1_postban": {"id": rng.choice(p1_picks)},
+            "p2_postban": None if rng.random() < 0.05 else {"id": rng.choice(p2_picks)},
+        })
+    return battles
+
+
+def check_parity(stats: DraftStats, battles: list[dict]):
+    picks, wins, pair_picks, matchup_wins = Counter(), Counter(), Counter(), Counter()
+    for battle in battles:
+        teams = [([unit["id"] for unit in battle["p1_picks"]], battle["p1_win"]),
+                 ([unit["id"] for unit in battle["p2_picks"]], not battle["p1_win"])]
+        for (team, win), (enemy_team, _) in zip(teams, reversed(teams)):
+            for unit_id in team:
+                picks[unit_id] += 1
+                wins[unit_id] += win
+                for other_id in team:
+                    if other_id != unit_id:
+                        pair_picks[unit_id, other_id] += 1
+                for enemy_id in enemy_team:
+                    matchup_wins[unit_id, enemy_id] += win
+
+    index = stats.unit_index
+    assert all(stats.picks[index[unit_id]] == count for unit_id, count in picks.items())
+    assert all(stats.wins[index[unit_id]] == count for unit_id, count in wins.items())
+    assert all(stats.pair_picks[index[a], index[b]] == count for (a, b), count in pair_picks.items())
+    assert all(stats.matchup_wins[index[a], index[b]] == count for (a, b), count in matchup_wins.items())
+    assert stats.picks.sum() == sum(picks.values())
+    assert stats.pair_picks.sum() == sum(pair_picks.values())
+    # adding the same battles again is a no-op
+    assert stats.add_battles(battles) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    unit_ids = list(UnitRegistry(filepath="data/static/units.json").ids)
+    battles = synthetic_battles(unit_ids, args.battles, args.seed)
+
+    parity_stats = DraftStats(unit_ids)
+    parity_stats.add_battles(battles[:batch_size])
+    check_parity(parity_stats, battles[:batch_size])
+    print(f'parity: ok on {batch_size} battles')
+
+    stats = DraftStats(unit_ids)
+    start = time.perf_counter()
+    for position in range(0, len(battles), batch_size):
+        stats.add_battles(battles[position:position + batch_size])
+    elapsed = time.perf_counter() - start
+    print(f'aggregation: {len(battles)} battles in {elapsed:.2f}s ({len(battles) / elapsed:.0f} battles/s), '
+          f'{len(stats)} units')
+
+    rng = random.Random(args.seed)
+    drafts = [rng.sample(unit_ids, 10) for _ in range(10000)]
+    stats.draft_features(drafts[0][:5], drafts[0][5:])
+    latencies = []
+    for draft in drafts:
+        start = time.perf_counter()
+        stats.draft_features(draft[:5], draft[5:])
+        latencies.append(time.perf_counter() - start)
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000000
+    print(f'draft features: p50 {p50:.0f}us / p99 {p99:.0f}us')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Local stand-ins for the game api and Elasticsearch, used by the ingestion benchmarks.
+
+- the game api replays the recorded `getBattleList` sample, rewritten for each requested player with unique battle ids
+  and opponents taken from a fixed pool of players (so discovery keeps finding players until the pool is exhausted);
+  with `shared_battles`, each battle is listed by both of its players, with the same id, as by the real api
+- Elasticsearch implements just enough of `_bulk`, `_update`, `_search` (point in time + search_after),
+  `_pit` and the index apis for the `Indexer`, and keeps the documents in memory; searches on an index support
+  the `term` / `bool` queries and the `filter` / `terms` aggregations of the query service
+
+Both run in a separate process (see `start_fake_servers`), so they do not compete with the benchmarked event loop.
+"""
+import asyncio
+import copy
+import json
+import multiprocessing
+import os
+import time
+from aiohttp import web
+
+root_dir = os.path.join(os.path.dirname(__file__), "..")
+es_headers = {"X-Elastic-Product": "Elasticsearch"}
+worlds = ["world_global", "world_kor", "world_asia", "world_jpn", "world_eu"]
+
+
+def pool_player(index: int) -> tuple[int, str]:
+    return 100000000 + index, worlds[index % len(worlds)]
+
+
+class FakeGameApi:
+    season: str
+    pool_size: int
+    battles_per_player: int
+    latency: float
+    shared_battles: bool
+
+    def __init__(self, season: str, pool_size: int, battles_per_player: int, latency: float,
+                 shared_battles: bool = False):
+        self.season = season
+        self.pool_size = pool_size
+        self.battles_per_player = battles_per_player
+        self.latency = latency
+        self.shared_battles = shared_battles
+        with open(os.path.join(root_dir, "rta_api/samples/getBattleList.json"), "r") as sample_file:
+            self.templates = json.load(sample_file)["result_body"]["battle_list"]
+        with open(os.path.join(root_dir, "rta_api/samples/getRecommendList.json"), "r") as sample_file:
+            self.recommend_template = json.load(sample_file)
+
+    async def get_battle_list(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        user_id = int(request.query["nick_no"])
+        world_code = request.query["world_code"]
+        player_index = user_id - 100000000
+
+        battles = []
+        for n in range(self.battles_per_player):
+            battle = copy.copy(self.templates[n % len(self.templates)])
+            opponent_index = (player_index * 7919 + n * 104729) % self.pool_size
+            # unique per player and battle, so every battle gets indexed
+            battle_seq = player_index * 1000 + n + 1
+            if self.shared_battles:
+                # the even battles are against the k-th next player, the odd ones against the k-th previous player,
+                # which lists the same battle as its even one
+                k = n // 2 + 1
+                if n % 2 == 0:
+                    opponent_index = (player_index + k) % self.pool_size
+                    battle_seq = player_index * self.battles_per_player + n + 1
+                else:
+                    opponent_index = (player_index - k) % self.pool_size
+                    battle_seq = opponent_index * self.battles_per_player + n
+            opponent_id, opponent_world = pool_player(opponent_index)
+            battle.update({
+                "nicknameno": user_id,
+                "worldCode": world_code,
+                "matchPlayerNicknameno": opponent_id,
+                "enemy_world_code": opponent_world,
+                "battle_seq": str(battle_seq),
+                "season_code": self.season,
+                "grade_code": "legend",
+                "enemy_grade_code": "legend",
+            })
+            battles.append(battle)
+
+        return web.json_response({
+            "result_body": {"nick_no": user_id, "world_code": world_code, "battle_list": battles},
+            "return_code": 0,
+        })
+
+    async def get_recommend_list(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        response = copy.deepcopy(self.recommend_template)
+        for n, player in enumerate(response["result_body"]["recommend_list"]):
+            player["nick_no"], player["world_code"] = pool_player(n % self.pool_size)
+            player["seasonCode"] = self.season
+        return web.json_response(response)
+
+
+class FakeElasticsearch:
+    latency: float
+    indices: dict[str, dict[str, dict]]
+    bulk_latencies: list[float]
+    bulk_sizes: list[int]
+    request_count: int
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.indices = {}
+        self.bulk_latencies = []
+        self.bulk_sizes = []
+        self.request_count = 0
+
+    def respond(self, body: dict, status: int = 200):
+        return web.json_response(body, status=status, headers=es_headers)
+
+    async def head_index(self, request: web.Request):
+        self.request_count += 1
+        exists = request.match_info["index"] in self.indices
+        return web.Response(status=200 if exists else 404, headers=es_headers)
+
+    async def create_index(self, request: web.Request):
+        self.request_count += 1
+        self.indices.setdefault(request.match_info["index"], {})
+        return self.respond({"acknowledged": True, "index": request.match_info["index"]})
+
+    async def put_mapping(self, request: web.Request):
+        self.request_count += 1
+        return self.respond({"acknowledged": True})
+
+    async def acknowledge(self, request: web.Request):
+        """
+        Settings, aliases and refreshes have no effect here.
+        """
+        self.request_count += 1
+        return self.respond({"acknowledged": True})
+
+    async def bulk(self, request: web.Request):
+        self.request_count += 1
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        lines = [line for line in (await request.text()).split("\n") if line]
+        items = []
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            operation, meta = next(iter(action.items()))
+            source = json.loads(lines[position + 1])
+            position += 2
+            documents = self.indices.setdefault(meta["_index"], {})
+            doc_id = str(meta["_id"])
+            status = 200
+            if operation == "create" and doc_id in documents:
+                status = 409
+            elif operation == "update":
+                if doc_id not in documents:
+                    status = 404
+                else:
+                    documents[doc_id].update(source.get("doc", {}))
+            else:
+                documents[doc_id] = source
+                status = 201
+            item = {"_index": meta["_index"], "_id": doc_id, "status": status}
+            if status >= 300:
+                item["error"] = {"type": "fake_error", "reason": f'status {status}'}
+            items.append({operation: item})
+
+        self.bulk_sizes.append(len(items))
+        self.bulk_latencies.append(time.perf_counter() - start)
+        errors = any(next(iter(item.values()))["status"] >= 300 for item in items)
+        return self.respond({"took": 1, "errors": errors, "items": items})
+
+    async def update(self, request: web.Request):
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        documents = self.indices.setdefault(request.match_info["index"], {})
+        doc_id = request.match_info["id"]
+        if doc_id not in documents:
+            return self.respond({"error": {"type": "document_missing_exception"}, "status": 404}, status=404)
+        documents[doc_id].update(body.get("doc", {}))
+        return self.respond({"_index": request.match_info["index"], "_id": doc_id, "result": "updated"})
+
+    async def open_pit(self, request: web.Request):
+        self.request_count += 1
+        return self.respond({"id": request.match_info["index"]})
+
+    async def close_pit(self, request: web.Request):
+        self.request_count += 1
+        return self.respond({"succeeded": True, "num_freed": 1})
+
+    async def search(self, request: web.Request):
+        """
+        Only supports paging over a point in time, in insertion order (sorts and queries are ignored).
+        """
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        index = body["pit"]["id"]
+        documents = list(self.indices.get(index, {}).items())
+        offset = body["search_after"][0] + 1 if body.get("search_after") else 0
+        page = documents[offset:offset + body.get("size", 10)]
+        hits = [
+            {"_index": index, "_id": doc_id, "_source": source, "sort": [offset + n]}
+            for n, (doc_id, source) in enumerate(page)
+        ]
+        return self.respond({"pit_id": index, "took": 1, "timed_out": False,
+                             "hits": {"total": {"value": len(documents), "relation": "eq"}, "hits": hits}})
+
+    async def index_search(self, request: web.Request):
+        """
+        Searches without a point in time: matching documents sorted on a single field, and aggregations.
+        """
+        self.request_count += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        documents = [source for source in self.indices.get(request.match_info["index"], {}).values()
+                     if matches(source, body.get("query", {"match_all": {}}))]
+        for sort in reversed(body.get("sort", [])):
+            field, options = next(iter(sort.items()))
+            documents.sort(key=lambda source: source[field], reverse=options["order"] == "desc")
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "hits": {"total": {"value": len(documents), "relation": "eq"},
+                     "hits": [{"_source": source} for source in documents[:body.get("size", 10)]]},
+        }
+        if "aggs" in body:
+            response["aggregations"] = aggregate(documents, body["aggs"])
+        return self.respond(response)
+
+    async def seed(self, request: web.Request):
+        """
+        Bench only api: fills the player index with the first `count` players of the pool.
+        """
+        body = await request.json()
+        documents = self.indices.setdefault(body["index"], {})
+        for n in range(body["count"]):
+            user_id, world = pool_player(n)
+            documents[f'{user_id}_{world}'] = {
+                "user_id": user_id, "user_world": world, "user_name": f'player {n}',
+                "last_known_rank": "legend", "last_update_time": 0, "last_updated_battle_id": 0,
+            }
+        return web.json_response({"seeded": body["count"]})
+
+    async def stats(self, request: web.Request):
+        """
+        Bench only api: returns the number of documents per index and the bulk request stats.
+        """
+        return web.json_response({
+            "documents": {index: len(documents) for index, documents in self.indices.items()},
+            "bulk_latencies": self.bulk_latencies,
+            "bulk_sizes": self.bulk_sizes,
+            "request_count": self.request_count,
+        })
+
+
+def field_values(source: dict, field: str) -> list:
+    """
+    The values of a dotted field, through the lists of objects.
+    """
+    values = [source]
+    for name in field.split("."):
+        values = [value.get(name) for value in values if isinstance(value, dict)]
+        values = [item for value in values for item in (value if isinstance(value, list) else [value])]
+    return [value for value in values if value is not None]
+
+
+def matches(source: dict, query: dict) -> bool:
+    kind, clause = next(iter(query.items()))
+    if kind == "match_all":
+        return True
+    if kind == "term":
+        field, value = next(iter(clause.items()))
+        return value in field_values(source, field)
+    if kind == "bool":
+        should = clause.get("should", [])
+        return (all(matches(source, sub) for sub in clause.get("must", []) + clause.get("filter", []))
+                and (len(should) == 0 or sum(matches(source, sub) for sub in should)
+                     >= clause.get("minimum_should_match", 1)))
+    raise ValueError(f'unsupported query {kind}')
+
+
+def aggregate(documents: list[dict], aggs: dict) -> dict:
+    results = {}
+    for name, aggregation in aggs.items():
+        if "filter" in aggregation:
+            selected = [source for source in documents if matches(source, aggregation["filter"])]
+            results[name] = {"doc_count": len(selected), **aggregate(selected, aggregation.get("aggs", {}))}
+        elif "terms" in aggregation:
+            buckets: dict = {}
+            for source in documents:
+                for value in set(field_values(source, aggregation["terms"]["field"])):
+                    buckets.setdefault(value, []).append(source)
+            top = sorted(buckets.items(), key=lambda item: -len(item[1]))[:aggregation["terms"].get("size", 10)]
+            results[name] = {"buckets": [{"key": key, "doc_count": len(selected),
+                                          **aggregate(selected, aggregation.get("aggs", {}))}
+                                         for key, selected in top]}
+        else:
+            raise ValueError(f'unsupported aggregation {next(iter(aggregation))}')
+    return results
+
+
+def create_app(season: str, pool_size: int, battles_per_player: int, api_latency: float, es_latency: float,
+               shared_battles: bool = False):
+    game_api = FakeGameApi(season, pool_size, battles_per_player, api_latency, shared_battles)
+    elasticsearch = FakeElasticsearch(es_latency)
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post("/gameApi/getBattleList", game_api.get_battle_list)
+    app.router.add_post("/gameApi/getRecommendList", game_api.get_recommend_list)
+    app.router.add_post("/_bench/seed", elasticsearch.seed)
+    app.router.add_get("/_bench/stats", elasticsearch.stats)
+    app.router.add_route("*", "/_bulk", elasticsearch.bulk)
+    app.router.add_route("*", "/_search", elasticsearch.search)
+    app.router.add_route("*", "/{index}/_search", elasticsearch.index_search)
+    app.router.add_delete("/_pit", elasticsearch.close_pit)
+    app.router.add_post("/{index}/_pit", elasticsearch.open_pit)
+    app.router.add_put("/{index}/_mapping", elasticsearch.put_mapping)
+    app.router.add_put("/{index}/_settings", elasticsearch.acknowledge)
+    app.router.add_put("/{index}/_alias/{name}", elasticsearch.acknowledge)
+    app.router.add_post("/{index}/_refresh", elasticsearch.acknowledge)
+    app.router.add_post("/{index}/_update/{id}", elasticsearch.update)
+    app.router.add_route("HEAD", "/{index}", elasticsearch.head_index)
+    app.router.add_put("/{index}", elasticsearch.create_index)
+    return app
+
+
+def _serve(port: int, season: str, pool_size: int, battles_per_player: int, api_latency: float, es_latency: float,
+           shared_battles: bool):
+    app = create_app(season, pool_size, battles_per_player, api_latency, es_latency, shared_battles)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def start_fake_servers(port: int, season: str, pool_size: int, battles_per_player: int,
+                       api_latency: float, es_latency: float, shared_battles: bool = False) -> multiprocessing.Process:
+    process = multiprocessing.Process(
+        target=_serve,
+        args=(port, season, pool_size, battles_per_player, api_latency, es_latency, shared_battles),
+        daemon=True,
+    )
+    process.start()
+    return process
@@ -0,0 +1,181 @@
+"""
+Offline ingestion benchmark: runs `sync_players_battles` and `fetch_player_list` against the local fake game api and
+fake Elasticsearch (see `fake_servers`), for several worker counts.
+
+Reports players/sec, battles/sec, p50/p99 latency per stage and peak RSS. Each scenario runs in its own process,
+so the peak RSS is not shared between scenarios.
+
+Usage: python -m benchmarks.ingestion [--workers 1,10,50] [--players 500] [--api-latency 0.05]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import aiohttp
+from elasticsearch import AsyncElasticsearch
+
+from benchmarks.fake_servers import start_fake_servers
+from commands import BattleConverter, fetch_player_list, sync_players_battles
+from rta_api import api as rta_api, call_stats, rate_limiter
+from src import ArtefactRegistry, Indexer, KnownPlayers, UnitRegistry
+from src.indexer import player_index
+
+season = "pvp_rta_ss12"
+
+
+class TimedBattleConverter(BattleConverter):
+    latencies: list[float]
+
+    def __init__(self, unit_registry: UnitRegistry, artefact_registry: ArtefactRegistry):
+        super().__init__(unit_registry, artefact_registry)
+        self.latencies = []
+
+    async def convert(self, raw_battles):
+        start = time.perf_counter()
+        battles = await super().convert(raw_battles)
+        self.latencies.append(time.perf_counter() - start)
+        return battles
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) == 0:
+        return "-"
+    ordered = sorted(values)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return f'p50 {p50 * 1000:.1f}ms / p99 {p99 * 1000:.1f}ms'
+
+
+async def wait_for_server(base_url: str):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f'{base_url}/_bench/stats'):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.05)
+    raise RuntimeError("fake servers did not start")
+
+
+async def server_call(base_url: str, method: str, path: str, body: dict | None = None) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, f'{base_url}{path}', json=body) as response:
+            return await response.json()
+
+
+async def run_scenario(scenario: str, num_worker: int, players: int, port: int) -> dict:
+    base_url = f'http://127.0.0.1:{port}'
+    await wait_for_server(base_url)
+    rta_api.api_base_url = f'{base_url}/gameApi'
+    rate_limiter.configure(rate=1000000, burst=1000000)
+
+    client = AsyncElasticsearch(base_url)
+    indexer = Indexer(client=client)
+    await indexer.create_player_index(season=season)
+    await indexer.create_battle_index(season=season)
+
+    unit_registry = UnitRegistry(filepath="data/static/units.json")
+    artefact_registry = ArtefactRegistry(filepath="data/static/artefacts.json")
+    converter = TimedBattleConverter(unit_registry, artefact_registry)
+
+    start = time.perf_counter()
+    # the workers are very verbose
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scenario == "sync-battles":
+            await server_call(base_url, "POST", "/_bench/seed", {"index": player_index(season), "count": players})
+            indexer.start_bulk_writer()
+            await sync_players_battles(
+                indexer=indexer,
+                unit_registry=unit_registry,
+                artefact_registry=artefact_registry,
+                players_to_sync=indexer.iter_users_to_refresh(players, season),
+                known_players=KnownPlayers(),
+                season=season,
+                sync_discovered_players=False,
+                num_worker=num_worker,
+                converter=converter,
+            )
+            await indexer.close_bulk_writer()
+        else:
+            await fetch_player_list(
+                indexer=indexer,
+                season=season,
+                known_players=KnownPlayers(),
+                num_worker=num_worker,
+                max_users=players,
+            )
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    stats = await server_call(base_url, "GET", "/_bench/stats")
+    battle_count = stats["documents"].get(f'rta_battles_{season}', 0)
+    player_count = stats["documents"].get(player_index(season), 0)
+
+    return {
+        "scenario": scenario,
+        "num_worker": num_worker,
+        "elapsed": elapsed,
+        "players_per_sec": (players if scenario == "sync-battles" else player_count) / elapsed,
+        "battles_per_sec": battle_count / elapsed,
+        "api": percentiles([latency for latencies in call_stats.latencies.values() for latency in latencies]),
+        "conversion": percentiles(converter.latencies),
+        "es_bulk": percentiles(stats["bulk_latencies"]),
+        "es_requests": stats["request_count"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_single(args):
+    server = start_fake_servers(args.port, season, pool_size=args.players * 4,
+                                battles_per_player=args.battles_per_player,
+                                api_latency=args.api_latency, es_latency=args.es_latency)
+    try:
+        result = asyncio.run(run_scenario(args.scenario, args.num_worker, args.players, args.port))
+    finally:
+        server.terminate()
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default="sync-battles,fetch-users")
+    parser.add_argument("--workers", default="1,10,50")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--battles-per-player", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--es-latency", type=float, default=0.005)
+    parser.add_argument("--port", type=int, default=18765)
+    # internal: run a single scenario in the current process
+    parser.add_argument("--scenario")
+    parser.add_argument("--num-worker", type=int)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        run_single(args)
+        return
+
+    print(f'{"scenario":<14}{"workers":>8}{"players/s":>11}{"battles/s":>11}{"es reqs":>9}{"rss MB":>8}'
+          f'  stage latencies')
+    for scenario in args.scenarios.split(","):
+        for num_worker in map(int, args.workers.split(",")):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.ingestion",
+                 "--scenario", scenario, "--num-worker", str(num_worker),
+                 "--players", str(args.players), "--battles-per-player", str(args.battles_per_player),
+                 "--api-latency", str(args.api_latency), "--es-latency", str(args.es_latency),
+                 "--port", str(args.port)],
+                check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f'{scenario:<14}{num_worker:>8}{result["players_per_sec"]:>11.1f}{result["battles_per_sec"]:>11.1f}'
+                  f'{result["es_requests"]:>9}{result["peak_rss_mb"]:>8.0f}'
+                  f'  api {result["api"]}, conversion {result["conversion"]}, es bulk {result["es_bulk"]}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Indexes converted sample battles in the fake Elasticsearch (see `fake_servers`, with a latency standing for a heavy
+aggregation), then serves them with the query service:
+
+- checks that the answers from the aggregated draft stats match the Elasticsearch ones
+- sends bursts of identical concurrent requests, and counts the Elasticsearch requests they cost
+- serves draft suggestions from a win predictor trained on the same battles
+
+Usage: python -m benchmarks.query_service [--battles 5000] [--concurrency 100]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import aiohttp
+import numpy as np
+from elasticsearch import AsyncElasticsearch
+
+from benchmarks.convert_battles import load_sample_battles, root_dir
+from benchmarks.fake_servers import start_fake_servers
+from benchmarks.ingestion import percentiles, server_call, wait_for_server
+from commands.battle_conversion import convert_raw_battle_source
+from src import ArtefactRegistry, Indexer, UnitRegistry
+from src.draft_stats import DraftStats
+from src.query_cache import QueryCache
+from src.query_service import QueryService, start_query_server
+from src.win_predictor import WinPredictor, draft_from_battle
+
+season = "pvp_rta_ss12"
+
+
+def sample_battles(battle_count: int, unit_registry: UnitRegistry, artefact_registry: ArtefactRegistry) -> list[dict]:
+    raw_battles = load_sample_battles()
+    converted = [convert_raw_battle_source(raw, unit_registry, artefact_registry) for raw in raw_battles]
+    return [
+        {
+            **converted[battle_id % len(converted)],
+            "battle_id": battle_id,
+            "battle_date": converted[battle_id % len(converted)]["battle_date"] + battle_id,
+            # a few players, so each has many battles
+            "p1_id": 1000 + battle_id % 50,
+        }
+        for battle_id in range(battle_count)
+    ]
+
+
+async def es_requests(es_url: str) -> int:
+    return (await server_call(es_url, "GET", "/_bench/stats"))["request_count"]
+
+
+async def burst(session: aiohttp.ClientSession, url: str, concurrency: int,
+                draft: dict | None = None) -> tuple[list[float], list[bytes]]:
+    async def request() -> tuple[float, bytes]:
+        start = time.perf_counter()
+        # drafts are posted
+        async with session.request("GET" if draft is None else "POST", url, json=draft) as response:
+            assert response.status == 200, await response.text()
+            body = await response.read()
+        return time.perf_counter() - start, body
+
+    results = await asyncio.gather(*[request() for _ in range(concurrency)])
+    return [latency for latency, _ in results], [body for _, body in results]
+
+
+async def run(battle_count: int, concurrency: int, es_port: int, service_port: int):
+    es_url = f'http://127.0.0.1:{es_port}'
+    await wait_for_server(es_url)
+    client = AsyncElasticsearch(es_url)
+    indexer = Indexer(client=client)
+    await indexer.create_battle_index(season=season)
+
+    unit_registry = UnitRegistry(os.path.join(root_dir, "data/static/units.json"))
+    artefact_registry = ArtefactRegistry(os.path.join(root_dir, "data/static/artefacts.json"))
+    battles = sample_battles(battle_count, unit_registry, artefact_registry)
+    for start in range(0, len(battles), 5000):
+        await indexer.insert_battles(battles[start:start + 5000], season)
+
+    directory = tempfile.mkdtemp(prefix="query_service_")
+    draft_stats_path = os.path.join(directory, "draft_stats.npz")
+    draft_stats = DraftStats(list(unit_registry.ids))
+    draft_stats.add_battles(battles)
+    draft_stats.save(draft_stats_path)
+    win_predictor_path = os.path.join(directory, "win_predictor.npz")
+    predictor = WinPredictor(list(unit_registry.ids), list(artefact_registry.ids))
+    predictor.train([draft_from_battle(battle) for battle in battles],
+                    np.array([battle["p1_win"] for battle in battles]), epochs=2)
+    predictor.save(win_predictor_path)
+
+    from_aggregates = QueryService(indexer, season, unit_registry, QueryCache(), draft_stats_path=draft_stats_path,
+                                   win_predictor_path=win_predictor_path)
+    from_elasticsearch = QueryService(indexer, season, unit_registry, QueryCache())
+    runner = await start_query_server(from_aggregates, service_port)
+    try:
+        # parity of the two sources, on the most picked units and their pairs
+        meta = json.loads(await from_aggregates.meta(size=10))
+        assert meta["source"] == "aggregates"
+        assert meta == {**json.loads(await from_elasticsearch.meta(size=10)), "source": "aggregates"}
+        top_units = [unit["id"] for unit in meta["units"]]
+        checked = 0
+        for unit_id in top_units:
+            expected = json.loads(await from_elasticsearch.unit_win_rate(unit_id))
+            assert json.loads(await from_aggregates.unit_win_rate(unit_id)) == {**expected, "source": "aggregates"}
+            checked += 1
+        for other_unit_id in top_units[1:]:
+            expected = json.loads(await from_elasticsearch.pair_win_rate(top_units[0], other_unit_id))
+            actual = json.loads(await from_aggregates.pair_win_rate(other_unit_id, top_units[0]))
+            assert actual == {**expected, "source": "aggregates"}
+            checked += 1
+        player_battles = json.loads(await from_aggregates.player_battles(1000, size=20))["battles"]
+        assert len(player_battles) == 20 and all(battle["p1_id"] == 1000 for battle in player_battles)
+        assert [battle["battle_date"] for battle in player_battles] == sorted(
+            (battle["battle_date"] for battle in player_battles), reverse=True)
+        rank = battles[0]["p1_grade"]
+        print(f'parity: {checked} unit and pair win rates, and the meta, match between the aggregates and '
+              f'Elasticsearch')
+
+        draft = {
+            "p1_prebans": top_units[2:4],
+            "p2_prebans": top_units[4:6],
+            "p1_picks": top_units[:1],
+            "p1_grade": rank,
+            "p2_grade": rank,
+        }
+        suggestions = json.loads(await from_aggregates.draft_suggestions(draft, size=3))
+        assert suggestions["side"] == "p2" and suggestions["action"] == "pick", suggestions
+        assert abs(suggestions["p1_win_rate"] - float(predictor.predict([draft])[0])) < 1e-6
+        suggested = [suggestion["unit_id"] for suggestion in suggestions["suggestions"]]
+        assert len(suggested) == 3 and not set(suggested) & set(top_units[:6]), suggested
+        print(f'draft suggestions: {suggestions["side"]} {suggestions["action"]} {", ".join(suggested)}')
+
+        base_url = f'http://127.0.0.1:{service_port}'
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            async with session.post(f'{base_url}/draft/suggestions', json={"p1_picks": "not a list"}) as response:
+                assert response.status == 400, response.status
+            for name, path, body in [
+                ("meta by rank (cold)", f'/meta?rank={rank}', None),
+                ("meta by rank (cached)", f'/meta?rank={rank}', None),
+                ("unit by rank (cold)", f'/units/{top_units[0]}?rank={rank}', None),
+                ("pair (aggregates)", f'/pairs/{top_units[0]}/{top_units[1]}', None),
+                ("player battles (cold)", '/players/1001/battles', None),
+                ("draft suggestions (cold)", '/draft/suggestions?size=3', {**draft, "p2_picks": top_units[6:8]}),
+            ]:
+                before = await es_requests(es_url)
+                latencies, bodies = await burst(session, f'{base_url}{path}', concurrency, body)
+                after = await es_requests(es_url)
+                assert len(set(bodies)) == 1
+                print(f'{name:<24} {concurrency} concurrent requests: {after - before} Elasticsearch requests, '
+                      f'{percentiles(latencies)}')
+    finally:
+        await runner.cleanup()
+        await client.close()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--es-latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=18771)
+    args = parser.parse_args()
+
+    server = start_fake_servers(args.port, season, pool_size=1, battles_per_player=1, api_latency=0,
+                                es_latency=args.es_latency)
+    try:
+        asyncio.run(run(args.battles, args.concurrency, args.port, args.port + 1))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Runs the single pass `crawl` against the local fake game api and Elasticsearch (see `fake_servers`), where each battle
+is listed by both of its players, without and with the recently indexed battles cache, and compares the converted
+battles and the bulk actions sent. Also checks the cache round trip through its file.
+
+Usage: python -m benchmarks.recent_battles [--players 300]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from elasticsearch import AsyncElasticsearch
+
+from benchmarks.fake_servers import start_fake_servers
+from benchmarks.ingestion import TimedBattleConverter, server_call, wait_for_server
+from commands import crawl
+from rta_api import api as rta_api, rate_limiter
+from src import ArtefactRegistry, Indexer, KnownPlayers, UnitRegistry
+from src.indexer import battle_index
+from src.recent_battles import RecentBattles
+
+season = "pvp_rta_ss12"
+battles_per_player = 50
+
+
+async def no_players():
+    return
+    yield
+
+
+class CountingBattleConverter(TimedBattleConverter):
+    converted: int
+
+    def __init__(self, unit_registry: UnitRegistry, artefact_registry: ArtefactRegistry):
+        super().__init__(unit_registry, artefact_registry)
+        self.converted = 0
+
+    async def convert(self, raw_battles):
+        self.converted += len(raw_battles)
+        return await super().convert(raw_battles)
+
+
+async def run_scenario(scenario: str, players: int, port: int) -> str:
+    base_url = f'http://127.0.0.1:{port}'
+    await wait_for_server(base_url)
+    rta_api.api_base_url = f'{base_url}/gameApi'
+    rate_limiter.configure(rate=1000000, burst=1000000)
+
+    client = AsyncElasticsearch(base_url)
+    indexer = Indexer(client=client)
+    await indexer.create_player_index(season=season)
+    await indexer.create_battle_index(season=season)
+    indexer.start_bulk_writer()
+    converter = CountingBattleConverter(UnitRegistry(filepath="data/static/units.json"),
+                                        ArtefactRegistry(filepath="data/static/artefacts.json"))
+    recent_battles = RecentBattles() if scenario == "cache" else None
+
+    start = time.perf_counter()
+    # the workers are very verbose
+    with contextlib.redirect_stdout(io.StringIO()):
+        await crawl(
+            indexer=indexer,
+            unit_registry=converter.unit_registry,
+            artefact_registry=converter.artefact_registry,
+            season=season,
+            players_to_refresh=no_players(),
+            known_players=KnownPlayers(),
+            max_discovered_players=players,
+            num_worker=10,
+            converter=converter,
+            recent_battles=recent_battles,
+        )
+    await indexer.close_bulk_writer()
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    if recent_battles is not None:
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "recent_battles.bin")
+            recent_battles.save(filepath)
+            loaded = RecentBattles.load(filepath)
+            assert len(loaded) == len(recent_battles)
+            # the ids of the shared battles are below pool size * battles per player
+            assert all((battle_id in loaded) == (battle_id in recent_battles)
+                       for battle_id in range(players * 4 * battles_per_player + 1))
+
+    stats = await server_call(base_url, "GET", "/_bench/stats")
+    battle_count = stats["documents"].get(battle_index(season), 0)
+    bulk_actions = sum(stats["bulk_sizes"])
+    return f'{scenario:<10}{battle_count:>10}{converter.converted:>11}{bulk_actions:>14}{elapsed:>9.1f}s'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=300)
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--port", type=int, default=18769)
+    args = parser.parse_args()
+
+    print(f'{"scenario":<10}{"battles":>10}{"converted":>11}{"bulk actions":>14}{"time":>10}')
+    for offset, scenario in enumerate(["no cache", "cache"]):
+        # a fresh fake cluster for each scenario
+        port = args.port + offset
+        server = start_fake_servers(port, season, pool_size=args.players * 4, battles_per_player=battles_per_player,
+                                    api_latency=args.api_latency, es_latency=0, shared_battles=True)
+        try:
+            print(asyncio.run(run_scenario(scenario, args.players, port)))
+        finally:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Simulates the refresh of a synthetic player base, to compare the FIFO refresh order
+(least recently updated first) with the activity based `RefreshSchedule`, with and without (the default) the battles
+covered through the opponents.
+
+Each player plays battles following a poisson process, with a rate depending on its rank (and many inactive players).
+A share of the battles are against other tracked players (matched by activity): such a battle is listed by both
+players, and only the first refresh of the two captures it. Every hour, the crawler gets a fixed budget of api calls.
+The metric is the number of new battles per api call, along with the share of all the battles played that were
+actually captured (an api call only returns the last 100), and the number of players left without a refresh.
+
+Usage: python -m benchmarks.refresh_scheduler [--players 5000] [--hours 336] [--calls-per-hour 300]
+"""
+import argparse
+import bisect
+import heapq
+import itertools
+import math
+import random
+
+from src.constants import RANK_CHAMPION, RANK_EMPEROR, RANK_LEGEND
+from src.refresh_scheduler import (RefreshSchedule, expected_new_battles, estimate_battle_rate, estimate_coverage,
+                                   max_battles_per_call)
+
+hour = 3600000
+rank_distribution = [(RANK_CHAMPION, 0.6), (RANK_EMPEROR, 0.3), (RANK_LEGEND, 0.1)]
+rank_activity = {RANK_CHAMPION: 0.3, RANK_EMPEROR: 0.5, RANK_LEGEND: 0.9}
+# history already available on the first refresh of a player
+initial_history_hours = 72
+# players not refreshed for this long at the end of the simulation are reported as stale
+stale_hours = 24 * 7
+
+
+class SimulatedPlayer:
+    rank: str
+    true_rate: float
+    # (battle id, tracked opponent or None) of the battles played since the last refresh
+    pending_battles: list[tuple[int, "SimulatedPlayer | None"]]
+    last_update_time: int | None
+    battle_rate: float | None
+    covered_battle_count: int
+    coverage: float | None
+
+    def __init__(self, rng: random.Random):
+        self.rank = rng.choices([rank for rank, _ in rank_distribution],
+                                weights=[weight for _, weight in rank_distribution])[0]
+        # a third of the players stopped playing, the others have a long tailed activity
+        inactive = rng.random() < 0.33
+        self.true_rate = 0 if inactive else rank_activity[self.rank] * rng.lognormvariate(0, 1)
+        self.pending_battles = []
+        self.last_update_time = None
+        self.battle_rate = None
+        self.covered_battle_count = 0
+        self.coverage = None
+
+
+def poisson(rng: random.Random, lam: float) -> int:
+    if lam <= 0:
+        return 0
+    if lam > 30:
+        return max(0, round(rng.gauss(lam, math.sqrt(lam))))
+    threshold = math.exp(-lam)
+    count = 0
+    product = rng.random()
+    while product > threshold:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+class Battles:
+    """
+    Plays the battles of the simulated players, and keeps the ids of the captured ones.
+    """
+    rng: random.Random
+    players: list[SimulatedPlayer]
+    tracked_share: float
+    played: int
+    captured: set[int]
+
+    def __init__(self, rng: random.Random, players: list[SimulatedPlayer], tracked_share: float):
+        self.rng = rng
+        self.players = players
+        self.tracked_share = tracked_share
+        # opponents are matched by activity
+        self.cumulative_rates = list(itertools.accumulate(player.true_rate for player in players))
+        self.battle_ids = itertools.count()
+        self.played = 0
+        self.captured = set()
+
+    def opponent(self, player: SimulatedPlayer) -> SimulatedPlayer | None:
+        if self.rng.random() >= self.tracked_share:
+            return None
+        opponent = self.players[bisect.bisect(self.cumulative_rates, self.rng.random() * self.cumulative_rates[-1])]
+        return opponent if opponent is not player else None
+
+    def play(self, hours: float):
+        for player in self.players:
+            # half of the battles of a tracked player are started by its tracked opponents
+            for _ in range(poisson(self.rng, player.true_rate * hours * (1 - self.tracked_share / 2))):
+                battle_id = next(self.battle_ids)
+                opponent = self.opponent(player)
+                player.pending_battles.append((battle_id, opponent))
+                if opponent is not None:
+                    opponent.pending_battles.append((battle_id, player))
+                self.played += 1
+
+    def refresh(self, player: SimulatedPlayer, now: int) -> int:
+        """
+        Simulates an api call for the player, returns the number of battles captured by this call.
+        """
+        returned = player.pending_battles[-max_battles_per_call:]
+        new_battles = 0
+        for battle_id, opponent in returned:
+            if battle_id in self.captured:
+                continue
+            self.captured.add(battle_id)
+            new_battles += 1
+            if opponent is not None:
+                opponent.covered_battle_count += 1
+
+        window_hours = (now - player.last_update_time) / hour if player.last_update_time else initial_history_hours
+        player.battle_rate = estimate_battle_rate(player.battle_rate, len(returned), window_hours, rank=player.rank)
+        player.coverage = estimate_coverage(player.coverage, player.covered_battle_count, len(returned))
+        player.last_update_time = now
+        player.pending_battles = []
+        player.covered_battle_count = 0
+        return new_battles
+
+
+def fifo_order(players: list[SimulatedPlayer], budget: int, now: int) -> list[SimulatedPlayer]:
+    return heapq.nsmallest(budget, players, key=lambda player: player.last_update_time or 0)
+
+
+def priority_order(schedule: RefreshSchedule):
+    def order(players: list[SimulatedPlayer], budget: int, now: int) -> list[SimulatedPlayer]:
+        def expected(player: SimulatedPlayer):
+            if not schedule.use_coverage:
+                return expected_new_battles(player.battle_rate, player.rank, player.last_update_time, now)
+            return expected_new_battles(player.battle_rate, player.rank, player.last_update_time, now,
+                                        player.covered_battle_count, player.coverage)
+
+        candidates = [player for player in players if expected(player) >= schedule.min_expected_battles]
+        return heapq.nlargest(budget, candidates, key=expected)
+
+    return order
+
+
+def simulate(name: str, order, num_players: int, hours: int, calls_per_hour: int, tracked_share: float, seed: int):
+    rng = random.Random(seed)
+    players = [SimulatedPlayer(rng) for _ in range(num_players)]
+    battles = Battles(rng, players, tracked_share)
+    battles.play(initial_history_hours)
+    calls = 0
+
+    for tick in range(hours):
+        now = tick * hour
+        for player in order(players, calls_per_hour, now):
+            battles.refresh(player, now)
+            calls += 1
+        battles.play(1)
+
+    captured = len(battles.captured)
+    now = hours * hour
+    stale = sum(1 for player in players if now - (player.last_update_time or 0) > stale_hours * hour)
+    print(f'{name}: {calls} api calls, {captured / max(calls, 1):.2f} new battles per call, '
+          f'{captured / max(battles.played, 1):.1%} of the battles captured, {battles.played - captured} missed, '
+          f'{stale} players not refreshed for {stale_hours}h')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--hours", type=int, default=24 * 14)
+    parser.add_argument("--calls-per-hour", type=int, default=300)
+    parser.add_argument("--min-expected-battles", type=float, default=1.0)
+    parser.add_argument("--tracked-share", type=float, default=0.7,
+                        help="share of the battles played against another tracked player")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for name, order in [
+        ("fifo", fifo_order),
+        ("priority", priority_order(RefreshSchedule(min_expected_battles=args.min_expected_battles))),
+        ("priority + coverage",
+         priority_order(RefreshSchedule(min_expected_battles=args.min_expected_battles, use_coverage=True))),
+    ]:
+        simulate(name, order, args.players, args.hours, args.calls_per_hour, args.tracked_share, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Runs `sync_static_lists` against a local static asset server (with ETag and Last-Modified validators), which first
+serves the lists without one of the units of the recorded sample, then releases it.
+
+Checks that:
+- a sync of unchanged lists does not rewrite the repository's static files (same serialization)
+- the next syncs are answered with bodyless 304s, and rewrite nothing
+- once the unit is released, the running converters (inline and process pool) reload the registries and name it,
+  instead of "Unknown"
+
+Usage: python -m benchmarks.static_sync [--syncs 20]
+"""
+import argparse
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from aiohttp import web
+
+from benchmarks.convert_battles import load_sample_battles, root_dir
+from commands import BattleConverter, ProcessPoolBattleConverter
+from commands.sync_static_lists import sync_static_lists
+from rta_api import api as rta_api
+from src import ArtefactRegistry, UnitRegistry
+
+
+class StaticAssetServer:
+    files: dict[str, bytes]
+    full_responses: int
+    not_modified_responses: int
+    bytes_sent: int
+
+    def __init__(self):
+        self.files = {}
+        self.full_responses = 0
+        self.not_modified_responses = 0
+        self.bytes_sent = 0
+        self.last_modified = email.utils.formatdate(usegmt=True)
+
+    def publish(self, path: str, content: dict):
+        self.files[path] = json.dumps(content).encode("utf-8")
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+
+    async def get(self, request: web.Request):
+        content = self.files[request.match_info["path"]]
+        etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified_responses += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        self.full_responses += 1
+        self.bytes_sent += len(content)
+        return web.Response(body=content, content_type="application/json",
+                            headers={"ETag": etag, "Last-Modified": self.last_modified})
+
+
+def hero_list(units: dict) -> dict:
+    return {"en": [{"code": unit["id"], "grade": unit["grade"], "name": unit["name"], "job_cd": unit["role"],
+                    "attribute_cd": unit["element"]} for unit in units.values()]}
+
+
+def artifact_list(artefacts: dict) -> dict:
+    return {"en": [{"code": artefact["id"], "name": artefact["name"]} for artefact in artefacts.values()]}
+
+
+def first_pick_name(converter: BattleConverter, raw_battles) -> str:
+    return converter.convert_inline(raw_battles[:1])[0]["p1_picks"][0]["name"]
+
+
+async def run(syncs: int):
+    with open(os.path.join(root_dir, "data/static/units.json"), "r") as units_file:
+        units = json.load(units_file)
+    with open(os.path.join(root_dir, "data/static/artefacts.json"), "r") as artefacts_file:
+        artefacts = json.load(artefacts_file)
+
+    server = StaticAssetServer()
+    server.publish(rta_api.hero_list_path, hero_list(units))
+    server.publish(rta_api.artifact_list_path, artifact_list(artefacts))
+    app = web.Application()
+    app.router.add_get("/{path:.*}", server.get)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    rta_api.static_assets_url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    directory = tempfile.mkdtemp(prefix="static_sync_")
+    static_directory = os.path.join(directory, "static")
+    state_file_path = os.path.join(directory, "static_lists.json")
+    shutil.copytree(os.path.join(root_dir, "data/static"), static_directory)
+    units_file_path = os.path.join(static_directory, "units.json")
+    artefacts_file_path = os.path.join(static_directory, "artefacts.json")
+    try:
+        assert await sync_static_lists(static_directory, state_file_path) == []
+        print('unchanged lists: no file rewritten')
+
+        start = time.perf_counter()
+        for _ in range(syncs):
+            assert await sync_static_lists(static_directory, state_file_path) == []
+        elapsed = time.perf_counter() - start
+        assert server.not_modified_responses == 2 * syncs
+        print(f'{syncs} conditional syncs: {server.not_modified_responses} not modified responses, '
+              f'{elapsed / syncs * 1000:.1f}ms per sync, {server.bytes_sent} bytes sent in total '
+              f'({len(server.files[rta_api.hero_list_path])} bytes per hero list download)')
+
+        # a unit of the sample battles that is not released yet
+        raw_battles = load_sample_battles()
+        converter = BattleConverter(UnitRegistry(units_file_path), ArtefactRegistry(artefacts_file_path))
+        unit_id = converter.convert_inline(raw_battles[:1])[0]["p1_picks"][0]["id"]
+        released = units.pop(unit_id)
+        server.publish(rta_api.hero_list_path, hero_list(units))
+        assert await sync_static_lists(static_directory, state_file_path) == [units_file_path]
+
+        converter = BattleConverter(UnitRegistry(units_file_path), ArtefactRegistry(artefacts_file_path),
+                                    reload_interval=0)
+        pool_converter = ProcessPoolBattleConverter(
+            UnitRegistry(units_file_path), ArtefactRegistry(artefacts_file_path), units_file_path, artefacts_file_path,
+            num_processes=1, min_batch_size=0, reload_interval=0)
+        try:
+            assert first_pick_name(converter, raw_battles) == "Unknown"
+            assert (await pool_converter.convert(raw_battles[:1]))[0]["p1_picks"][0]["name"] == "Unknown"
+
+            units[unit_id] = released
+            server.publish(rta_api.hero_list_path, hero_list(units))
+            assert await sync_static_lists(static_directory, state_file_path) == [units_file_path]
+            assert first_pick_name(converter, raw_battles) == released["name"]
+            assert (await pool_converter.convert(raw_battles[:1]))[0]["p1_picks"][0]["name"] == released["name"]
+        finally:
+            pool_converter.close()
+        print(f'release of {released["name"]}: reloaded by the inline and process pool converters')
+    finally:
+        shutil.rmtree(directory)
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--syncs", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.syncs))
+
+
+if __name__ == "__main__":
+    main()
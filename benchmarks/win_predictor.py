@@ -0,0 +1,100 @@
+"""
+Trains the `WinPredictor` on synthetic battles drawn from a hidden logistic model over the unit list (unit strengths,
+a first pick advantage and some artifact strengths), checks that it recovers the model, and measures the number of
+drafts scored per second, with and without the encoding.
+
+Usage: python -m benchmarks.win_predictor [--battles 100000] [--batch 10000]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from src import ArtefactRegistry, UnitRegistry
+from src.win_predictor import WinPredictor, draft_from_battle, grades
+
+
+def synthetic_battles(unit_ids: list[str], artifact_ids: list[str], count: int,
+                      seed: int) -> tuple[list[dict], np.ndarray]:
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    unit_strength = dict(zip(unit_ids, np_rng.normal(0, 0.3, len(unit_ids))))
+    artifact_strength = dict(zip(artifact_ids, np_rng.normal(0, 0.1, len(artifact_ids))))
+    first_pick_advantage = 0.1
+
+    battles = []
+    true_probabilities = []
+    for _ in range(count):
+        units = rng.sample(unit_ids, 14)
+        p1_picks, p2_picks = units[0:5], units[5:10]
+        p1_postban, p2_postban = rng.choice(p1_picks), rng.choice(p2_picks)
+        artifacts = rng.sample(artifact_ids, 10)
+        logit = first_pick_advantage
+        logit += sum(unit_strength[unit_id] for unit_id in p1_picks if unit_id != p1_postban)
+        logit -= sum(unit_strength[unit_id] for unit_id in p2_picks if unit_id != p2_postban)
+        logit += sum(artifact_strength[artifact_id] for artifact_id in artifacts[:5])
+        logit -= sum(artifact_strength[artifact_id] for artifact_id in artifacts[5:])
+        probability = 1 / (1 + np.exp(-logit))
+        true_probabilities.append(probability)
+
+        battles.append({
+            "p1_win": rng.random() < probability,
+            "p1_grade": rng.choice(grades),
+            "p2_grade": rng.choice(grades),
+            "p1_picks": [{"id": unit_id} for unit_id in p1_picks],
+            "p2_picks": [{"id": unit_id} for unit_id in p2_picks],
+            "p1_prebans": [{"id": unit_id} for unit_id in units[10:12]],
+            "p2_prebans": [{"id": unit_id} for unit_id in units[12:14]],
+            "p1_postban": {"id": p1_postban},
+            "p2_postban": {"id": p2_postban},
+            "units_details": [{"id": unit_id, "artifact_id": artifact_id}
+                              for unit_id, artifact_id in zip(p1_picks + p2_picks, artifacts)],
+        })
+    return battles, np.array(true_probabilities)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--battles", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=10000)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    unit_ids = list(UnitRegistry(filepath="data/static/units.json").ids)
+    artifact_ids = list(ArtefactRegistry(filepath="data/static/artefacts.json").ids)
+    battles, true_probabilities = synthetic_battles(unit_ids, artifact_ids, args.battles, args.seed)
+    drafts = [draft_from_battle(battle) for battle in battles]
+    labels = np.array([battle["p1_win"] for battle in battles], dtype=np.float32)
+    split = round(len(drafts) * 0.9)
+
+    predictor = WinPredictor(unit_ids, artifact_ids)
+    start = time.perf_counter()
+    losses = predictor.train(drafts[:split], labels[:split], epochs=args.epochs)
+    print(f'training: {split} battles x {args.epochs} epochs in {time.perf_counter() - start:.1f}s, '
+          f'final loss {losses[-1]:.4f}')
+
+    evaluation = predictor.evaluate(drafts[split:], labels[split:])
+    predicted = predictor.predict(drafts[split:])
+    best_accuracy = float(((true_probabilities[split:] >= 0.5) == (labels[split:] == 1)).mean())
+    correlation = float(np.corrcoef(predicted, true_probabilities[split:])[0, 1])
+    print(f'holdout: log loss {evaluation["log_loss"]:.4f}, accuracy {evaluation["accuracy"]:.1%} '
+          f'(hidden model {best_accuracy:.1%}), correlation with the hidden probabilities {correlation:.3f}')
+
+    batch = drafts[:args.batch]
+    indexes, signs = predictor.encode(batch)
+    for name, score in [("encode + predict", lambda: predictor.predict(batch)),
+                        ("predict encoded", lambda: predictor.predict_encoded(indexes, signs))]:
+        score()
+        runs = []
+        for _ in range(5):
+            start = time.perf_counter()
+            score()
+            runs.append(time.perf_counter() - start)
+        best = min(runs)
+        print(f'{name}: {len(batch)} drafts in {best * 1000:.1f}ms ({len(batch) / best:.0f} drafts/s)')
+
+
+if __name__ == "__main__":
+    main()
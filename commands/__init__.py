@@ -1,3 +1,11 @@
 from .fetch_player_list import fetch_player_list
 from .sync_player_battles import sync_players_battles
 from .sync_static_lists import sync_static_lists
+from .battle_converter import BattleConverter, ProcessPoolBattleConverter
+from .aggregate_draft_stats import aggregate_draft_stats
+from .train_win_predictor import train_win_predictor
+from .export_battles import export_battles
+from .backfill_names import backfill_unknown_names
+from .detect_season import detect_current_season
+from .crawl import crawl
+from .reindex_battles import reindex_battles
@@ -0,0 +1,35 @@
+from src import Indexer
+from src.draft_stats import DraftStats, battle_source_fields
+
+minute = 60 * 1000
+
+
+async def aggregate_draft_stats(indexer: Indexer,
+                                season: str,
+                                stats: DraftStats,
+                                lookback_minutes: float = 10,
+                                batch_size: int = 5000) -> int:
+    """
+    Aggregates the battles indexed since the previous run into the stats, returns the number of new battles.
+
+    Battles are scanned by indexing time, so the old battles of rarely refreshed or newly discovered players are
+    aggregated too. The scan starts `lookback_minutes` before the most recent indexing time already scanned: battles
+    only become visible at the next refresh of the index, possibly after more recently indexed ones. The battles seen
+    before are skipped by the stats themselves. Stats without a watermark yet are completed by a full scan.
+    """
+    since = stats.last_indexed_at - round(lookback_minutes * minute) if stats.last_indexed_at > 0 else None
+    added = 0
+    scanned = 0
+    batch = []
+    async for battle in indexer.iter_battles(season, indexed_since=since, source=battle_source_fields):
+        batch.append(battle)
+        if len(batch) >= batch_size:
+            added += stats.add_battles(batch)
+            scanned += len(batch)
+            batch = []
+            print(f'scanned {scanned} battles, {added} new')
+    added += stats.add_battles(batch)
+    scanned += len(batch)
+
+    print(f'aggregated {added} new battles ({scanned} scanned), {stats.battle_count} battles in total')
+    return added
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from src import Indexer, UnitRegistry, ArtefactRegistry
+from src.constants import UNKNOWN_NAME
+from src.crawl_state import CrawlState
+from src.model import character_fields
+
+checkpoint_key = "checkpoint"
+
+
+async def backfill_unknown_names(indexer: Indexer,
+                                 season: str,
+                                 unit_registry: UnitRegistry,
+                                 artefact_registry: ArtefactRegistry,
+                                 crawl_state: CrawlState | None = None,
+                                 batch_size: int = 500,
+                                 max_updates_per_second: float = 500) -> int:
+    """
+    Names the units and artifacts of the indexed battles that were missing from the registries when the battles were
+    converted, from the current registries: only the affected battles are scanned, and only their fixed fields are
+    updated, so neither the game api nor the rest of the season is touched. Returns the number of updated battles.
+
+    Updates are sent in batches, spread to at most `max_updates_per_second` so the cluster keeps up with the running
+    syncs. When a `crawl_state` is provided, the last battle id of each batch is checkpointed in it, and an
+    interrupted run resumes after it. The checkpoint is cleared once the scan completes.
+    """
+    checkpoint = crawl_state.result(checkpoint_key) if crawl_state is not None else None
+    after_battle_id = checkpoint["after_battle_id"] if checkpoint is not None else None
+    scanned = checkpoint["scanned"] if checkpoint is not None else 0
+    updated = checkpoint["updated"] if checkpoint is not None else 0
+    if after_battle_id is not None:
+        print(f'resuming previous run after battle {after_battle_id}: {scanned} scanned, {updated} updated')
+    failed = 0
+    unresolved: dict[str, int] = {}
+
+    async def update(batch: list[dict]):
+        nonlocal scanned, updated, failed
+        start = time.monotonic()
+        updates = []
+        for battle in batch:
+            fields = resolve_unknown_names(battle, unit_registry, artefact_registry, unresolved)
+            if len(fields) > 0:
+                updates.append((battle["battle_id"], fields))
+        results = await indexer.update_battles(updates, season)
+        updated += results.count(True)
+        failed += results.count(False)
+        scanned += len(batch)
+        if crawl_state is not None:
+            crawl_state.add_result(checkpoint_key, {
+                "after_battle_id": batch[-1]["battle_id"],
+                "scanned": scanned,
+                "updated": updated,
+            })
+        print(f'scanned {scanned} battles, {updated} updated')
+
+        # throttling
+        if max_updates_per_second > 0:
+            delay = len(updates) / max_updates_per_second - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    batch = []
+    async for battle in indexer.iter_battles_with_unknown_names(season, after_battle_id=after_battle_id,
+                                                                page_size=batch_size):
+        batch.append(battle)
+        if len(batch) >= batch_size:
+            await update(batch)
+            batch = []
+    if len(batch) > 0:
+        await update(batch)
+
+    if crawl_state is not None:
+        crawl_state.clear()
+    print(f'backfill done: {scanned} battles with unknown names scanned, {updated} updated')
+    if failed > 0:
+        # the failed battles still match the scan, a new run retries them
+        print(f'{failed} updates failed')
+    if len(unresolved) > 0:
+        missing = sorted(unresolved.items(), key=lambda item: -item[1])
+        print(f'still missing from the registries: {", ".join(f"{id_} ({count})" for id_, count in missing[:20])}')
+    return updated
+
+
+def resolve_unknown_names(battle: dict,
+                          unit_registry: UnitRegistry,
+                          artefact_registry: ArtefactRegistry,
+                          unresolved: dict[str, int] | None = None) -> dict:
+    """
+    The fields of a battle holding names that can now be resolved, with these names fixed.
+    The ids that are still unknown are counted in `unresolved`.
+    """
+    unresolved = unresolved if unresolved is not None else {}
+
+    def resolve(item_id: str, name: str | None, registry: UnitRegistry | ArtefactRegistry) -> str | None:
+        # an empty id is no artifact equipped
+        if (name is not None and name != UNKNOWN_NAME) or not item_id:
+            return None
+        resolved = registry.name_from_id(item_id)
+        if resolved is None:
+            unresolved[item_id] = unresolved.get(item_id, 0) + 1
+        return resolved
+
+    fields = {}
+    for field in character_fields:
+        value = battle.get(field)
+        if value is None:
+            continue
+        units = value if isinstance(value, list) else [value]
+        names = [resolve(unit["id"], unit["name"], unit_registry) for unit in units]
+        if any(name is not None for name in names):
+            fixed = [unit if name is None else {**unit, "name": name} for unit, name in zip(units, names)]
+            fields[field] = fixed if isinstance(value, list) else fixed[0]
+
+    # the details are a nested field, they are replaced as a whole
+    details = battle.get("units_details") or []
+    fixed_details = []
+    for detail in details:
+        name = resolve(detail["id"], detail.get("name"), unit_registry)
+        artifact_name = resolve(detail["artifact_id"], detail["artifact_name"], artefact_registry)
+        if name is not None:
+            detail = {**detail, "name": name}
+        if artifact_name is not None:
+            detail = {**detail, "artifact_name": artifact_name}
+        fixed_details.append(detail)
+    if any(fixed is not detail for fixed, detail in zip(fixed_details, details)):
+        fields["units_details"] = fixed_details
+    return fields
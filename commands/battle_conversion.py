@@ -0,0 +1,280 @@
+import json
+import math
+from datetime import datetime
+import pydantic
+
+from rta_api.model.get_battle_list import GetBattleListResponseBattleListItem
+from src import UnitRegistry, ArtefactRegistry
+from src.constants import UNKNOWN_NAME
+from src.model import RtaBattle
+
+raw_date_format = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def convert_raw_battle(raw: GetBattleListResponseBattleListItem,
+                       unit_registry: UnitRegistry,
+                       artefact_registry: ArtefactRegistry) -> 'RtaBattle':
+    def unit_from_id(unit_id: str | None):
+        if unit_id is None:
+            return None
+        unit_name = unit_registry.name_from_id(unit_id)
+        return {
+            "id": unit_id,
+            "name": unit_name or UNKNOWN_NAME,
+        }
+
+    def units_from_ids(unit_ids: list[str]):
+        return list(map(unit_from_id, unit_ids))
+
+    p1_postban = next((char for char in raw.my_deck.hero_list if char.ban == 1), None)
+    p2_postban = next((char for char in raw.enemy_deck.hero_list if char.ban == 1), None)
+
+    p1_first_pick = next((char for char in raw.my_deck.hero_list if char.first_pick == 1), None)
+
+    p1_team_battle_info = json.loads("{" + raw.teamBettleInfo + "}")
+    p1_team_info = p1_team_battle_info["my_team"]
+    p1_team_info.sort(key=lambda x: x["pick_order"], reverse=False)
+    p1_pick_order = list(map(lambda s: s["hero_code"], p1_team_info))
+
+    p2_team_battle_info = json.loads("{" + raw.teamBettleInfoenemy + "}")
+    p2_team_info = p2_team_battle_info["my_team"]
+    p2_team_info.sort(key=lambda x: x["pick_order"], reverse=False)
+    p2_pick_order = list(map(lambda s: s["hero_code"], p2_team_info))
+
+    p1_postban_position = p1_pick_order.index(p1_postban.hero_code) + 1 if p1_postban else None
+    p2_postban_position = p2_pick_order.index(p2_postban.hero_code) + 1 if p2_postban else None
+
+    battle_date = math.floor(datetime.strptime(raw.battle_day, raw_date_format).timestamp() * 1000)
+
+    battle: dict = {
+        "schema_version": 1,
+
+        "battle_id": int(raw.battle_seq),
+        "season_code": raw.season_code,
+        "turn_count": raw.turn,
+        "battle_date": battle_date,
+    }
+
+    reverse_players = p1_first_pick is None
+    p1_prefix = 'p2' if reverse_players else 'p1'
+    p2_prefix = 'p1' if reverse_players else 'p2'
+
+    battle.update({
+        f'{p1_prefix}_id': raw.nicknameno,
+        f'{p1_prefix}_world': raw.worldCode,
+        f'{p1_prefix}_grade': raw.grade_code,
+        f'{p1_prefix}_win': raw.iswin == 1,
+        f'{p1_prefix}_first_pick': p1_first_pick is not None,
+
+        f'{p2_prefix}_id': raw.matchPlayerNicknameno,
+        f'{p2_prefix}_world': raw.enemy_world_code,
+        f'{p2_prefix}_grade': raw.enemy_grade_code,
+        f'{p2_prefix}_win': raw.iswin == 2,
+        f'{p2_prefix}_first_pick': p1_first_pick is None,
+    })
+
+    all_prebans = list(set(raw.my_deck.preban_list + raw.enemy_deck.preban_list))
+    battle["prebans"] = units_from_ids(all_prebans)
+
+    battle.update({
+        f'{p1_prefix}_prebans': units_from_ids(raw.my_deck.preban_list),
+        f'{p1_prefix}_postban': unit_from_id(p1_postban.hero_code) if p1_postban is not None else None,
+        f'{p1_prefix}_postban_position': p1_postban_position,
+
+        f'{p2_prefix}_prebans': units_from_ids(raw.enemy_deck.preban_list),
+        f'{p2_prefix}_postban': unit_from_id(p2_postban.hero_code) if p2_postban is not None else None,
+        f'{p2_prefix}_postban_position': p2_postban_position,
+    })
+
+    battle[f'{p1_prefix}_picks'] = units_from_ids(p1_pick_order)
+    battle[f'{p2_prefix}_picks'] = units_from_ids(p2_pick_order)
+
+    # p1_pick1 -> p1_pick5
+    for n in range(0, 5):
+        pick_id = p1_pick_order[n] if len(p1_pick_order) > n else None
+        battle[f'{p1_prefix}_pick{n + 1}'] = unit_from_id(pick_id)
+
+    # p2_pick1 -> p2_pick5
+    for n in range(0, 5):
+        pick_id = p2_pick_order[n] if len(p2_pick_order) > n else None
+        battle[f'{p2_prefix}_pick{n + 1}'] = unit_from_id(pick_id)
+
+    p1_picks = units_from_ids(p2_pick_order if reverse_players else p1_pick_order)
+    p2_picks = units_from_ids(p1_pick_order if reverse_players else p2_pick_order)
+
+    battle["p1_picks_stage1"] = p1_picks[0:1]
+    battle["p1_picks_stage2"] = p1_picks[1:3]
+    battle["p1_picks_stage3"] = p1_picks[3:5]
+
+    battle["p2_picks_stage1"] = p2_picks[0:2]
+    battle["p2_picks_stage2"] = p2_picks[2:4]
+    battle["p2_picks_stage3"] = p2_picks[4:5]
+
+    parsed_p1_team_info = TeamBattleInfo(**p1_team_battle_info)
+    parsed_p2_team_info = TeamBattleInfo(**p2_team_battle_info)
+    all_unit_details = parsed_p1_team_info.my_team + parsed_p2_team_info.my_team
+
+    def map_unit_details(raw: TeamBattleInfoDetails):
+        return {
+            "id": raw.hero_code,
+            "name": unit_registry.name_from_id(raw.hero_code),
+            "pick_order": raw.pick_order,
+            "equipped_sets": raw.equip,
+            "artifact_id": raw.artifact,
+            "artifact_name": artefact_registry.name_from_id(raw.artifact) or UNKNOWN_NAME,
+            "mvp": raw.mvp == 1,
+            "position": raw.position,
+            "role": raw.job_cd,
+        }
+
+    battle["units_details"] = list(map(map_unit_details, all_unit_details))
+
+    initial_cr_position = json.loads("{" + raw.energyGauge + "}")["energy_gauge"]
+    battle["initial_cr_position"] = initial_cr_position
+
+    return RtaBattle(**battle)
+
+
+def convert_raw_battle_source(raw: GetBattleListResponseBattleListItem,
+                              unit_registry: UnitRegistry,
+                              artefact_registry: ArtefactRegistry) -> 'dict':
+    """
+    Fast path of `convert_raw_battle`: directly produces the battle document's `_source`,
+    (same output as `convert_raw_battle(...).model_dump()`) without going through the pydantic models.
+    """
+    units: dict[str, dict] = {}
+
+    def unit_from_id(unit_id: str | None):
+        if unit_id is None:
+            return None
+        unit = units.get(unit_id)
+        if unit is None:
+            unit = {
+                "id": unit_id,
+                "name": unit_registry.name_from_id(unit_id) or UNKNOWN_NAME,
+            }
+            units[unit_id] = unit
+        return unit
+
+    def units_from_ids(unit_ids: list[str]):
+        return [unit_from_id(unit_id) for unit_id in unit_ids]
+
+    p1_postban = None
+    p1_first_pick = None
+    for char in raw.my_deck.hero_list:
+        if char.ban == 1 and p1_postban is None:
+            p1_postban = char
+        if char.first_pick == 1 and p1_first_pick is None:
+            p1_first_pick = char
+    p2_postban = next((char for char in raw.enemy_deck.hero_list if char.ban == 1), None)
+
+    p1_team_info = json.loads("{" + raw.teamBettleInfo + "}")["my_team"]
+    p1_team_info.sort(key=lambda x: x["pick_order"])
+    p1_pick_order = [s["hero_code"] for s in p1_team_info]
+
+    p2_team_info = json.loads("{" + raw.teamBettleInfoenemy + "}")["my_team"]
+    p2_team_info.sort(key=lambda x: x["pick_order"])
+    p2_pick_order = [s["hero_code"] for s in p2_team_info]
+
+    p1_postban_position = p1_pick_order.index(p1_postban.hero_code) + 1 if p1_postban else None
+    p2_postban_position = p2_pick_order.index(p2_postban.hero_code) + 1 if p2_postban else None
+
+    reverse_players = p1_first_pick is None
+    p1_prefix = 'p2' if reverse_players else 'p1'
+    p2_prefix = 'p1' if reverse_players else 'p2'
+
+    battle: dict = {
+        "schema_version": 1,
+
+        "battle_id": int(raw.battle_seq),
+        "season_code": raw.season_code,
+        "turn_count": raw.turn,
+        "battle_date": parse_battle_date(raw.battle_day),
+
+        f'{p1_prefix}_id': raw.nicknameno,
+        f'{p1_prefix}_world': raw.worldCode,
+        f'{p1_prefix}_grade': raw.grade_code,
+        f'{p1_prefix}_win': raw.iswin == 1,
+        f'{p1_prefix}_first_pick': p1_first_pick is not None,
+
+        f'{p2_prefix}_id': raw.matchPlayerNicknameno,
+        f'{p2_prefix}_world': raw.enemy_world_code,
+        f'{p2_prefix}_grade': raw.enemy_grade_code,
+        f'{p2_prefix}_win': raw.iswin == 2,
+        f'{p2_prefix}_first_pick': p1_first_pick is None,
+
+        "prebans": units_from_ids(list(set(raw.my_deck.preban_list + raw.enemy_deck.preban_list))),
+
+        f'{p1_prefix}_prebans': units_from_ids(raw.my_deck.preban_list),
+        f'{p1_prefix}_postban': unit_from_id(p1_postban.hero_code) if p1_postban is not None else None,
+        f'{p1_prefix}_postban_position': p1_postban_position,
+
+        f'{p2_prefix}_prebans': units_from_ids(raw.enemy_deck.preban_list),
+        f'{p2_prefix}_postban': unit_from_id(p2_postban.hero_code) if p2_postban is not None else None,
+        f'{p2_prefix}_postban_position': p2_postban_position,
+    }
+
+    p1_picks = units_from_ids(p1_pick_order)
+    p2_picks = units_from_ids(p2_pick_order)
+    battle[f'{p1_prefix}_picks'] = p1_picks
+    battle[f'{p2_prefix}_picks'] = p2_picks
+
+    for n in range(0, 5):
+        battle[f'{p1_prefix}_pick{n + 1}'] = p1_picks[n] if len(p1_picks) > n else None
+        battle[f'{p2_prefix}_pick{n + 1}'] = p2_picks[n] if len(p2_picks) > n else None
+
+    first_picker_picks = p2_picks if reverse_players else p1_picks
+    second_picker_picks = p1_picks if reverse_players else p2_picks
+
+    battle["p1_picks_stage1"] = first_picker_picks[0:1]
+    battle["p1_picks_stage2"] = first_picker_picks[1:3]
+    battle["p1_picks_stage3"] = first_picker_picks[3:5]
+
+    battle["p2_picks_stage1"] = second_picker_picks[0:2]
+    battle["p2_picks_stage2"] = second_picker_picks[2:4]
+    battle["p2_picks_stage3"] = second_picker_picks[4:5]
+
+    battle["units_details"] = [
+        {
+            "id": details["hero_code"],
+            "name": unit_registry.name_from_id(details["hero_code"]),
+            "pick_order": details["pick_order"],
+            "equipped_sets": details["equip"],
+            "artifact_id": details["artifact"],
+            "artifact_name": artefact_registry.name_from_id(details["artifact"]) or UNKNOWN_NAME,
+            "mvp": details["mvp"] == 1,
+            "position": details["position"],
+            "role": details["job_cd"],
+        }
+        for details in p1_team_info + p2_team_info
+    ]
+
+    battle["initial_cr_position"] = json.loads("{" + raw.energyGauge + "}")["energy_gauge"]
+
+    return battle
+
+
+def parse_battle_date(battle_day: str) -> int:
+    try:
+        # much faster than strptime, but only accepts the short fractional part since python 3.11
+        parsed = datetime.fromisoformat(battle_day)
+    except ValueError:
+        parsed = datetime.strptime(battle_day, raw_date_format)
+    return math.floor(parsed.timestamp() * 1000)
+
+
+class TeamBattleInfoDetails(pydantic.BaseModel):
+    pick_order: int
+    hero_code: str
+    artifact: str
+    equip: list[str]
+    mvp: int  # 0 / 1
+    kill_count: int
+    position: int
+    attack_damage: float
+    receive_damage: float
+    job_cd: str
+
+
+class TeamBattleInfo(pydantic.BaseModel):
+    my_team: list[TeamBattleInfoDetails]
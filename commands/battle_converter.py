@@ -0,0 +1,112 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from rta_api.model.get_battle_list import GetBattleListResponseBattleListItem
+from src import UnitRegistry, ArtefactRegistry
+from .battle_conversion import convert_raw_battle_source
+
+
+class BattleConverter:
+    """
+    Converts raw battles to battle documents on the event loop thread.
+
+    The registries are reloaded when their static files change (checked at most every `reload_interval` seconds),
+    so the units and artifacts of a new release get their names without restarting a long-running sync.
+    """
+    unit_registry: UnitRegistry
+    artefact_registry: ArtefactRegistry
+    reload_interval: float
+
+    def __init__(self, unit_registry: UnitRegistry, artefact_registry: ArtefactRegistry, reload_interval: float = 10):
+        self.unit_registry = unit_registry
+        self.artefact_registry = artefact_registry
+        self.reload_interval = reload_interval
+        self.__next_reload_check = time.monotonic() + reload_interval
+
+    async def convert(self, raw_battles: list[GetBattleListResponseBattleListItem]) -> list[dict]:
+        return self.convert_inline(raw_battles)
+
+    def convert_inline(self, raw_battles: list[GetBattleListResponseBattleListItem]) -> list[dict]:
+        if time.monotonic() >= self.__next_reload_check:
+            self.reload_registries()
+        return [convert_raw_battle_source(raw, self.unit_registry, self.artefact_registry) for raw in raw_battles]
+
+    def reload_registries(self):
+        self.__next_reload_check = time.monotonic() + self.reload_interval
+        self.unit_registry, self.artefact_registry = _reloaded(self.unit_registry, self.artefact_registry)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolBattleConverter(BattleConverter):
+    """
+    Converts raw battles in a pool of processes, so the conversion can use all the cores while the event loop
+    keeps fetching. Each process loads its own registries from the static files, and reloads them when they change.
+
+    Small batches are still converted inline, as they are cheaper to convert than to send to another process.
+    """
+    min_batch_size: int
+
+    def __init__(self,
+                 unit_registry: UnitRegistry,
+                 artefact_registry: ArtefactRegistry,
+                 units_file_path: str,
+                 artefacts_file_path: str,
+                 num_processes: int,
+                 min_batch_size: int = 10,
+                 reload_interval: float = 10):
+        super().__init__(unit_registry, artefact_registry, reload_interval)
+        self.min_batch_size = min_batch_size
+        self.__executor = ProcessPoolExecutor(
+            max_workers=num_processes,
+            initializer=_init_process,
+            initargs=(units_file_path, artefacts_file_path, reload_interval),
+        )
+
+    async def convert(self, raw_battles: list[GetBattleListResponseBattleListItem]) -> list[dict]:
+        if len(raw_battles) < self.min_batch_size:
+            return self.convert_inline(raw_battles)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, _convert_batch, raw_battles)
+
+    def close(self):
+        self.__executor.shutdown()
+
+
+def _reloaded(unit_registry: UnitRegistry,
+              artefact_registry: ArtefactRegistry) -> tuple[UnitRegistry, ArtefactRegistry]:
+    try:
+        reloaded = unit_registry.reloaded(), artefact_registry.reloaded()
+    except (OSError, ValueError) as e:
+        # keep converting with the previous registries, the next check retries
+        print(f'failed to reload the registries: {e}')
+        return unit_registry, artefact_registry
+    if reloaded[0] is not unit_registry or reloaded[1] is not artefact_registry:
+        print(f'reloaded the registries: {len(reloaded[0])} units, {len(reloaded[1])} artifacts')
+    return reloaded
+
+
+# registries of the current pool process, loaded by `_init_process`, then reloaded when their files change
+_process_unit_registry: UnitRegistry | None = None
+_process_artefact_registry: ArtefactRegistry | None = None
+_process_reload_interval: float = 10
+_process_next_reload_check: float = 0
+
+
+def _init_process(units_file_path: str, artefacts_file_path: str, reload_interval: float):
+    global _process_unit_registry, _process_artefact_registry, _process_reload_interval, _process_next_reload_check
+    _process_unit_registry = UnitRegistry(filepath=units_file_path)
+    _process_artefact_registry = ArtefactRegistry(filepath=artefacts_file_path)
+    _process_reload_interval = reload_interval
+    _process_next_reload_check = time.monotonic() + reload_interval
+
+
+def _convert_batch(raw_battles: list[GetBattleListResponseBattleListItem]) -> list[dict]:
+    global _process_unit_registry, _process_artefact_registry, _process_next_reload_check
+    if time.monotonic() >= _process_next_reload_check:
+        _process_next_reload_check = time.monotonic() + _process_reload_interval
+        _process_unit_registry, _process_artefact_registry = _reloaded(_process_unit_registry,
+                                                                       _process_artefact_registry)
+    return [convert_raw_battle_source(raw, _process_unit_registry, _process_artefact_registry) for raw in raw_battles]
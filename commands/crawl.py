@@ -0,0 +1,102 @@
+from typing import AsyncIterable, AsyncIterator
+
+import aiohttp
+
+from rta_api import api as rta_api, create_session
+from src import Indexer, UnitRegistry, ArtefactRegistry, KnownPlayers
+from src.constants import RANK_LEGEND
+from src.crawl_state import CrawlState
+from src.metrics import errors, players_discovered
+from src.model import RtaPlayer
+from src.recent_battles import RecentBattles
+from .battle_converter import BattleConverter
+from .sync_player_battles import insert_discovered_players, sync_players_battles
+
+
+async def crawl(indexer: Indexer,
+                unit_registry: UnitRegistry,
+                artefact_registry: ArtefactRegistry,
+                season: str,
+                players_to_refresh: AsyncIterable[RtaPlayer],
+                known_players: KnownPlayers,
+                max_discovered_players: int = 1000,
+                recommend_count: int = 5,
+                num_worker: int = 10,
+                crawl_state: CrawlState | None = None,
+                converter: BattleConverter | None = None,
+                recent_battles: RecentBattles | None = None):
+    """
+    Single pass crawl: each `getBattleList` response is used at once to index the player's new battles, update the
+    player, and discover its opponents, which are synced in turn (up to `max_discovered_players`).
+
+    The frontier is seeded with the new players recommended by the game api, then the known `players_to_refresh`.
+    This replaces a `fetch-users` run followed by a `sync-battles` run, where the battle lists of the discovered
+    players were fetched twice.
+    """
+    # the recommended lists and the workers share the same connection pool
+    async with create_session() as session:
+        async def players_to_sync() -> AsyncIterator[RtaPlayer]:
+            async for player in recommended_players(session, indexer, season, known_players, recommend_count):
+                yield player
+            async for player in players_to_refresh:
+                yield player
+
+        await sync_players_battles(
+            indexer=indexer,
+            unit_registry=unit_registry,
+            artefact_registry=artefact_registry,
+            players_to_sync=players_to_sync(),
+            known_players=known_players,
+            season=season,
+            sync_discovered_players=True,
+            num_worker=num_worker,
+            crawl_state=crawl_state,
+            converter=converter,
+            max_discovered_players=max_discovered_players,
+            recent_battles=recent_battles,
+            session=session,
+        )
+
+
+async def recommended_players(session: aiohttp.ClientSession,
+                              indexer: Indexer,
+                              season: str,
+                              known_players: KnownPlayers,
+                              recommend_count: int) -> AsyncIterator[RtaPlayer]:
+    """
+    Streams (and inserts) the players of `recommend_count` recommended lists that are not known yet:
+    the known ones are refreshed with their watermark instead. A list that cannot be fetched is skipped.
+    """
+    for _ in range(recommend_count):
+        # the lists differ between calls
+        try:
+            response = await rta_api.get_recommended_list(session)
+        except Exception as e:
+            # the api layer already retried transient errors, so we just skip this list
+            print(f'error fetching a recommended list: {type(e).__name__} {e}')
+            errors.inc(command="crawl", type=type(e).__name__)
+            continue
+        new_players = [
+            RtaPlayer(
+                user_id=player.nick_no,
+                user_world=player.world_code,
+                user_name=player.nickname,
+                last_known_rank=RANK_LEGEND,
+            )
+            for player in response.recommend_list
+            if player.seasonCode == season and known_players.add(player.nick_no, player.world_code)
+        ]
+        inserted_players = await insert_discovered_players(indexer, [
+            {
+                "id": player.user_id,
+                "name": player.user_name,
+                "world": player.user_world,
+                "rank": player.last_known_rank,
+            }
+            for player in new_players
+        ], season, known_players)
+        inserted = {(player["id"], player["world"]) for player in inserted_players}
+        new_players = [player for player in new_players if (player.user_id, player.user_world) in inserted]
+        players_discovered.inc(len(new_players), command="crawl")
+        for player in new_players:
+            yield player
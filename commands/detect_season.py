@@ -0,0 +1,16 @@
+from collections import Counter
+
+from rta_api import get_recommended_list, create_session
+
+
+async def detect_current_season() -> str:
+    """
+    The season of the players recommended by the game api: the most common one, in case the list straddles
+    a season change.
+    """
+    async with create_session() as session:
+        response = await get_recommended_list(session)
+    seasons = Counter(player.seasonCode for player in response.recommend_list)
+    if len(seasons) == 0:
+        raise RuntimeError("no recommended player to detect the current season from")
+    return seasons.most_common(1)[0][0]
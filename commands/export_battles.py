@@ -0,0 +1,34 @@
+from src import Indexer
+from src.battle_store import BattleStore, battle_source_fields
+
+minute = 60 * 1000
+
+
+async def export_battles(indexer: Indexer,
+                         season: str,
+                         store: BattleStore,
+                         lookback_minutes: float = 10,
+                         batch_size: int = 5000) -> int:
+    """
+    Appends the battles indexed since the previous export to the store, returns the number of new battles.
+
+    As for the draft stats, battles are scanned by indexing time, from `lookback_minutes` before the most recent
+    indexing time already exported, and the ones already stored are skipped.
+    """
+    since = store.last_indexed_at - round(lookback_minutes * minute) if store.last_indexed_at > 0 else None
+    added = 0
+    scanned = 0
+    batch = []
+    source = [*battle_source_fields, "indexed_at"]
+    async for battle in indexer.iter_battles(season, indexed_since=since, source=source):
+        batch.append(battle)
+        if len(batch) >= batch_size:
+            added += store.append(batch)
+            scanned += len(batch)
+            batch = []
+            print(f'scanned {scanned} battles, {added} new')
+    added += store.append(batch)
+    scanned += len(batch)
+
+    print(f'exported {added} new battles ({scanned} scanned), {len(store)} battles in the store')
+    return added
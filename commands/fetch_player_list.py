@@ -1,11 +1,13 @@
 import asyncio
 import aiohttp
-import json
 from typing import TypedDict
-from rta_api import api as rta_api
-from src import Indexer
+from rta_api import api as rta_api, create_session, call_stats
+from src import Indexer, KnownPlayers
 from src.constants import ALLOWED_PLAYER_RANKS, RANK_LEGEND
+from src.crawl_state import CrawlState
+from src.metrics import errors, players_discovered, queue_depth, tasks_processed
 from src.utils import get_user_uuid
+from .sync_player_battles import insert_discovered_players
 
 
 class UserInfo(TypedDict):
@@ -16,9 +18,13 @@ class UserInfo(TypedDict):
 
 
 async def worker(name: str,
+                 session: aiohttp.ClientSession,
                  queue: asyncio.Queue,
                  season: str,
-                 user_dict: dict[str, UserInfo],
+                 visited_players: KnownPlayers,
+                 known_players: KnownPlayers,
+                 discovered_players: list[UserInfo],
+                 crawl_state: CrawlState | None,
                  max_count: int):
     async def enqueue_user_if_needed(
             user_id: int,
@@ -27,35 +33,47 @@ async def worker(name: str,
             current_rank: str,
             match_season: str,
     ):
-        player_uuid = get_user_uuid(user_id, world_code)
         if current_rank not in ALLOWED_PLAYER_RANKS or match_season != season:
             return
-        if user_dict.get(player_uuid) is None:
+        if visited_players.add(user_id, world_code):
             # print(f'{name} - adding player {player.nick_no} - {player.world_code}')
-            await queue.put({
+            player_uuid = get_user_uuid(user_id, world_code)
+            new_task = {
+                "key": player_uuid,
                 "action": "fetch_battle_list",
                 "user_id": user_id,
                 "world_code": world_code
-            })
-            user_dict[player_uuid] = {
-                "user_id": user_id,
-                "user_name": user_name,
-                "world_code": world_code,
-                "user_rank": current_rank,
             }
+            if crawl_state is not None:
+                crawl_state.add_task(player_uuid, new_task)
+            await queue.put(new_task)
+            # players that are already indexed are still crawled, but not inserted again
+            if known_players.add(user_id, world_code):
+                user_info: UserInfo = {
+                    "user_id": user_id,
+                    "user_name": user_name,
+                    "world_code": world_code,
+                    "user_rank": current_rank,
+                }
+                discovered_players.append(user_info)
+                players_discovered.inc(command="fetch_users")
+                if crawl_state is not None:
+                    crawl_state.add_result(player_uuid, user_info)
+
+    while True:
+        # Get a "work item" out of the queue.
+        task = await queue.get()
+
+        # exit earlier if we've reached our goal
+        if len(visited_players) > max_count:
+            queue.task_done()
+            continue
 
-    async with aiohttp.ClientSession() as session:
-        while True:
-            # Get a "work item" out of the queue.
-            task = await queue.get()
-
-            # exit earlier if we've reached our goal
-            if len(user_dict) > max_count:
-                queue.task_done()
-                continue
-
-            # print(f'{name} - received task {task}')
+        # print(f'{name} - received task {task}')
+        if crawl_state is not None:
+            crawl_state.lease_task(task["key"])
 
+        try:
             match task["action"]:
                 case "fetch_recommend_list":
                     response = await rta_api.get_recommended_list(session)
@@ -76,42 +94,80 @@ async def worker(name: str,
                                                      current_rank=battle.enemy_grade_code,
                                                      match_season=battle.season_code)
 
-            print(f'{name} - task done - total user added: {len(user_dict)}, elements in queue: {queue.qsize()}')
-
+            tasks_processed.inc(command="fetch_users")
+            print(f'{name} - task done - total user visited: {len(visited_players)}, '
+                  f'added: {len(discovered_players)}, elements in queue: {queue.qsize()}')
+            if crawl_state is not None:
+                crawl_state.complete_task(task["key"])
+        except Exception as e:
+            # the api layer already retried transient errors, so we just drop the task
+            print(f'{name} - error processing task {task}: {type(e).__name__} {e}')
+            errors.inc(command="fetch_users", type=type(e).__name__)
+            if crawl_state is not None:
+                crawl_state.fail_task(task["key"])
+        finally:
             # Notify the queue that the "work item" has been processed.
             queue.task_done()
+            queue_depth.set(queue.qsize(), command="fetch_users")
 
 
 async def fetch_player_list(indexer: Indexer,
                             season: str,
+                            known_players: KnownPlayers,
                             num_worker: int = 3,
                             initial_recommend_count: int = 5,
-                            max_users: int = 500):
+                            max_users: int = 500,
+                            crawl_state: CrawlState | None = None):
+    """
+    When a `crawl_state` is provided, the frontier and the discovered players are persisted in it,
+    and an interrupted run is resumed where it stopped. The state is cleared once the players are inserted:
+    a run whose insert failed is also resumed, which inserts its players again.
+    """
     # Create a queue that we will use to store our "workload".
     queue = asyncio.Queue()
 
-    user_dict: dict[str, UserInfo] = {}
-
-    # start by fetching the recommended list 3 times (results will differ)
-    for _ in range(initial_recommend_count):
-        queue.put_nowait({
-            "action": "fetch_recommend_list"
-        })
-
-    # Create the worker tasks to process the queue concurrently.
-    tasks = []
-    for i in range(num_worker):
-        task = asyncio.create_task(worker(f'worker-{i}', queue, season, user_dict, max_count=max_users))
-        tasks.append(task)
-
-    # Wait until the queue is fully processed.
-    await queue.join()
-
-    # Cancel our worker tasks.
-    for task in tasks:
-        task.cancel()
-    # Wait until all worker tasks are cancelled.
-    await asyncio.gather(*tasks, return_exceptions=True)
+    visited_players = KnownPlayers()
+    discovered_players: list[UserInfo] = []
+
+    if crawl_state is not None and (crawl_state.has_unfinished_tasks() or crawl_state.has_results()):
+        for previous_task in crawl_state.all_tasks():
+            if previous_task["action"] == "fetch_battle_list":
+                visited_players.add(previous_task["user_id"], previous_task["world_code"])
+        for previous_player in crawl_state.results():
+            discovered_players.append(previous_player)
+            known_players.add(previous_player["user_id"], previous_player["world_code"])
+        unfinished_tasks = crawl_state.unfinished_tasks()
+        print(f'resuming previous run: {len(unfinished_tasks)} tasks left, {len(discovered_players)} users added')
+        for unfinished_task in unfinished_tasks:
+            queue.put_nowait(unfinished_task)
+    else:
+        # start by fetching the recommended list 3 times (results will differ)
+        for i in range(initial_recommend_count):
+            new_task = {
+                "key": f'recommend_{i}',
+                "action": "fetch_recommend_list"
+            }
+            if crawl_state is not None:
+                crawl_state.add_task(new_task["key"], new_task)
+            queue.put_nowait(new_task)
+
+    # all the workers share the same connection pool
+    async with create_session() as session:
+        # Create the worker tasks to process the queue concurrently.
+        tasks = []
+        for i in range(num_worker):
+            task = asyncio.create_task(worker(f'worker-{i}', session, queue, season, visited_players, known_players,
+                                              discovered_players, crawl_state, max_count=max_users))
+            tasks.append(task)
+
+        # Wait until the queue is fully processed.
+        await queue.join()
+
+        # Cancel our worker tasks.
+        for task in tasks:
+            task.cancel()
+        # Wait until all worker tasks are cancelled.
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     def map_player(player):
         return {
@@ -121,9 +177,16 @@ async def fetch_player_list(indexer: Indexer,
             "rank": player["user_rank"],
         }
 
-    await indexer.insert_players(
-        list(map(map_player, user_dict.values())),
-        season
+    inserted_players = await insert_discovered_players(
+        indexer,
+        list(map(map_player, discovered_players)),
+        season,
+        known_players
     )
 
-    print(f'inserted {len(user_dict)} users')
+    # keep the state around if some players could not be inserted, so the next run resumes and inserts them again
+    if crawl_state is not None and len(inserted_players) == len(discovered_players):
+        crawl_state.clear()
+
+    print(f'inserted {len(inserted_players)} users')
+    print(call_stats.summary())
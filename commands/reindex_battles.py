@@ -0,0 +1,37 @@
+from src import Indexer, UnitRegistry, ArtefactRegistry
+from src.battle_store import BattleStore
+
+
+async def reindex_battles(indexer: Indexer,
+                          season: str,
+                          store: BattleStore,
+                          unit_registry: UnitRegistry,
+                          artefact_registry: ArtefactRegistry,
+                          batch_size: int = 5000) -> int:
+    """
+    Indexes the battles of the store (see `export_battles`) in the season's battle index, with the names of the
+    current registries, returns the number of battles indexed. Battles already indexed are overwritten.
+    """
+    indexed = 0
+    failed = 0
+    batch = []
+
+    async def insert(battles: list[dict]):
+        nonlocal indexed, failed
+        results = await indexer.insert_battles(battles, season)
+        indexed += results.count(True)
+        failed += results.count(False)
+        print(f'indexed {indexed} of {len(store)} battles')
+
+    for battle in store.battles(unit_registry, artefact_registry, batch_size=batch_size):
+        batch.append(battle)
+        if len(batch) >= batch_size:
+            await insert(batch)
+            batch = []
+    if len(batch) > 0:
+        await insert(batch)
+
+    print(f'reindex done: {indexed} battles indexed')
+    if failed > 0:
+        print(f'{failed} battles failed to be indexed')
+    return indexed
@@ -1,20 +1,22 @@
 import asyncio
 import aiohttp
-import json
-import math
-from datetime import datetime
 import time
-from typing import TypedDict
-import pydantic
+from contextlib import nullcontext
+from typing import AsyncIterable, TypedDict
 
-from rta_api import api as rta_api
+from rta_api import api as rta_api, create_session, call_stats
 from rta_api.model.get_battle_list import GetBattleListResponseBattleListItem
-from src import Indexer, UnitRegistry, ArtefactRegistry
-from src.model import RtaBattle, RtaPlayer
+from src import Indexer, UnitRegistry, ArtefactRegistry, KnownPlayers
+from src.model import RtaPlayer
 from src.constants import ALLOWED_PLAYER_RANKS
+from src.crawl_state import CrawlState
+from src.recent_battles import RecentBattles
+from src.metrics import (battles_processed, conversion_latency, errors, players_discovered, queue_depth,
+                         tasks_processed)
+from src.refresh_scheduler import estimate_battle_rate, estimate_coverage
 from src.utils import get_user_uuid
-
-raw_date_format = "%Y-%m-%d %H:%M:%S.%f"
+from .battle_conversion import parse_battle_date
+from .battle_converter import BattleConverter
 
 
 # TODO: factorize with fetch_player_list
@@ -25,281 +27,338 @@ class UserInfo(TypedDict):
     rank: str
 
 
+class DiscoveryBudget:
+    """
+    Number of discovered players that can still be queued for a sync, shared by the workers (None for no limit).
+    """
+    remaining: int | None
+
+    def __init__(self, remaining: int | None = None):
+        self.remaining = remaining
+
+    def take(self) -> bool:
+        if self.remaining is None:
+            return True
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class PrefetchWindow:
+    """
+    The players produced from the refresh list that are not synced yet, at most `size` of them.
+
+    The producer waits for room in the window rather than for the queue to drain: the queue also holds the discovered
+    players, so it may stay full long enough for the point in time of the refresh list to expire.
+    """
+    size: int
+
+    def __init__(self, size: int):
+        self.size = size
+        self.__slots = asyncio.Semaphore(size)
+        # identities of the players in the window, the queue items themselves
+        self.__players: set[int] = set()
+
+    async def add(self, player: RtaPlayer):
+        await self.__slots.acquire()
+        self.__players.add(id(player))
+
+    def done(self, player: RtaPlayer):
+        if id(player) in self.__players:
+            self.__players.remove(id(player))
+            self.__slots.release()
+
+
 async def worker(
         name: str,
+        session: aiohttp.ClientSession,
         queue: asyncio.Queue,
         indexer: Indexer,
-        unit_registry: UnitRegistry,
-        artefact_registry: ArtefactRegistry,
+        converter: BattleConverter,
         season: str,
-        known_player_uuids: set[str],
+        known_players: KnownPlayers,
         sync_discovered_players: bool,
+        crawl_state: CrawlState | None,
+        discovery_budget: DiscoveryBudget,
+        recent_battles: RecentBattles | None,
+        prefetch_window: PrefetchWindow,
 ):
-    async with aiohttp.ClientSession() as session:
-        while True:
-            # get the player to process from the queue
-            player: RtaPlayer = await queue.get()
-
-            try:
-                api_response = await rta_api.get_battle_list(
-                    session,
-                    user_id=player.user_id,
-                    world_code=player.user_world
-                )
-                raw_battle_list = api_response.result_body.battle_list
-
-                battles = list(
-                    map(lambda battle: convert_raw_battle(battle, unit_registry, artefact_registry), raw_battle_list))
-                max_battle_id = max(list(map(lambda battle: battle.battle_id, battles)))
-
-                # filter out battles already ingested
-                last_updated_battle = player.last_updated_battle_id or 0
-
-                def filter_battles(battle: RtaBattle) -> 'bool':
-                    # already processed - skipping
-                    if battle.battle_id <= last_updated_battle:
-                        return False
-                    # not in correct season - skipping
-                    if battle.season_code != season:
-                        return False
-                    # only import if at least one player is in the allowed ranks
-                    if battle.p1_grade not in ALLOWED_PLAYER_RANKS and battle.p2_grade not in ALLOWED_PLAYER_RANKS:
-                        return False
-                    return True
-
-                battles = list(filter(filter_battles, battles))
-
-                discovered_players = []
-                for raw_battle in raw_battle_list:
-                    opponent_uuid = get_user_uuid(raw_battle.matchPlayerNicknameno, raw_battle.enemy_world_code)
-                    opponent_rank = raw_battle.enemy_grade_code
-                    if (
-                            opponent_uuid not in known_player_uuids
-                            and opponent_rank in ALLOWED_PLAYER_RANKS
-                            and raw_battle.season_code == season
-                    ):
-                        known_player_uuids.add(opponent_uuid)
-                        discovered_players.append({
-                            "id": raw_battle.matchPlayerNicknameno,
-                            "name": raw_battle.enemy_nick_no,
-                            "world": raw_battle.enemy_world_code,
-                            "rank": raw_battle.enemy_grade_code,
-                        })
-
-                if len(discovered_players) > 0:
-                    await indexer.insert_players(discovered_players, season)
-
-                    if sync_discovered_players:
-                        for discovered_player in discovered_players:
-                            await queue.put(RtaPlayer(**{
-                                "user_id": discovered_player['id'],
-                                "user_world": discovered_player['world'],
-                                "user_name": discovered_player['name'],
-                                "last_known_rank": discovered_player['rank'],
-                            }))
-
-                if len(battles) > 0:
-                    await indexer.insert_battles(battles, season)
-
-                last_known_rank = raw_battle_list[0].grade_code if len(raw_battle_list) > 0 else player.last_known_rank
-
-                await indexer.set_player_updated(
+    while True:
+        # get the player to process from the queue
+        player: RtaPlayer = await queue.get()
+        player_uuid = get_user_uuid(player.user_id, player.user_world)
+        if crawl_state is not None:
+            crawl_state.lease_task(player_uuid)
+
+        try:
+            api_response = await rta_api.get_battle_list(
+                session,
+                user_id=player.user_id,
+                world_code=player.user_world
+            )
+            raw_battle_list = api_response.result_body.battle_list
+
+            # apply the cheap filters on the raw battles, to only convert the ones we will actually insert
+            last_updated_battle = player.last_updated_battle_id or 0
+            new_raw_battles = [
+                raw_battle
+                for raw_battle in raw_battle_list
+                if should_ingest_raw_battle(raw_battle, season, last_updated_battle)
+            ]
+            raw_battles_to_ingest = new_raw_battles
+            if recent_battles is not None:
+                # already indexed from the opponent's battle list
+                raw_battles_to_ingest = [raw for raw in new_raw_battles if int(raw.battle_seq) not in recent_battles]
+            duplicate_count = len(new_raw_battles) - len(raw_battles_to_ingest)
+            with conversion_latency.time():
+                battles = await converter.convert(raw_battles_to_ingest)
+            skipped_count = len(raw_battle_list) - len(battles) - duplicate_count
+            max_battle_id = max((int(raw_battle.battle_seq) for raw_battle in raw_battle_list),
+                                default=last_updated_battle)
+
+            # the tracked opponents get these battles without a call of their own
+            covered_battles = covered_opponent_battles(new_raw_battles, known_players)
+
+            discovered_players = []
+            for raw_battle in raw_battle_list:
+                opponent_rank = raw_battle.enemy_grade_code
+                if (
+                        opponent_rank in ALLOWED_PLAYER_RANKS
+                        and raw_battle.season_code == season
+                        and known_players.add(raw_battle.matchPlayerNicknameno, raw_battle.enemy_world_code)
+                ):
+                    discovered_players.append({
+                        "id": raw_battle.matchPlayerNicknameno,
+                        "name": raw_battle.enemy_nick_no,
+                        "world": raw_battle.enemy_world_code,
+                        "rank": raw_battle.enemy_grade_code,
+                    })
+
+            # both writes end up in the same bulk request when the indexer's bulk writer is running
+            discovered_players, battle_results = await asyncio.gather(
+                insert_discovered_players(indexer, discovered_players, season, known_players),
+                indexer.insert_battles(battles, season),
+            )
+            # do not move the player's watermark past battles that failed to be indexed
+            if not all(battle_results):
+                raise Exception(f'{battle_results.count(False)} of {len(battles)} battles failed to be indexed')
+            if recent_battles is not None:
+                recent_battles.add([battle["battle_id"] for battle in battles])
+
+            if len(discovered_players) > 0 and sync_discovered_players:
+                for discovered_player in discovered_players:
+                    if not discovery_budget.take():
+                        break
+                    discovered_rta_player = RtaPlayer(**{
+                        "user_id": discovered_player['id'],
+                        "user_world": discovered_player['world'],
+                        "user_name": discovered_player['name'],
+                        "last_known_rank": discovered_player['rank'],
+                    })
+                    if add_crawl_task(crawl_state, discovered_rta_player):
+                        await queue.put(discovered_rta_player)
+
+            last_known_rank = raw_battle_list[0].grade_code if len(raw_battle_list) > 0 else player.last_known_rank
+
+            now = round(time.time() * 1000)
+            battle_rate = estimate_player_battle_rate(player, raw_battle_list, season, now)
+            coverage = estimate_coverage(player.coverage, player.covered_battle_count or 0, len(new_raw_battles))
+
+            await asyncio.gather(
+                indexer.set_player_updated(
                     user_id=player.user_id,
                     user_world=player.user_world,
                     season=season,
-                    date=round(time.time() * 1000),
+                    date=now,
                     last_updated_battle=max_battle_id,
-                    last_known_rank=last_known_rank)
+                    last_known_rank=last_known_rank,
+                    battle_rate=battle_rate,
+                    coverage=coverage),
+                indexer.add_covered_battles(covered_battles, season),
+            )
 
-                print(
-                    f'updated battles for player {player.user_id}'
-                    f' - {len(battles)} battles inserted'
-                    f' - {len(discovered_players)} players discovered')
-                print(f'remaining items in queue: {queue.qsize()}')
-            except Exception as e:
-                print(f'error updating user {player.user_id}: {e}')
-            finally:
-                # Notify the queue that the "work item" has been processed.
-                queue.task_done()
+            tasks_processed.inc(command="sync_battles")
+            battles_processed.inc(len(battles), outcome="inserted")
+            battles_processed.inc(skipped_count, outcome="skipped")
+            battles_processed.inc(duplicate_count, outcome="duplicate")
+            players_discovered.inc(len(discovered_players), command="sync_battles")
+            print(
+                f'updated battles for player {player.user_id}'
+                f' - {len(battles)} battles inserted'
+                f' - {skipped_count} battles skipped'
+                f' - {duplicate_count} duplicates'
+                f' - {len(discovered_players)} players discovered')
+            print(f'remaining items in queue: {queue.qsize()}')
+            if crawl_state is not None:
+                crawl_state.complete_task(player_uuid)
+        except Exception as e:
+            # the api layer already retried transient errors, the player will be picked up again on the next run
+            print(f'error updating user {player.user_id}: {type(e).__name__} {e}')
+            errors.inc(command="sync_battles", type=type(e).__name__)
+            if crawl_state is not None:
+                crawl_state.fail_task(player_uuid)
+        finally:
+            prefetch_window.done(player)
+            # Notify the queue that the "work item" has been processed.
+            queue.task_done()
+            queue_depth.set(queue.qsize(), command="sync_battles")
+
+
+async def insert_discovered_players(indexer: Indexer, players: list[dict], season: str,
+                                    known_players: KnownPlayers) -> list[dict]:
+    """
+    Inserts the players just added to the known players, and returns the inserted ones.
+    The others are removed from the known players, so they are inserted again when discovered again.
+    """
+    results = [False] * len(players)
+    try:
+        results = await indexer.insert_players(players, season)
+    finally:
+        for player, inserted in zip(players, results):
+            if not inserted:
+                known_players.remove(player["id"], player["world"])
+    return [player for player, inserted in zip(players, results) if inserted]
 
 
 async def sync_players_battles(
         indexer: Indexer,
         unit_registry: UnitRegistry,
         artefact_registry: ArtefactRegistry,
-        players_to_sync: list[RtaPlayer],
-        known_player_uuids: set[str],
+        players_to_sync: AsyncIterable[RtaPlayer],
+        known_players: KnownPlayers,
         season: str,
         sync_discovered_players: bool,
-        num_worker: int = 3
+        num_worker: int = 3,
+        prefetch_size: int = 1000,
+        crawl_state: CrawlState | None = None,
+        converter: BattleConverter | None = None,
+        max_discovered_players: int | None = None,
+        recent_battles: RecentBattles | None = None,
+        session: aiohttp.ClientSession | None = None,
 ):
+    """
+    When a `crawl_state` is provided, the frontier is persisted in it, and the unfinished players of an interrupted
+    run are synced first. The state is cleared once the run completes.
+
+    Battles are converted on the event loop, unless another `converter` (e.g. a process pool) is provided.
+
+    With `sync_discovered_players`, at most `max_discovered_players` of the discovered players are synced in turn
+    (all of them if None).
+
+    The battles in `recent_battles` are skipped, and the indexed ones are added to it.
+
+    The workers use the caller's `session` when provided, else their own.
+    """
+    discovery_budget = DiscoveryBudget(max_discovered_players)
+    prefetch_window = PrefetchWindow(prefetch_size)
     queue: asyncio.Queue = asyncio.Queue()
-    for player in players_to_sync:
-        queue.put_nowait(player)
-
-    # Create the worker tasks to process the queue concurrently.
-    tasks = []
-    for i in range(num_worker):
-        task = asyncio.create_task(
-            worker(
-                f'worker-{i}',
-                queue,
-                indexer,
-                unit_registry,
-                artefact_registry,
-                season,
-                known_player_uuids,
-                sync_discovered_players
+    if converter is None:
+        converter = BattleConverter(unit_registry, artefact_registry)
+
+    async def produce():
+        if crawl_state is not None:
+            resumed_players = crawl_state.unfinished_tasks()
+            if len(resumed_players) > 0:
+                print(f'resuming previous run: {len(resumed_players)} players left to sync')
+            for resumed_player in resumed_players:
+                queue.put_nowait(RtaPlayer(**resumed_player))
+
+        async for player_to_sync in players_to_sync:
+            # players already synced by the interrupted run are skipped
+            if not add_crawl_task(crawl_state, player_to_sync):
+                continue
+            # backpressure: only fetch the next players once the workers caught up with the produced ones
+            await prefetch_window.add(player_to_sync)
+            queue.put_nowait(player_to_sync)
+
+    # all the workers share the same connection pool
+    async with create_session() if session is None else nullcontext(session) as session:
+        # Create the worker tasks to process the queue concurrently.
+        tasks = []
+        for i in range(num_worker):
+            task = asyncio.create_task(
+                worker(
+                    f'worker-{i}',
+                    session,
+                    queue,
+                    indexer,
+                    converter,
+                    season,
+                    known_players,
+                    sync_discovered_players,
+                    crawl_state,
+                    discovery_budget,
+                    recent_battles,
+                    prefetch_window,
+                )
             )
-        )
-        tasks.append(task)
-
-    # Wait until the queue is fully processed.
-    await queue.join()
-
-    # Cancel our worker tasks.
-    for task in tasks:
-        task.cancel()
-    # Wait until all worker tasks are cancelled.
-    await asyncio.gather(*tasks, return_exceptions=True)
-
-
-def convert_raw_battle(raw: GetBattleListResponseBattleListItem,
-                       unit_registry: UnitRegistry,
-                       artefact_registry: ArtefactRegistry) -> 'RtaBattle':
-    def unit_from_id(unit_id: str | None):
-        if unit_id is None:
-            return None
-        unit_name = unit_registry.name_from_id(unit_id)
-        return {
-            "id": unit_id,
-            "name": unit_name or "Unknown",
-        }
-
-    def units_from_ids(unit_ids: list[str]):
-        return list(map(unit_from_id, unit_ids))
-
-    p1_postban = next((char for char in raw.my_deck.hero_list if char.ban == 1), None)
-    p2_postban = next((char for char in raw.enemy_deck.hero_list if char.ban == 1), None)
-
-    p1_first_pick = next((char for char in raw.my_deck.hero_list if char.first_pick == 1), None)
-
-    p1_team_battle_info = json.loads("{" + raw.teamBettleInfo + "}")
-    p1_team_info = p1_team_battle_info["my_team"]
-    p1_team_info.sort(key=lambda x: x["pick_order"], reverse=False)
-    p1_pick_order = list(map(lambda s: s["hero_code"], p1_team_info))
-
-    p2_team_battle_info = json.loads("{" + raw.teamBettleInfoenemy + "}")
-    p2_team_info = p2_team_battle_info["my_team"]
-    p2_team_info.sort(key=lambda x: x["pick_order"], reverse=False)
-    p2_pick_order = list(map(lambda s: s["hero_code"], p2_team_info))
-
-    p1_postban_position = p1_pick_order.index(p1_postban.hero_code) + 1 if p1_postban else None
-    p2_postban_position = p2_pick_order.index(p2_postban.hero_code) + 1 if p2_postban else None
-
-    battle_date = math.floor(datetime.strptime(raw.battle_day, raw_date_format).timestamp() * 1000)
-
-    battle: dict = {
-        "schema_version": 1,
-
-        "battle_id": int(raw.battle_seq),
-        "season_code": raw.season_code,
-        "turn_count": raw.turn,
-        "battle_date": battle_date,
-    }
-
-    reverse_players = p1_first_pick is None
-    p1_prefix = 'p2' if reverse_players else 'p1'
-    p2_prefix = 'p1' if reverse_players else 'p2'
-
-    battle.update({
-        f'{p1_prefix}_id': raw.nicknameno,
-        f'{p1_prefix}_world': raw.worldCode,
-        f'{p1_prefix}_grade': raw.grade_code,
-        f'{p1_prefix}_win': raw.iswin == 1,
-        f'{p1_prefix}_first_pick': p1_first_pick is not None,
-
-        f'{p2_prefix}_id': raw.matchPlayerNicknameno,
-        f'{p2_prefix}_world': raw.enemy_world_code,
-        f'{p2_prefix}_grade': raw.enemy_grade_code,
-        f'{p2_prefix}_win': raw.iswin == 2,
-        f'{p2_prefix}_first_pick': p1_first_pick is None,
-    })
-
-    all_prebans = list(set(raw.my_deck.preban_list + raw.enemy_deck.preban_list))
-    battle["prebans"] = units_from_ids(all_prebans)
-
-    battle.update({
-        f'{p1_prefix}_prebans': units_from_ids(raw.my_deck.preban_list),
-        f'{p1_prefix}_postban': unit_from_id(p1_postban.hero_code) if p1_postban is not None else None,
-        f'{p1_prefix}_postban_position': p1_postban_position,
-
-        f'{p2_prefix}_prebans': units_from_ids(raw.enemy_deck.preban_list),
-        f'{p2_prefix}_postban': unit_from_id(p2_postban.hero_code) if p2_postban is not None else None,
-        f'{p2_prefix}_postban_position': p2_postban_position,
-    })
-
-    battle[f'{p1_prefix}_picks'] = units_from_ids(p1_pick_order)
-    battle[f'{p2_prefix}_picks'] = units_from_ids(p2_pick_order)
-
-    # p1_pick1 -> p1_pick5
-    for n in range(0, 5):
-        pick_id = p1_pick_order[n] if len(p1_pick_order) > n else None
-        battle[f'{p1_prefix}_pick{n + 1}'] = unit_from_id(pick_id)
-
-    # p2_pick1 -> p2_pick5
-    for n in range(0, 5):
-        pick_id = p2_pick_order[n] if len(p2_pick_order) > n else None
-        battle[f'{p2_prefix}_pick{n + 1}'] = unit_from_id(pick_id)
-
-    p1_picks = units_from_ids(p2_pick_order if reverse_players else p1_pick_order)
-    p2_picks = units_from_ids(p1_pick_order if reverse_players else p2_pick_order)
-
-    battle["p1_picks_stage1"] = p1_picks[0:1]
-    battle["p1_picks_stage2"] = p1_picks[1:3]
-    battle["p1_picks_stage3"] = p1_picks[3:5]
-
-    battle["p2_picks_stage1"] = p2_picks[0:2]
-    battle["p2_picks_stage2"] = p2_picks[2:4]
-    battle["p2_picks_stage3"] = p2_picks[4:5]
-
-    parsed_p1_team_info = TeamBattleInfo(**p1_team_battle_info)
-    parsed_p2_team_info = TeamBattleInfo(**p2_team_battle_info)
-    all_unit_details = parsed_p1_team_info.my_team + parsed_p2_team_info.my_team
-
-    def map_unit_details(raw: TeamBattleInfoDetails):
-        return {
-            "id": raw.hero_code,
-            "name": unit_registry.name_from_id(raw.hero_code),
-            "pick_order": raw.pick_order,
-            "equipped_sets": raw.equip,
-            "artifact_id": raw.artifact,
-            "artifact_name": artefact_registry.name_from_id(raw.artifact) or "Unknown",
-            "mvp": raw.mvp == 1,
-            "position": raw.position,
-            "role": raw.job_cd,
-        }
-
-    battle["units_details"] = list(map(map_unit_details, all_unit_details))
-
-    initial_cr_position = json.loads("{" + raw.energyGauge + "}")["energy_gauge"]
-    battle["initial_cr_position"] = initial_cr_position
-
-    return RtaBattle(**battle)
-
-
-class TeamBattleInfoDetails(pydantic.BaseModel):
-    pick_order: int
-    hero_code: str
-    artifact: str
-    equip: list[str]
-    mvp: int  # 0 / 1
-    kill_count: int
-    position: int
-    attack_damage: float
-    receive_damage: float
-    job_cd: str
-
-
-class TeamBattleInfo(pydantic.BaseModel):
-    my_team: list[TeamBattleInfoDetails]
+            tasks.append(task)
+
+        try:
+            # the workers start as soon as the first players are produced
+            await produce()
+            # Wait until the queue is fully processed.
+            await queue.join()
+            if crawl_state is not None:
+                crawl_state.clear()
+        finally:
+            # Cancel our worker tasks.
+            for task in tasks:
+                task.cancel()
+            # Wait until all worker tasks are cancelled.
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(call_stats.summary())
+
+
+def add_crawl_task(crawl_state: CrawlState | None, player: RtaPlayer) -> bool:
+    if crawl_state is None:
+        return True
+    return crawl_state.add_task(get_user_uuid(player.user_id, player.user_world), player.model_dump())
+
+
+def should_ingest_raw_battle(raw: GetBattleListResponseBattleListItem, season: str, last_updated_battle: int) -> bool:
+    # already processed - skipping
+    if int(raw.battle_seq) <= last_updated_battle:
+        return False
+    # not in correct season - skipping
+    if raw.season_code != season:
+        return False
+    # only import if at least one player is in the allowed ranks
+    if raw.grade_code not in ALLOWED_PLAYER_RANKS and raw.enemy_grade_code not in ALLOWED_PLAYER_RANKS:
+        return False
+    return True
+
+
+def covered_opponent_battles(raw_battles: list[GetBattleListResponseBattleListItem],
+                             known_players: KnownPlayers) -> dict[tuple[int, str], list[int]]:
+    """
+    The ids of the given battles, by known opponent (the players discovered by these battles are not in the index yet).
+    """
+    covered_battles: dict[tuple[int, str], list[int]] = {}
+    for raw in raw_battles:
+        opponent = (raw.matchPlayerNicknameno, raw.enemy_world_code)
+        if opponent in known_players:
+            covered_battles.setdefault(opponent, []).append(int(raw.battle_seq))
+    return covered_battles
+
+
+def estimate_player_battle_rate(player: RtaPlayer,
+                                raw_battle_list: list[GetBattleListResponseBattleListItem],
+                                season: str,
+                                now: int) -> float | None:
+    season_battles = [raw for raw in raw_battle_list if raw.season_code == season]
+    if player.last_update_time:
+        # battles played since the previous refresh
+        last_updated_battle = player.last_updated_battle_id or 0
+        new_battle_count = sum(1 for raw in season_battles if int(raw.battle_seq) > last_updated_battle)
+        window_start = player.last_update_time
+    elif len(season_battles) > 0:
+        # first refresh: use the history returned by the api
+        new_battle_count = len(season_battles)
+        window_start = min(parse_battle_date(raw.battle_day) for raw in season_battles)
+    else:
+        return player.battle_rate
+    return estimate_battle_rate(player.battle_rate, new_battle_count, (now - window_start) / 3600000,
+                                rank=player.last_known_rank)
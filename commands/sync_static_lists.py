@@ -1,55 +1,116 @@
 import aiohttp
+import hashlib
 import json
 import os
-from rta_api import get_hero_list, get_artifact_list
+from typing import Callable
 
+from rta_api import get_static_file, create_session
+from rta_api.api import hero_list_path, artifact_list_path
+from rta_api.model import HeroList, ArtefactList
 
-async def sync_static_lists():
-    print("Syncing unit list...")
-    await sync_unit_list()
-    print("Syncing artefact list...")
-    await sync_artefact_list()
+
+async def sync_static_lists(static_directory: str | None = None, state_file_path: str | None = None) -> list[str]:
+    """
+    Only downloads the lists modified since the previous sync (with the validators of the previous responses,
+    kept in the state file), and only rewrites the static files whose content changed: the running syncs reload
+    their registries when the files change. Returns the paths of the rewritten files.
+    """
+    static_directory = static_directory or os.path.join(os.getcwd(), 'data/static')
+    state_file_path = state_file_path or os.path.join(os.getcwd(), 'data/cache/static_lists.json')
+    state = _load_state(state_file_path)
+    updated = []
+    async with create_session() as session:
+        print("Syncing unit list...")
+        units_file_path = os.path.join(static_directory, 'units.json')
+        if await sync_static_list(session, hero_list_path, units_file_path, map_heroes, state):
+            updated.append(units_file_path)
+        _save_state(state_file_path, state)
+
+        print("Syncing artefact list...")
+        artefacts_file_path = os.path.join(static_directory, 'artefacts.json')
+        if await sync_static_list(session, artifact_list_path, artefacts_file_path, map_artefacts, state):
+            updated.append(artefacts_file_path)
+        _save_state(state_file_path, state)
     print("Done.")
+    return updated
+
+
+async def sync_static_list(session: aiohttp.ClientSession,
+                           path: str,
+                           target_file_path: str,
+                           convert: Callable[[bytes], dict],
+                           state: dict) -> bool:
+    """
+    Syncs a static file from the static asset at `path`, returns whether the file was rewritten.
+    `state` holds the validators and content hash of the previous response of each asset.
+    """
+    previous = state.get(path, {}) if os.path.exists(target_file_path) else {}
+    static_file = await get_static_file(session, path, previous.get("etag"), previous.get("last_modified"))
+    if static_file.content is None:
+        print(f'{path}: not modified')
+        return False
+
+    source_hash = hashlib.sha256(static_file.content).hexdigest()
+    state[path] = {"etag": static_file.etag, "last_modified": static_file.last_modified, "sha256": source_hash}
+    if source_hash == previous.get("sha256"):
+        print(f'{path}: unchanged')
+        return False
+
+    content = json.dumps(convert(static_file.content), indent=2, ensure_ascii=False).encode("utf-8")
+    # e.g. a change of a field that is not kept
+    if os.path.exists(target_file_path):
+        with open(target_file_path, "rb") as target_file:
+            if target_file.read() == content:
+                print(f'{path}: unchanged')
+                return False
+
+    _write_atomically(target_file_path, content)
+    print(f'{path}: updated {target_file_path}')
+    return True
 
 
-async def sync_unit_list():
-    async with aiohttp.ClientSession() as session:
-        response = await get_hero_list(session)
+def map_heroes(content: bytes) -> dict:
+    response = HeroList(**json.loads(content))
+    return {
+        hero.code: {
+            "id": hero.code,
+            "name": hero.name,
+            "grade": hero.grade,
+            "role": hero.job_cd,
+            "element": hero.attribute_cd,
+        }
+        for hero in response.en
+    }
 
-        def map_hero(hero):
-            return (
-                hero.code,
-                {
-                    "id": hero.code,
-                    "name": hero.name,
-                    "grade": hero.grade,
-                    "role": hero.job_cd,
-                    "element": hero.attribute_cd,
-                }
-            )
 
-        heroes = dict(map(map_hero, response.en))
+def map_artefacts(content: bytes) -> dict:
+    response = ArtefactList(**json.loads(content))
+    return {
+        artefact.code: {
+            "id": artefact.code,
+            "name": artefact.name,
+        }
+        for artefact in response.en
+    }
 
-        target_file_path = os.path.join(os.getcwd(), 'data/static/units.json')
-        with open(target_file_path, "w") as target_file:
-            target_file.write(json.dumps(heroes, indent=2, ensure_ascii=False))
 
+def _write_atomically(filepath: str, content: bytes):
+    # readers (e.g. the registries of a running sync) never see a partially written file
+    temporary_path = f'{filepath}.tmp'
+    with open(temporary_path, "wb") as temporary_file:
+        temporary_file.write(content)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+    os.replace(temporary_path, filepath)
 
-async def sync_artefact_list():
-    async with aiohttp.ClientSession() as session:
-        response = await get_artifact_list(session)
 
-        def map_hero(artefact):
-            return (
-                artefact.code,
-                {
-                    "id": artefact.code,
-                    "name": artefact.name,
-                }
-            )
+def _load_state(state_file_path: str) -> dict:
+    if not os.path.exists(state_file_path):
+        return {}
+    with open(state_file_path, "r") as state_file:
+        return json.load(state_file)
 
-        artefacts = dict(map(map_hero, response.en))
 
-        target_file_path = os.path.join(os.getcwd(), 'data/static/artefacts.json')
-        with open(target_file_path, "w") as target_file:
-            target_file.write(json.dumps(artefacts, indent=2, ensure_ascii=False))
+def _save_state(state_file_path: str, state: dict):
+    os.makedirs(os.path.dirname(state_file_path), exist_ok=True)
+    _write_atomically(state_file_path, json.dumps(state, indent=2).encode("utf-8"))
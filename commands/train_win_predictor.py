@@ -0,0 +1,33 @@
+import numpy as np
+
+from src import Indexer
+from src.win_predictor import WinPredictor, battle_source_fields, draft_from_battle
+
+
+async def train_win_predictor(indexer: Indexer,
+                              season: str,
+                              predictor: WinPredictor,
+                              holdout: float = 0.1,
+                              epochs: int = 20,
+                              learning_rate: float = 0.05,
+                              l2: float = 1e-4) -> dict[str, float]:
+    """
+    Trains the predictor on the battles of the season, and evaluates it on the most recent ones (the `holdout`
+    share), which it did not see, as it will be used on future drafts.
+    """
+    drafts = []
+    p1_wins = []
+    # battles are streamed by date
+    async for battle in indexer.iter_battles(season, source=battle_source_fields):
+        drafts.append(draft_from_battle(battle))
+        p1_wins.append(battle["p1_win"])
+    labels = np.array(p1_wins, dtype=np.float32)
+
+    split = round(len(drafts) * (1 - holdout))
+    losses = predictor.train(drafts[:split], labels[:split], epochs=epochs, learning_rate=learning_rate, l2=l2)
+    evaluation = predictor.evaluate(drafts[split:], labels[split:])
+
+    print(f'trained on {split} battles, final training loss {losses[-1] if losses else 0:.4f}')
+    print(f'evaluated on {len(drafts) - split} battles: log loss {evaluation["log_loss"]:.4f}, '
+          f'accuracy {evaluation["accuracy"]:.1%} (p1 win rate {evaluation["p1_win_rate"]:.1%})')
+    return evaluation
@@ -1,43 +1,243 @@
 import typer
 import asyncio
 import commands
+import contextlib
 import os
-from typing import Annotated
+import shutil
+from typing import Annotated, Optional
 
-from src import create_client, Indexer, UnitRegistry, ArtefactRegistry
-from src.utils import get_user_uuid
-
-# the current RTA season
-current_season = 'pvp_rta_ss12'
+from rta_api import rate_limiter
+from src import create_client, Indexer, UnitRegistry, ArtefactRegistry, KnownPlayers, metrics
+from src.config import load_config
+from src.battle_store import BattleStore
+from src.crawl_state import CrawlState
+from src.query_cache import QueryCache
+from src.query_service import QueryService, start_query_server
+from src.recent_battles import RecentBattles
+from src.draft_stats import DraftStats
+from src.win_predictor import WinPredictor
+from src.refresh_scheduler import RefreshSchedule
 
 app = typer.Typer(add_completion=False)
 
 
+def create_indexer(client) -> "Indexer":
+    config = load_config()
+    return Indexer(
+        client=client,
+        shards=config.get("elastic.shards", 1),
+        replicas=config.get("elastic.replicas", 1),
+        refresh_interval=config.get("elastic.refresh_interval", "1s"),
+    )
+
+
+def create_converter(conversion_processes: int) -> "commands.BattleConverter":
+    units_file_path = os.path.join(os.getcwd(), "./data/static/units.json")
+    unit_registry = UnitRegistry(filepath=units_file_path)
+
+    artefacts_file_path = os.path.join(os.getcwd(), "./data/static/artefacts.json")
+    artefact_registry = ArtefactRegistry(filepath=artefacts_file_path)
+
+    if conversion_processes > 0:
+        return commands.ProcessPoolBattleConverter(
+            unit_registry=unit_registry,
+            artefact_registry=artefact_registry,
+            units_file_path=units_file_path,
+            artefacts_file_path=artefacts_file_path,
+            num_processes=conversion_processes)
+    return commands.BattleConverter(unit_registry=unit_registry, artefact_registry=artefact_registry)
+
+
+async def resolve_season(season: str | None) -> str:
+    """
+    The season given on the command line, else the `rta.season` of the config, else the current season
+    according to the game api.
+    """
+    if season is not None:
+        return season
+    season = load_config().get("rta.season")
+    if season is not None:
+        return season
+    season = await commands.detect_current_season()
+    print(f'current season: {season}')
+    return season
+
+
+def known_players_path(season: str):
+    return os.path.join(os.getcwd(), f"./data/cache/known_players_{season}.bin")
+
+
+def draft_stats_path(season: str):
+    return os.path.join(os.getcwd(), f"./data/cache/draft_stats_{season}.npz")
+
+
+def win_predictor_path(season: str):
+    return os.path.join(os.getcwd(), f"./data/cache/win_predictor_{season}.npz")
+
+
+def battle_store_path(season: str):
+    return os.path.join(os.getcwd(), f"./data/store/battles_{season}")
+
+
+def recent_battles_path(season: str):
+    return os.path.join(os.getcwd(), f"./data/cache/recent_battles_{season}.bin")
+
+
+def load_recent_battles(season: str, max_size: int, ttl_hours: float) -> "RecentBattles | None":
+    """
+    Loads the battles indexed by the previous runs, if the cache is enabled.
+    """
+    if max_size <= 0:
+        return None
+    filepath = recent_battles_path(season)
+    if os.path.exists(filepath):
+        return RecentBattles.load(filepath, max_size=max_size, ttl=ttl_hours * 3600)
+    return RecentBattles(max_size=max_size, ttl=ttl_hours * 3600)
+
+
+def save_caches(season: str, known_players: "KnownPlayers | None", recent_battles: "RecentBattles | None"):
+    """
+    Saves the caches loaded by a sync, also when it failed: the players and battles it indexed are still indexed.
+    """
+    if known_players is not None:
+        known_players.save(known_players_path(season))
+    if recent_battles is not None:
+        recent_battles.save(recent_battles_path(season))
+
+
+def open_crawl_state(command: str, season: str, resume: bool) -> "CrawlState":
+    crawl_state = CrawlState(os.path.join(os.getcwd(), f"./data/cache/crawl_{command}_{season}.sqlite"))
+    if not resume:
+        crawl_state.clear()
+    return crawl_state
+
+
+async def load_known_players(indexer: Indexer, season: str, rebuild: bool) -> "KnownPlayers":
+    """
+    Loads the known players saved by the previous run, or rebuilds them from the player index.
+    """
+    filepath = known_players_path(season)
+    if not rebuild and os.path.exists(filepath):
+        return KnownPlayers.load(filepath)
+
+    known_players = KnownPlayers()
+    async for user_id, user_world in indexer.iter_player_ids(season=season):
+        known_players.add(user_id, user_world)
+    return known_players
+
+
+@contextlib.asynccontextmanager
+async def instrumentation(metrics_port: int, metrics_file: str | None, metrics_interval: float,
+                          profile_file: str | None, stack_samples_file: str | None):
+    """
+    Exposes the pipeline metrics while the command runs, and optionally profiles it.
+    """
+    runner = await metrics.start_metrics_server(metrics_port) if metrics_port > 0 else None
+    dump_task = None
+    if metrics_file is not None:
+        dump_task = asyncio.create_task(metrics.dump_metrics_periodically(metrics_file, metrics_interval))
+    try:
+        with metrics.profiling(profile_file, stack_samples_file):
+            yield
+    finally:
+        if dump_task is not None:
+            dump_task.cancel()
+            await asyncio.gather(dump_task, return_exceptions=True)
+            metrics.dump_metrics(metrics_file)
+        if runner is not None:
+            await runner.cleanup()
+
+
+SeasonOption = Annotated[
+    Optional[str], typer.Option(help='The season, by default rta.season of the config, or the current season')]
+IngestModeOption = Annotated[
+    bool, typer.Option(help='If true, the season indices use bulk ingestion settings during the run')]
+
+
+def ingest_settings(indexer: Indexer, season: str, enabled: bool) -> contextlib.AbstractAsyncContextManager:
+    return indexer.ingest_mode(season) if enabled else contextlib.nullcontext()
+
+
+MetricsPortOption = Annotated[
+    int, typer.Option(help='If set, the metrics are served on this port (/metrics and /metrics.json)')]
+MetricsFileOption = Annotated[
+    Optional[str], typer.Option(help='If set, the metrics are periodically dumped as json in this file')]
+MetricsIntervalOption = Annotated[float, typer.Option(help='The delay between two metrics dumps, in seconds')]
+ProfileFileOption = Annotated[
+    Optional[str], typer.Option(help='If set, the run is profiled with cProfile in this file')]
+StackSamplesFileOption = Annotated[
+    Optional[str], typer.Option(help='If set, the stack samples of the run are written in this file (folded format)')]
+RecentBattlesSizeOption = Annotated[
+    int, typer.Option(help='The number of recently indexed battles skipped when found again, 0 to disable')]
+RecentBattlesTtlOption = Annotated[
+    float, typer.Option(help='The delay after which a recently indexed battle is forgotten, in hours')]
+
+
+async def sync_static_lists_periodically(interval: float):
+    """
+    Keeps the static lists up to date during a long-running command, the converters reload the updated files.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await commands.sync_static_lists()
+        except Exception as e:
+            print(f'static lists sync failed: {e}')
+
+
 @app.command(name="sync-json")
 def sync_jsons():
     async def _sync_jsons():
-        await commands.sync_static_lists()
+        updated = await commands.sync_static_lists()
+        print(f'{len(updated)} static files updated')
 
     asyncio.run(_sync_jsons())
 
 
 @app.command(name="fetch-users")
 def fetch_users(
-        max_users: Annotated[int, typer.Option(help='The maximum number of users to fetch')] = 500
+        season: SeasonOption = None,
+        max_users: Annotated[int, typer.Option(help='The maximum number of users to fetch')] = 500,
+        num_worker: Annotated[int, typer.Option(help='The number of concurrent workers')] = 3,
+        api_rate: Annotated[float, typer.Option(help='The maximum number of api calls per second')] = 10,
+        rebuild_known_players: Annotated[
+            bool, typer.Option(help='If true, the known players are loaded from the index instead of the cache')] = False,
+        resume: Annotated[
+            bool, typer.Option(help='If true, an interrupted run is resumed where it stopped')] = True,
+        ingest_mode: IngestModeOption = True,
+        metrics_port: MetricsPortOption = 0,
+        metrics_file: MetricsFileOption = None,
+        metrics_interval: MetricsIntervalOption = 10,
+        profile_file: ProfileFileOption = None,
+        stack_samples_file: StackSamplesFileOption = None,
 ):
     async def _fetch_users():
+        current_season = await resolve_season(season)
+        rate_limiter.configure(rate=api_rate, burst=api_rate)
         client = create_client()
         try:
-            indexer = Indexer(client=client)
+            indexer = create_indexer(client)
 
             await indexer.create_player_index(season=current_season)
 
-            await commands.fetch_player_list(
-                indexer=indexer,
-                season=current_season,
-                num_worker=3,
-                max_users=max_users,
-                initial_recommend_count=5)
+            known_players = await load_known_players(indexer, current_season, rebuild=rebuild_known_players)
+
+            crawl_state = open_crawl_state("fetch_users", current_season, resume=resume)
+
+            async with ingest_settings(indexer, current_season, ingest_mode):
+                async with instrumentation(metrics_port, metrics_file, metrics_interval, profile_file,
+                                           stack_samples_file):
+                    await commands.fetch_player_list(
+                        indexer=indexer,
+                        season=current_season,
+                        known_players=known_players,
+                        num_worker=num_worker,
+                        max_users=max_users,
+                        initial_recommend_count=5,
+                        crawl_state=crawl_state)
+
+            crawl_state.close()
+            known_players.save(known_players_path(current_season))
         finally:
             await client.close()
 
@@ -46,42 +246,389 @@ def fetch_users(
 
 @app.command(name="sync-battles")
 def sync_battles(
+        season: SeasonOption = None,
         max_users: Annotated[int, typer.Option(help='The maximum number of users to fetch')] = 1000,
         sync_discovered_players: Annotated[
-            bool, typer.Option(help='If true, discovered players will be added to the list')] = True
+            bool, typer.Option(help='If true, discovered players will be added to the list')] = True,
+        num_worker: Annotated[int, typer.Option(help='The number of concurrent workers')] = 10,
+        api_rate: Annotated[float, typer.Option(help='The maximum number of api calls per second')] = 10,
+        bulk_size: Annotated[int, typer.Option(help='The number of actions that triggers a bulk flush')] = 1000,
+        bulk_flush_interval: Annotated[
+            float, typer.Option(help='The maximum delay an action waits for others before a bulk flush, in seconds')] = 0.05,
+        rebuild_known_players: Annotated[
+            bool, typer.Option(help='If true, the known players are loaded from the index instead of the cache')] = False,
+        prioritize_active_players: Annotated[
+            bool, typer.Option(help='If true, players are refreshed by expected number of new battles')] = True,
+        min_expected_battles: Annotated[
+            float, typer.Option(help='Players expected to have less new battles are deferred')] = 1.0,
+        use_coverage: Annotated[
+            bool, typer.Option(help='If true, the battles already ingested through the opponents of a player defer it '
+                                    '(fewer battles are captured when the api calls are scarce)')] = False,
+        resume: Annotated[
+            bool, typer.Option(help='If true, an interrupted run is resumed where it stopped')] = True,
+        conversion_processes: Annotated[
+            int, typer.Option(help='If set, battles are converted in a pool of this many processes')] = 0,
+        static_sync_interval: Annotated[
+            float, typer.Option(help='If set, the static unit and artefact lists are synced every this many seconds')] = 0,
+        ingest_mode: IngestModeOption = True,
+        recent_battles_size: RecentBattlesSizeOption = 200000,
+        recent_battles_ttl: RecentBattlesTtlOption = 48,
+        metrics_port: MetricsPortOption = 0,
+        metrics_file: MetricsFileOption = None,
+        metrics_interval: MetricsIntervalOption = 10,
+        profile_file: ProfileFileOption = None,
+        stack_samples_file: StackSamplesFileOption = None,
 ):
     async def _sync_battles():
-        units_file_path = os.path.join(os.getcwd(), "./data/static/units.json")
-        unit_registry = UnitRegistry(filepath=units_file_path)
+        current_season = await resolve_season(season)
+        rate_limiter.configure(rate=api_rate, burst=api_rate)
 
-        artefacts_file_path = os.path.join(os.getcwd(), "./data/static/artefacts.json")
-        artefact_registry = ArtefactRegistry(filepath=artefacts_file_path)
+        converter = create_converter(conversion_processes)
+        unit_registry, artefact_registry = converter.unit_registry, converter.artefact_registry
 
         client = create_client()
-        indexer = Indexer(client=client)
+        crawl_state = None
+        known_players = None
+        recent_battles = None
+        static_sync_task = None
+        try:
+            indexer = create_indexer(client)
 
-        await indexer.create_player_index(season=current_season)
-        await indexer.create_battle_index(season=current_season)
+            await indexer.create_player_index(season=current_season)
+            await indexer.create_battle_index(season=current_season)
+            indexer.start_bulk_writer(max_actions=bulk_size, flush_interval=bulk_flush_interval)
 
-        players = await indexer.get_all_players(season=current_season)
-        known_players = set(map(lambda player: get_user_uuid(player.user_id, player.user_world), players))
+            known_players = await load_known_players(indexer, current_season, rebuild=rebuild_known_players)
 
-        players = await indexer.get_users_to_refresh(max_users, current_season)
+            schedule = RefreshSchedule(min_expected_battles=min_expected_battles,
+                                       use_coverage=use_coverage) if prioritize_active_players else None
+            players = indexer.iter_users_to_refresh(max_users, current_season, schedule=schedule)
+            crawl_state = open_crawl_state("sync_battles", current_season, resume=resume)
+            recent_battles = load_recent_battles(current_season, recent_battles_size, recent_battles_ttl)
+            if static_sync_interval > 0:
+                static_sync_task = asyncio.create_task(sync_static_lists_periodically(static_sync_interval))
 
-        await commands.sync_players_battles(
-            indexer=indexer,
-            unit_registry=unit_registry,
-            artefact_registry=artefact_registry,
-            season=current_season,
-            players_to_sync=players,
-            known_player_uuids=known_players,
-            sync_discovered_players=sync_discovered_players,
-            num_worker=10
-        )
-        await client.close()
+            async with ingest_settings(indexer, current_season, ingest_mode):
+                try:
+                    async with instrumentation(metrics_port, metrics_file, metrics_interval, profile_file,
+                                               stack_samples_file):
+                        await commands.sync_players_battles(
+                            indexer=indexer,
+                            unit_registry=unit_registry,
+                            artefact_registry=artefact_registry,
+                            season=current_season,
+                            players_to_sync=players,
+                            known_players=known_players,
+                            sync_discovered_players=sync_discovered_players,
+                            num_worker=num_worker,
+                            crawl_state=crawl_state,
+                            converter=converter,
+                            recent_battles=recent_battles,
+                        )
+                finally:
+                    # the pending writes are flushed before the settings are restored
+                    await indexer.close_bulk_writer()
+        finally:
+            if static_sync_task is not None:
+                static_sync_task.cancel()
+                await asyncio.gather(static_sync_task, return_exceptions=True)
+            converter.close()
+            if crawl_state is not None:
+                crawl_state.close()
+            await client.close()
+            save_caches(current_season, known_players, recent_battles)
 
     asyncio.run(_sync_battles())
 
 
+@app.command(name="crawl")
+def crawl(
+        season: SeasonOption = None,
+        max_users: Annotated[int, typer.Option(help='The maximum number of known users to refresh')] = 1000,
+        max_discovered_users: Annotated[
+            int, typer.Option(help='The maximum number of discovered users to sync in turn')] = 1000,
+        recommend_count: Annotated[
+            int, typer.Option(help='The number of recommended lists the new users are seeded from')] = 5,
+        num_worker: Annotated[int, typer.Option(help='The number of concurrent workers')] = 10,
+        api_rate: Annotated[float, typer.Option(help='The maximum number of api calls per second')] = 10,
+        bulk_size: Annotated[int, typer.Option(help='The number of actions that triggers a bulk flush')] = 1000,
+        bulk_flush_interval: Annotated[
+            float, typer.Option(help='The maximum delay an action waits for others before a bulk flush, in seconds')] = 0.05,
+        rebuild_known_players: Annotated[
+            bool, typer.Option(help='If true, the known players are loaded from the index instead of the cache')] = False,
+        prioritize_active_players: Annotated[
+            bool, typer.Option(help='If true, players are refreshed by expected number of new battles')] = True,
+        min_expected_battles: Annotated[
+            float, typer.Option(help='Players expected to have less new battles are deferred')] = 1.0,
+        use_coverage: Annotated[
+            bool, typer.Option(help='If true, the battles already ingested through the opponents of a player defer it '
+                                    '(fewer battles are captured when the api calls are scarce)')] = False,
+        resume: Annotated[
+            bool, typer.Option(help='If true, an interrupted run is resumed where it stopped')] = True,
+        conversion_processes: Annotated[
+            int, typer.Option(help='If set, battles are converted in a pool of this many processes')] = 0,
+        ingest_mode: IngestModeOption = True,
+        recent_battles_size: RecentBattlesSizeOption = 200000,
+        recent_battles_ttl: RecentBattlesTtlOption = 48,
+        metrics_port: MetricsPortOption = 0,
+        metrics_file: MetricsFileOption = None,
+        metrics_interval: MetricsIntervalOption = 10,
+        profile_file: ProfileFileOption = None,
+        stack_samples_file: StackSamplesFileOption = None,
+):
+    """
+    Discovers users and syncs battles in a single pass: fetch-users and sync-battles in one.
+    """
+    async def _crawl():
+        current_season = await resolve_season(season)
+        rate_limiter.configure(rate=api_rate, burst=api_rate)
+        converter = create_converter(conversion_processes)
+
+        client = create_client()
+        crawl_state = None
+        known_players = None
+        recent_battles = None
+        try:
+            indexer = create_indexer(client)
+
+            await indexer.create_player_index(season=current_season)
+            await indexer.create_battle_index(season=current_season)
+            indexer.start_bulk_writer(max_actions=bulk_size, flush_interval=bulk_flush_interval)
+
+            known_players = await load_known_players(indexer, current_season, rebuild=rebuild_known_players)
+
+            schedule = RefreshSchedule(min_expected_battles=min_expected_battles,
+                                       use_coverage=use_coverage) if prioritize_active_players else None
+            players = indexer.iter_users_to_refresh(max_users, current_season, schedule=schedule)
+            crawl_state = open_crawl_state("crawl", current_season, resume=resume)
+            recent_battles = load_recent_battles(current_season, recent_battles_size, recent_battles_ttl)
+
+            async with ingest_settings(indexer, current_season, ingest_mode):
+                try:
+                    async with instrumentation(metrics_port, metrics_file, metrics_interval, profile_file,
+                                               stack_samples_file):
+                        await commands.crawl(
+                            indexer=indexer,
+                            unit_registry=converter.unit_registry,
+                            artefact_registry=converter.artefact_registry,
+                            season=current_season,
+                            players_to_refresh=players,
+                            known_players=known_players,
+                            max_discovered_players=max_discovered_users,
+                            recommend_count=recommend_count,
+                            num_worker=num_worker,
+                            crawl_state=crawl_state,
+                            converter=converter,
+                            recent_battles=recent_battles,
+                        )
+                finally:
+                    await indexer.close_bulk_writer()
+        finally:
+            converter.close()
+            if crawl_state is not None:
+                crawl_state.close()
+            await client.close()
+            save_caches(current_season, known_players, recent_battles)
+
+    asyncio.run(_crawl())
+
+
+@app.command(name="aggregate-stats")
+def aggregate_stats(
+        season: SeasonOption = None,
+        rebuild: Annotated[
+            bool, typer.Option(help='If true, the stats are aggregated from scratch instead of updated')] = False,
+        lookback_minutes: Annotated[
+            float, typer.Option(help='Rescans the battles indexed up to this delay before the last scanned one')] = 10,
+):
+    async def _aggregate_stats():
+        current_season = await resolve_season(season)
+        unit_registry = UnitRegistry(filepath=os.path.join(os.getcwd(), "./data/static/units.json"))
+        unit_ids = list(unit_registry.ids)
+        filepath = draft_stats_path(current_season)
+        if not rebuild and os.path.exists(filepath):
+            stats = DraftStats.load(filepath, unit_ids=unit_ids)
+        else:
+            stats = DraftStats(unit_ids)
+
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            await commands.aggregate_draft_stats(indexer, current_season, stats, lookback_minutes=lookback_minutes)
+        finally:
+            await client.close()
+        stats.save(filepath)
+
+    asyncio.run(_aggregate_stats())
+
+
+@app.command(name="train-predictor")
+def train_predictor(
+        season: SeasonOption = None,
+        epochs: Annotated[int, typer.Option(help='The number of passes over the training battles')] = 20,
+        holdout: Annotated[float, typer.Option(help='The share of the most recent battles kept for evaluation')] = 0.1,
+        learning_rate: Annotated[float, typer.Option(help='The learning rate of the optimizer')] = 0.05,
+        l2: Annotated[float, typer.Option(help='The L2 regularization of the weights')] = 1e-4,
+):
+    async def _train_predictor():
+        current_season = await resolve_season(season)
+        unit_registry = UnitRegistry(filepath=os.path.join(os.getcwd(), "./data/static/units.json"))
+        artefact_registry = ArtefactRegistry(filepath=os.path.join(os.getcwd(), "./data/static/artefacts.json"))
+        predictor = WinPredictor(list(unit_registry.ids), list(artefact_registry.ids))
+
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            await commands.train_win_predictor(indexer, current_season, predictor, holdout=holdout, epochs=epochs,
+                                               learning_rate=learning_rate, l2=l2)
+        finally:
+            await client.close()
+        predictor.save(win_predictor_path(current_season))
+
+    asyncio.run(_train_predictor())
+
+
+@app.command(name="export-battles")
+def export_battles(
+        season: SeasonOption = None,
+        rebuild: Annotated[
+            bool, typer.Option(help='If true, the store is exported from scratch instead of appended to')] = False,
+        lookback_minutes: Annotated[
+            float, typer.Option(help='Rescans the battles indexed up to this delay before the last exported one')] = 10,
+):
+    async def _export_battles():
+        current_season = await resolve_season(season)
+        directory = battle_store_path(current_season)
+        if rebuild and os.path.exists(directory):
+            shutil.rmtree(directory)
+        store = BattleStore(directory)
+
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            await commands.export_battles(indexer, current_season, store, lookback_minutes=lookback_minutes)
+        finally:
+            await client.close()
+
+    asyncio.run(_export_battles())
+
+
+@app.command(name="reindex-battles")
+def reindex_battles(
+        season: SeasonOption = None,
+        directory: Annotated[
+            Optional[str], typer.Option(help='The battle store, by default the one export-battles writes')] = None,
+        batch_size: Annotated[int, typer.Option(help='The number of battles indexed at once')] = 5000,
+        ingest_mode: IngestModeOption = True,
+):
+    """
+    Indexes the battles of a battle store (see export-battles) again, without calling the game api.
+    """
+    async def _reindex_battles():
+        current_season = await resolve_season(season)
+        store_directory = directory or battle_store_path(current_season)
+        if not os.path.exists(store_directory):
+            print(f'no battle store in {store_directory}, see export-battles')
+            return
+        store = BattleStore(store_directory)
+        unit_registry = UnitRegistry(filepath=os.path.join(os.getcwd(), "./data/static/units.json"))
+        artefact_registry = ArtefactRegistry(filepath=os.path.join(os.getcwd(), "./data/static/artefacts.json"))
+
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            await indexer.create_battle_index(season=current_season)
+            async with ingest_settings(indexer, current_season, ingest_mode):
+                await commands.reindex_battles(indexer, current_season, store, unit_registry, artefact_registry,
+                                               batch_size=batch_size)
+        finally:
+            await client.close()
+
+    asyncio.run(_reindex_battles())
+
+
+@app.command(name="backfill-names")
+def backfill_names(
+        season: SeasonOption = None,
+        batch_size: Annotated[int, typer.Option(help='The number of battles scanned and updated at once')] = 500,
+        max_updates_per_second: Annotated[
+            float, typer.Option(help='The maximum number of battles updated per second (0 for no limit)')] = 500,
+        resume: Annotated[
+            bool, typer.Option(help='If true, an interrupted run is resumed where it stopped')] = True,
+):
+    async def _backfill_names():
+        current_season = await resolve_season(season)
+        unit_registry = UnitRegistry(filepath=os.path.join(os.getcwd(), "./data/static/units.json"))
+        artefact_registry = ArtefactRegistry(filepath=os.path.join(os.getcwd(), "./data/static/artefacts.json"))
+        crawl_state = open_crawl_state("backfill_names", current_season, resume=resume)
+
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            await commands.backfill_unknown_names(indexer, current_season, unit_registry, artefact_registry,
+                                                  crawl_state=crawl_state, batch_size=batch_size,
+                                                  max_updates_per_second=max_updates_per_second)
+        finally:
+            crawl_state.close()
+            await client.close()
+
+    asyncio.run(_backfill_names())
+
+
+@app.command(name="optimize-seasons")
+def optimize_seasons(
+        season: SeasonOption = None,
+):
+    """
+    Makes the indices of the past seasons read-only, and force merges them.
+    """
+    async def _optimize_seasons():
+        current_season = await resolve_season(season)
+        client = create_client()
+        try:
+            indexer = create_indexer(client)
+            for past_season, optimized in sorted((await indexer.list_seasons()).items()):
+                if past_season == current_season or optimized:
+                    continue
+                print(f'optimizing season {past_season}...')
+                await indexer.optimize_season(past_season)
+        finally:
+            await client.close()
+
+    asyncio.run(_optimize_seasons())
+
+
+@app.command(name="serve")
+def serve(
+        season: SeasonOption = None,
+        host: Annotated[str, typer.Option(help='The address the query service listens on')] = "127.0.0.1",
+        port: Annotated[int, typer.Option(help='The port the query service listens on')] = 8080,
+        cache_ttl: Annotated[float, typer.Option(help='The delay the answers are cached for, in seconds')] = 30,
+        cache_size: Annotated[int, typer.Option(help='The maximum number of cached answers')] = 10000,
+        metrics_port: MetricsPortOption = 0,
+):
+    """
+    Serves read-only queries over the battles of the season (unit and pair win rates, player battles, meta) until
+    interrupted, from the aggregated draft stats when possible, and draft suggestions from the win predictor.
+    """
+    async def _serve():
+        current_season = await resolve_season(season)
+        unit_registry = UnitRegistry(filepath=os.path.join(os.getcwd(), "./data/static/units.json"))
+        client = create_client()
+        service = QueryService(create_indexer(client), current_season, unit_registry,
+                               QueryCache(ttl=cache_ttl, max_size=cache_size),
+                               draft_stats_path=draft_stats_path(current_season),
+                               win_predictor_path=win_predictor_path(current_season))
+        runner = await start_query_server(service, port, host)
+        try:
+            async with instrumentation(metrics_port, None, 10, None, None):
+                await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await client.close()
+
+    asyncio.run(_serve())
+
+
 if __name__ == "__main__":
     app()
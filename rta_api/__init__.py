@@ -1 +1,4 @@
-from .api import get_recommended_list, get_battle_list, get_hero_list, get_artifact_list
+from .api import get_recommended_list, get_battle_list, get_hero_list, get_artifact_list, get_static_file, StaticFile
+from .session import create_session
+from .rate_limiter import rate_limiter
+from .resilience import ApiError, retry_policy, circuit_breaker, call_stats
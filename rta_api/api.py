@@ -1,9 +1,17 @@
 import aiohttp
-import random
+import asyncio
+import json
+import time
+from typing import NamedTuple
 from .model import GetRecommendListRecommendedList, GetBattleListResponse, HeroList, ArtefactList
+from .rate_limiter import rate_limiter
+from .resilience import ApiError, retry_policy, circuit_breaker, call_stats
+from src.metrics import api_latency
 
 api_base_url = "https://epic7.gg.onstove.com/gameApi"
 static_assets_url = "https://static.smilegatemegaport.com"
+hero_list_path = "gameRecord/epic7/epic7_hero.json"
+artifact_list_path = "gameRecord/epic7/epic7_artifact.json"
 
 
 # https://sandbox-static.smilegatemegaport.com/gameRecord/epic7/epic7_user_world_global.json
@@ -11,10 +19,9 @@ static_assets_url = "https://static.smilegatemegaport.com"
 # https://sandbox-static.smilegatemegaport.com/event/qa/epic7/guide/images/hero/c1133_s.png
 
 async def get_recommended_list(session: aiohttp.ClientSession) -> "GetRecommendListRecommendedList":
-    async with session.post(f'{api_base_url}/getRecommendList') as request:
-        response = await request.json()
-        parsed = GetRecommendListRecommendedList(**response["result_body"])
-        return parsed
+    response = await _call_game_api(session, "getRecommendList")
+    parsed = GetRecommendListRecommendedList(**response["result_body"])
+    return parsed
 
 
 async def get_battle_list(session: aiohttp.ClientSession, user_id: int, world_code: str,
@@ -25,22 +32,87 @@ async def get_battle_list(session: aiohttp.ClientSession, user_id: int, world_co
         "lang": lang,
         "season_code": season_code,
     }
-    async with session.post(f'{api_base_url}/getBattleList', params=params) as request:
-        response = await request.json()
+    response = await _call_game_api(session, "getBattleList", params=params)
     parsed = GetBattleListResponse(**response)
     return parsed
 
 
+class StaticFile(NamedTuple):
+    """
+    A static asset, `content` is None when it was not modified since the given validators.
+    """
+    content: bytes | None
+    etag: str | None
+    last_modified: str | None
+
+
+async def get_static_file(session: aiohttp.ClientSession, path: str,
+                          etag: str | None = None, last_modified: str | None = None) -> "StaticFile":
+    """
+    Conditional GET of a static asset: with the validators of the previous response, an unchanged asset
+    is answered with a bodyless 304.
+    """
+    # caches on the way must revalidate with the origin, instead of serving a stale copy
+    headers = {"Cache-Control": "no-cache"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    async with session.get(f'{static_assets_url}/{path}', headers=headers) as request:
+        if request.status == 304:
+            return StaticFile(content=None, etag=etag, last_modified=last_modified)
+        if request.status != 200:
+            raise ApiError(status=request.status, url=str(request.url))
+        content = await request.read()
+        return StaticFile(
+            content=content,
+            etag=request.headers.get("ETag"),
+            last_modified=request.headers.get("Last-Modified"),
+        )
+
+
 async def get_hero_list(session: aiohttp.ClientSession) -> "HeroList":
-    cache_buster = random.randrange(100000)
-    async with session.get(f'{static_assets_url}/gameRecord/epic7/epic7_hero.json?_={cache_buster}') as request:
-        response = await request.json()
-        parsed = HeroList(**response)
-        return parsed
+    static_file = await get_static_file(session, hero_list_path)
+    return HeroList(**json.loads(static_file.content))
 
 
 async def get_artifact_list(session: aiohttp.ClientSession) -> "ArtefactList":
-    async with session.get(f'{static_assets_url}/gameRecord/epic7/epic7_artifact.json') as request:
-        response = await request.json()
-    parsed = ArtefactList(**response)
-    return parsed
+    static_file = await get_static_file(session, artifact_list_path)
+    return ArtefactList(**json.loads(static_file.content))
+
+
+async def _call_game_api(session: aiohttp.ClientSession, endpoint: str, params: dict | None = None) -> dict:
+    url = f'{api_base_url}/{endpoint}'
+    attempt = 0
+    while True:
+        await circuit_breaker.wait_until_closed()
+        await rate_limiter.acquire(url)
+
+        start = time.monotonic()
+        try:
+            async with session.post(url, params=params) as request:
+                if request.status != 200:
+                    raise ApiError(status=request.status, url=url)
+                response = await request.json()
+        except Exception as e:
+            record_call(endpoint, time.monotonic() - start, type(e).__name__)
+            retryable = retry_policy.is_retryable(e)
+            if retryable:
+                circuit_breaker.record(success=False)
+            attempt += 1
+            if not retryable or attempt >= retry_policy.max_attempts:
+                raise
+            await asyncio.sleep(retry_policy.delay(attempt))
+            continue
+
+        record_call(endpoint, time.monotonic() - start, "ok")
+        circuit_breaker.record(success=True)
+        return response
+
+
+def record_call(endpoint: str, latency: float, outcome: str):
+    """
+    Each attempt is measured once, for the run summary and the metrics registry.
+    """
+    call_stats.record(endpoint, latency, outcome)
+    api_latency.observe(latency, endpoint=endpoint)
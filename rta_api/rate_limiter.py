@@ -0,0 +1,66 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    A simple async token bucket: `rate` tokens are added per second, up to `capacity`.
+    """
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.__lock = asyncio.Lock()
+
+    async def acquire(self):
+        # the lock makes waiters queue in FIFO order instead of all waking up at the same time
+        async with self.__lock:
+            while True:
+                self.__refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class HostRateLimiter:
+    """
+    Keeps one token bucket per host, so that all the workers share the same request budget for a given api.
+    """
+    rate: float
+    burst: float
+    buckets: dict[str, TokenBucket]
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def configure(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    async def acquire(self, url: str):
+        host = urlsplit(url).netloc
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.rate, capacity=self.burst)
+            self.buckets[host] = bucket
+        await bucket.acquire()
+
+
+# shared by all the calls to the game api
+rate_limiter = HostRateLimiter(rate=10, burst=10)
@@ -0,0 +1,128 @@
+import aiohttp
+import asyncio
+import random
+import time
+from collections import deque
+
+
+class ApiError(Exception):
+    """
+    Raised when the game api answers with an unexpected http status.
+    """
+    status: int
+
+    def __init__(self, status: int, url: str):
+        super().__init__(f'api call to {url} failed with status {status}')
+        self.status = status
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, for throttled (429), server side (5xx) and network errors.
+    """
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 10):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, ApiError):
+            return error.status == 429 or error.status >= 500
+        return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Opens when the error rate over the last `window` seconds goes above `error_threshold`.
+
+    While open, every caller waits for the cooldown to expire, so all the workers pause together
+    instead of burning their retries against an api that is down.
+    """
+    window: float
+    error_threshold: float
+    min_calls: int
+    cooldown: float
+    opened_until: float
+
+    def __init__(self, window: float = 30, error_threshold: float = 0.5, min_calls: int = 10, cooldown: float = 15):
+        self.window = window
+        self.error_threshold = error_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.opened_until = 0
+        self.__outcomes: deque[tuple[float, bool]] = deque()
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.opened_until
+
+    async def wait_until_closed(self):
+        while self.is_open():
+            await asyncio.sleep(self.opened_until - time.monotonic())
+
+    def record(self, success: bool):
+        now = time.monotonic()
+        self.__outcomes.append((now, success))
+        while self.__outcomes and self.__outcomes[0][0] < now - self.window:
+            self.__outcomes.popleft()
+
+        if success or self.is_open() or len(self.__outcomes) < self.min_calls:
+            return
+        errors = sum(1 for _, ok in self.__outcomes if not ok)
+        if errors / len(self.__outcomes) >= self.error_threshold:
+            print(f'circuit breaker opened: {errors}/{len(self.__outcomes)} failed calls, pausing for {self.cooldown}s')
+            self.opened_until = now + self.cooldown
+            # start from a clean window when the circuit closes again
+            self.__outcomes.clear()
+
+
+class CallStats:
+    """
+    Per endpoint outcome counts of the api calls, and the latency of the last `max_samples` calls.
+    """
+    max_samples: int
+    latencies: dict[str, deque[float]]
+    outcomes: dict[str, dict[str, int]]
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.latencies = {}
+        self.outcomes = {}
+
+    def record(self, endpoint: str, latency: float, outcome: str):
+        latencies = self.latencies.get(endpoint)
+        if latencies is None:
+            latencies = self.latencies[endpoint] = deque(maxlen=self.max_samples)
+        latencies.append(latency)
+        endpoint_outcomes = self.outcomes.setdefault(endpoint, {})
+        endpoint_outcomes[outcome] = endpoint_outcomes.get(outcome, 0) + 1
+
+    def calls(self, endpoint: str) -> int:
+        return sum(self.outcomes.get(endpoint, {}).values())
+
+    def clear(self):
+        self.latencies.clear()
+        self.outcomes.clear()
+
+    def summary(self) -> str:
+        lines = []
+        for endpoint, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            p50 = ordered[len(ordered) // 2]
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            lines.append(
+                f'{endpoint}: {self.calls(endpoint)} calls, p50 {p50 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms '
+                f'(last {len(ordered)}), outcomes {self.outcomes[endpoint]}')
+        return "\n".join(lines)
+
+
+# shared by all the calls to the game api
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+call_stats = CallStats()
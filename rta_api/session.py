@@ -0,0 +1,25 @@
+import aiohttp
+
+
+def create_session(connection_limit: int = 100,
+                   connection_limit_per_host: int = 50,
+                   keepalive_timeout: float = 60,
+                   dns_cache_ttl: int = 300,
+                   request_timeout: float = 30) -> "aiohttp.ClientSession":
+    """
+    Creates the http session shared by all the workers of a command.
+
+    Connections are pooled and kept alive, so the workers don't pay the TLS handshake on every request.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+        use_dns_cache=True,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=request_timeout),
+    )
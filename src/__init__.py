@@ -1,4 +1,5 @@
 from .elasticsearch import create_client
 from .indexer import Indexer
 from .unit_registry import UnitRegistry
-from .artefact_registry import ArtefactRegistry
\ No newline at end of file
+from .artefact_registry import ArtefactRegistry
+from .known_players import KnownPlayers
@@ -1,5 +1,10 @@
-import pydantic
 import json
+import sys
+
+import numpy as np
+import pydantic
+
+from src.utils import file_version, read_only
 
 
 class Artefact(pydantic.BaseModel):
@@ -8,18 +13,53 @@ class Artefact(pydantic.BaseModel):
 
 
 class ArtefactRegistry:
-    registry: dict[str, Artefact] = {}
+    """
+    Immutable registry of the artifacts of `artefacts.json`, with a dense index per artifact (in file order),
+    as for the `UnitRegistry`.
+    """
+    filepath: str
+    # version of the file the registry was loaded from
+    version: tuple[int, int, int]
+    ids: np.ndarray
+    names: np.ndarray
 
     def __init__(self, filepath: str):
-        self.__load(filepath)
-
-    def name_from_id(self, unit_id: str):
-        if unit_id in self.registry:
-            return self.registry[unit_id].name
-        return None
-
-    def __load(self, filepath: str):
-        with open(filepath, "r") as unit_file:
-            data: dict = json.load(unit_file)
-            for key, value in data.items():
-                self.registry[key] = Artefact(**value)
+        self.filepath = filepath
+        self.version = file_version(filepath)
+        with open(filepath, "r") as artefact_file:
+            data: dict = json.load(artefact_file)
+
+        artefacts = list(data.values())
+        self.ids = read_only(np.array([sys.intern(artefact["id"]) for artefact in artefacts], dtype=object))
+        self.names = read_only(np.array([sys.intern(artefact["name"]) for artefact in artefacts], dtype=object))
+        self.__index = {artefact_id: index for index, artefact_id in enumerate(self.ids)}
+        self.__names = dict(zip(self.ids, self.names))
+
+    def reloaded(self) -> "ArtefactRegistry":
+        """
+        A registry of the current file if it changed since this one was loaded, else this registry.
+        """
+        if file_version(self.filepath) == self.version:
+            return self
+        return ArtefactRegistry(self.filepath)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, artefact_id: str) -> bool:
+        return artefact_id in self.__index
+
+    def index_of(self, artefact_id: str) -> int:
+        """
+        Dense index of the artifact, -1 if unknown.
+        """
+        return self.__index.get(artefact_id, -1)
+
+    def encode(self, artefact_ids: list[str]) -> np.ndarray:
+        return np.array([self.__index.get(artefact_id, -1) for artefact_id in artefact_ids], dtype=np.int32)
+
+    def name_from_id(self, artefact_id: str) -> str | None:
+        return self.__names.get(artefact_id)
+
+    def artefact(self, index: int) -> Artefact:
+        return Artefact(id=self.ids[index], name=self.names[index])
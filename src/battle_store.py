@@ -0,0 +1,360 @@
+import json
+import os
+from typing import Iterator
+
+import numpy as np
+
+from src.artefact_registry import ArtefactRegistry
+from src.constants import UNKNOWN_NAME
+from src.unit_registry import UnitRegistry
+
+store_version = 2
+max_equipped_sets = 4
+team_size = 5
+# the combat readiness of each unit at the start of the battle
+max_cr_positions = 2 * team_size
+
+# name, dtype, shape of a row, dictionary of the values (for the dictionary encoded columns)
+columns = [
+    ("schema_version", "int8", (), None),
+    ("battle_id", "int64", (), None),
+    ("season", "int16", (), "season"),
+    ("battle_date", "int64", (), None),
+    ("turn_count", "int16", (), None),
+    ("p1_id", "int64", (), None),
+    ("p2_id", "int64", (), None),
+    ("p1_world", "int16", (), "world"),
+    ("p2_world", "int16", (), "world"),
+    ("p1_grade", "int16", (), "grade"),
+    ("p2_grade", "int16", (), "grade"),
+    ("p1_win", "bool", (), None),
+    # both are false for a draw
+    ("p2_win", "bool", (), None),
+    ("p1_prebans", "int16", (2,), "unit"),
+    ("p2_prebans", "int16", (2,), "unit"),
+    ("p1_postban", "int16", (), "unit"),
+    ("p2_postban", "int16", (), "unit"),
+    ("p1_postban_position", "int8", (), None),
+    ("p2_postban_position", "int8", (), None),
+    ("p1_picks", "int16", (team_size,), "unit"),
+    ("p2_picks", "int16", (team_size,), "unit"),
+    # `units_details`, flattened: p1's units then p2's, in pick order
+    # (the documents list the units of the player whose battle list they came from first)
+    ("details_p2_first", "bool", (), None),
+    ("details_unit", "int16", (2 * team_size,), "unit"),
+    ("details_pick_order", "int8", (2 * team_size,), None),
+    ("details_artifact", "int16", (2 * team_size,), "artifact"),
+    ("details_role", "int16", (2 * team_size,), "role"),
+    ("details_sets", "int16", (2 * team_size, max_equipped_sets), "set"),
+    ("details_position", "int8", (2 * team_size,), None),
+    ("details_mvp", "bool", (2 * team_size,), None),
+    # `initial_cr_position`
+    ("cr_unit", "int16", (max_cr_positions,), "unit"),
+    ("cr_energy", "int16", (max_cr_positions,), None),
+    ("cr_team", "int8", (max_cr_positions,), None),
+    ("cr_position", "int8", (max_cr_positions,), None),
+]
+# fields of the battle documents stored in the columns, the others are derived from them (see `BattleStore.battles`)
+battle_source_fields = [
+    "schema_version", "battle_id", "season_code", "battle_date", "turn_count",
+    "p1_id", "p2_id", "p1_world", "p2_world", "p1_grade", "p2_grade", "p1_win", "p2_win",
+    "p1_prebans", "p2_prebans", "p1_postban", "p2_postban", "p1_postban_position", "p2_postban_position",
+    "p1_picks", "p2_picks", "units_details", "initial_cr_position",
+]
+
+
+class BattleStore:
+    """
+    Append-only columnar store of battles, in a directory: one raw file per column (rows of a fixed shape),
+    and a `meta.json` holding the number of rows and the dictionaries of the encoded columns.
+
+    Unit, artifact, world, grade, role and set codes are dictionary encoded as int16 (-1 for missing values),
+    so a season fits in a few hundred bytes per battle, and the columns are read back as memory-mapped arrays:
+    a scan only touches the columns it needs, and the pages are shared with the os cache.
+
+    Each unit of a battle is stored once, and `battles` expands the rows back to the battle documents, with the names
+    of the current registries, so an archived season can be indexed again without the game api.
+
+    The rows are only committed once `meta.json` is written, so an interrupted append is rolled back
+    on the next open.
+    """
+    directory: str
+    row_count: int
+    last_battle_date: int
+    # the most recent indexing time of the battles appended (timestamp), the watermark of the next export
+    last_indexed_at: int
+    dictionaries: dict[str, list[str]]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.__specs = {name: (np.dtype(dtype), shape, dictionary) for name, dtype, shape, dictionary in columns}
+        self.__codes: dict[str, dict[str, int]] = {}
+        self.row_count = 0
+        self.last_battle_date = 0
+        self.last_indexed_at = 0
+        self.dictionaries = {}
+
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+            if meta["version"] != store_version:
+                raise ValueError(f'unsupported battle store version {meta["version"]} in {directory}, '
+                                 f'export the battles again with --rebuild')
+            self.row_count = meta["row_count"]
+            self.last_battle_date = meta["last_battle_date"]
+            self.last_indexed_at = meta.get("last_indexed_at", 0)
+            self.dictionaries = meta["dictionaries"]
+        for dictionary in {spec[2] for spec in self.__specs.values() if spec[2] is not None}:
+            values = self.dictionaries.setdefault(dictionary, [])
+            self.__codes[dictionary] = {value: code for code, value in enumerate(values)}
+
+        # drop the rows of an interrupted append
+        for name in self.__specs:
+            path = self.__column_path(name)
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            committed_size = self.row_count * self.__row_size(name)
+            if os.path.getsize(path) != committed_size:
+                os.truncate(path, committed_size)
+
+    def __len__(self):
+        return self.row_count
+
+    # READ
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        The column as a read-only memory-mapped array of (rows, *row shape).
+        """
+        dtype, shape, _ = self.__specs[name]
+        if self.row_count == 0:
+            return np.zeros((0, *shape), dtype=dtype)
+        return np.memmap(self.__column_path(name), dtype=dtype, mode="r", shape=(self.row_count, *shape))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.column(name)
+
+    def decode(self, dictionary: str, codes: np.ndarray) -> np.ndarray:
+        """
+        Values of the codes of a dictionary encoded column (None for the missing ones).
+        """
+        values = np.array(self.dictionaries[dictionary] + [None], dtype=object)
+        # -1 picks the trailing None
+        return values[codes]
+
+    def code(self, dictionary: str, value: str) -> int:
+        return self.__codes[dictionary].get(value, -1)
+
+    def battles(self, unit_registry: UnitRegistry, artefact_registry: ArtefactRegistry, start: int = 0,
+                stop: int | None = None, batch_size: int = 5000) -> Iterator[dict]:
+        """
+        Expands the rows back to battle documents, as `convert_raw_battle_source` converts them with these registries
+        (except for the order of `prebans`, built from a set there).
+
+        The unit objects are shared by the documents of a batch: copy them before modifying them.
+        """
+        stop = self.row_count if stop is None else min(stop, self.row_count)
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            # plain python values, decoding them one by one from numpy scalars is much slower
+            rows = {name: self.column(name)[batch_start:batch_stop].tolist() for name in self.__specs}
+            values = {dictionary: self.dictionaries[dictionary] for dictionary in ["season", "world", "grade", "role",
+                                                                                    "set", "artifact"]}
+            unit_ids = self.dictionaries["unit"]
+            units = [{"id": unit_id, "name": unit_registry.name_from_id(unit_id) or UNKNOWN_NAME}
+                     for unit_id in unit_ids]
+            detail_names = [unit_registry.name_from_id(unit_id) for unit_id in unit_ids]
+            artifact_names = [artefact_registry.name_from_id(artifact_id) or UNKNOWN_NAME
+                              for artifact_id in values["artifact"]]
+            for row in range(batch_stop - batch_start):
+                yield self.__expand(rows, row, values, units, detail_names, artifact_names)
+
+    def __expand(self, rows: dict[str, list], row: int, values: dict[str, list[str]], units: list[dict],
+                 detail_names: list[str | None], artifact_names: list[str]) -> dict:
+        def unit_list(codes: list[int]) -> list[dict]:
+            return [units[code] for code in codes if code >= 0]
+
+        battle = {
+            "schema_version": rows["schema_version"][row],
+            "battle_id": rows["battle_id"][row],
+            "season_code": values["season"][rows["season"][row]],
+            "turn_count": rows["turn_count"][row],
+            "battle_date": rows["battle_date"][row],
+            # p1 is the first picker
+            "p1_first_pick": True,
+            "p2_first_pick": False,
+        }
+        for side in ["p1", "p2"]:
+            battle[f'{side}_id'] = rows[f'{side}_id'][row]
+            battle[f'{side}_world'] = values["world"][rows[f'{side}_world'][row]]
+            battle[f'{side}_grade'] = values["grade"][rows[f'{side}_grade'][row]]
+            battle[f'{side}_win'] = rows[f'{side}_win'][row]
+            battle[f'{side}_prebans'] = unit_list(rows[f'{side}_prebans'][row])
+            postban = rows[f'{side}_postban'][row]
+            battle[f'{side}_postban'] = units[postban] if postban >= 0 else None
+            position = rows[f'{side}_postban_position'][row]
+            battle[f'{side}_postban_position'] = position if position >= 0 else None
+            picks = unit_list(rows[f'{side}_picks'][row])
+            battle[f'{side}_picks'] = picks
+            for n in range(team_size):
+                battle[f'{side}_pick{n + 1}'] = picks[n] if len(picks) > n else None
+        battle["prebans"] = list({unit["id"]: unit for unit in battle["p1_prebans"] + battle["p2_prebans"]}.values())
+        p1_picks, p2_picks = battle["p1_picks"], battle["p2_picks"]
+        battle["p1_picks_stage1"], battle["p1_picks_stage2"], battle["p1_picks_stage3"] = \
+            p1_picks[0:1], p1_picks[1:3], p1_picks[3:5]
+        battle["p2_picks_stage1"], battle["p2_picks_stage2"], battle["p2_picks_stage3"] = \
+            p2_picks[0:2], p2_picks[2:4], p2_picks[4:5]
+
+        details = []
+        for position, code in enumerate(rows["details_unit"][row]):
+            if code < 0:
+                continue
+            artifact = rows["details_artifact"][row][position]
+            details.append({
+                "id": units[code]["id"],
+                "name": detail_names[code],
+                "pick_order": rows["details_pick_order"][row][position],
+                "equipped_sets": [values["set"][equipped] for equipped in rows["details_sets"][row][position]
+                                  if equipped >= 0],
+                "artifact_id": values["artifact"][artifact],
+                "artifact_name": artifact_names[artifact],
+                "mvp": rows["details_mvp"][row][position],
+                "position": rows["details_position"][row][position],
+                "role": values["role"][rows["details_role"][row][position]],
+            })
+        if rows["details_p2_first"][row]:
+            p1_ids = {unit["id"] for unit in p1_picks}
+            p1_count = sum(1 for detail in details if detail["id"] in p1_ids)
+            details = details[p1_count:] + details[:p1_count]
+        battle["units_details"] = details
+
+        battle["initial_cr_position"] = [
+            {
+                "hero_code": units[code]["id"],
+                "energy": rows["cr_energy"][row][position],
+                "team": str(rows["cr_team"][row][position]),
+                "position_no": str(rows["cr_position"][row][position]),
+            }
+            for position, code in enumerate(rows["cr_unit"][row])
+            if code >= 0
+        ]
+        return battle
+
+    # WRITE
+
+    def append(self, battles: list[dict]) -> int:
+        """
+        Appends the battles that are not stored yet, returns their number.
+        """
+        if len(battles) == 0:
+            return 0
+        last_indexed_at = max(self.last_indexed_at, max(battle.get("indexed_at") or 0 for battle in battles))
+        battle_ids = np.array([battle["battle_id"] for battle in battles], dtype=np.int64)
+        unique_ids, first_positions = np.unique(battle_ids, return_index=True)
+        new_positions = np.sort(first_positions[~np.isin(unique_ids, self.column("battle_id"))])
+        if len(new_positions) == 0:
+            if last_indexed_at > self.last_indexed_at:
+                self.last_indexed_at = last_indexed_at
+                self.__write_meta()
+            return 0
+        new_battles = [battles[position] for position in new_positions]
+
+        arrays = {name: np.full((len(new_battles), *shape), -1 if dtype.kind == "i" else 0, dtype=dtype)
+                  for name, (dtype, shape, _) in self.__specs.items()}
+        for row, battle in enumerate(new_battles):
+            self.__encode_battle(battle, row, arrays)
+
+        for name, array in arrays.items():
+            with open(self.__column_path(name), "ab") as column_file:
+                column_file.write(array.tobytes())
+                column_file.flush()
+                # the rows must be on disk before the meta that commits them
+                os.fsync(column_file.fileno())
+        self.row_count += len(new_battles)
+        self.last_battle_date = max(self.last_battle_date, int(arrays["battle_date"].max()))
+        self.last_indexed_at = last_indexed_at
+        self.__write_meta()
+        return len(new_battles)
+
+    def __encode_battle(self, battle: dict, row: int, arrays: dict[str, np.ndarray]):
+        code = self.__encode
+        details = battle.get("units_details") or []
+        cr_positions = battle.get("initial_cr_position") or []
+        # the rows have a fixed shape, and the store must not lose anything
+        if (len(details) > 2 * team_size or len(cr_positions) > max_cr_positions
+                or any(len(battle[f'{side}_picks']) > team_size or len(battle[f'{side}_prebans']) > 2
+                       for side in ["p1", "p2"])
+                or any(len(detail["equipped_sets"]) > max_equipped_sets for detail in details)):
+            raise ValueError(f'battle {battle["battle_id"]} does not fit in a battle store row')
+
+        for name in ["schema_version", "battle_id", "battle_date", "turn_count", "p1_id", "p2_id", "p1_win", "p2_win"]:
+            arrays[name][row] = battle[name]
+        arrays["season"][row] = code("season", battle["season_code"])
+        for name in ["p1_postban_position", "p2_postban_position"]:
+            if battle.get(name) is not None:
+                arrays[name][row] = battle[name]
+        for side in ["p1", "p2"]:
+            arrays[f'{side}_world'][row] = code("world", battle[f'{side}_world'])
+            arrays[f'{side}_grade'][row] = code("grade", battle[f'{side}_grade'])
+            postban = battle.get(f'{side}_postban')
+            if postban is not None:
+                arrays[f'{side}_postban'][row] = code("unit", postban["id"])
+            for field in ["prebans", "picks"]:
+                units = battle[f'{side}_{field}']
+                arrays[f'{side}_{field}'][row, :len(units)] = [code("unit", unit["id"]) for unit in units]
+
+        # p1's units first (a unit can only be picked by one of the players), then by pick order
+        p1_ids = {unit["id"] for unit in battle["p1_picks"]}
+        arrays["details_p2_first"][row] = len(details) > 0 and details[0]["id"] not in p1_ids
+        details = sorted(details, key=lambda detail: (detail["id"] not in p1_ids, detail["pick_order"]))
+        for position, detail in enumerate(details):
+            arrays["details_unit"][row, position] = code("unit", detail["id"])
+            arrays["details_pick_order"][row, position] = detail["pick_order"]
+            arrays["details_artifact"][row, position] = code("artifact", detail["artifact_id"])
+            arrays["details_role"][row, position] = code("role", detail["role"])
+            sets = detail["equipped_sets"]
+            arrays["details_sets"][row, position, :len(sets)] = [code("set", equipped) for equipped in sets]
+            arrays["details_position"][row, position] = detail["position"]
+            arrays["details_mvp"][row, position] = detail["mvp"]
+
+        for position, cr_position in enumerate(cr_positions):
+            arrays["cr_unit"][row, position] = code("unit", cr_position["hero_code"])
+            arrays["cr_energy"][row, position] = cr_position["energy"]
+            arrays["cr_team"][row, position] = int(cr_position["team"])
+            arrays["cr_position"][row, position] = int(cr_position["position_no"])
+
+    def __encode(self, dictionary: str, value: str | None) -> int:
+        if value is None:
+            return -1
+        codes = self.__codes[dictionary]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.dictionaries[dictionary])
+            self.dictionaries[dictionary].append(value)
+        return code
+
+    def __write_meta(self):
+        meta_path = os.path.join(self.directory, "meta.json")
+        temporary_path = f'{meta_path}.tmp'
+        with open(temporary_path, "w") as meta_file:
+            json.dump({
+                "version": store_version,
+                "row_count": self.row_count,
+                "last_battle_date": self.last_battle_date,
+                "last_indexed_at": self.last_indexed_at,
+                "columns": {name: {"dtype": dtype, "shape": shape, "dictionary": dictionary}
+                            for name, dtype, shape, dictionary in columns},
+                "dictionaries": self.dictionaries,
+            }, meta_file)
+            meta_file.flush()
+            os.fsync(meta_file.fileno())
+        os.replace(temporary_path, meta_path)
+
+    def __column_path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def __row_size(self, name: str) -> int:
+        dtype, shape, _ = self.__specs[name]
+        return dtype.itemsize * int(np.prod(shape, dtype=np.int64))
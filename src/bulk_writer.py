@@ -0,0 +1,121 @@
+import asyncio
+import time
+from elasticsearch import AsyncElasticsearch, helpers
+from src.metrics import bulk_failed_actions, bulk_latency, bulk_size
+
+
+class BulkWriter:
+    """
+    Buffers bulk actions coming from all the workers, and sends them in shared bulk requests.
+
+    Pending actions are flushed as soon as the previous bulk request is done, after waiting at most `flush_interval`
+    seconds for other actions to join (or until `max_actions` are pending). So the requests stay small and fast
+    under low load, and grow with the load, as the actions submitted while a request is in flight join the next one.
+
+    Callers get back the success of each of their own actions once the bulk request is done. Updates submitted with
+    `missing_ok` succeed when their document does not exist.
+    """
+    client: AsyncElasticsearch
+    max_actions: int
+    flush_interval: float
+
+    def __init__(self, client: AsyncElasticsearch, max_actions: int = 1000, flush_interval: float = 0.05):
+        self.client = client
+        self.max_actions = max_actions
+        self.flush_interval = flush_interval
+        self.__pending: list[tuple[dict, bool, asyncio.Future]] = []
+        self.__has_pending = asyncio.Event()
+        self.__full = asyncio.Event()
+        self.__task: asyncio.Task | None = None
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+        await self.flush()
+
+    async def submit(self, actions: list[dict], missing_ok: bool = False) -> list[bool]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for action in actions:
+            future = loop.create_future()
+            self.__pending.append((action, missing_ok, future))
+            futures.append(future)
+        if len(futures) > 0:
+            self.__has_pending.set()
+        if len(self.__pending) >= self.max_actions:
+            self.__full.set()
+        return list(await asyncio.gather(*futures))
+
+    async def flush(self):
+        pending = self.__pending
+        self.__pending = []
+        self.__has_pending.clear()
+        self.__full.clear()
+        if len(pending) == 0:
+            return
+
+        results = [False] * len(pending)
+        try:
+            results = await stream_bulk(self.client, [action for action, _, _ in pending],
+                                        missing_ok=[missing_ok for _, missing_ok, _ in pending])
+        finally:
+            for (_, _, future), success in zip(pending, results):
+                if not future.done():
+                    future.set_result(success)
+
+    async def __run(self):
+        while True:
+            await self.__has_pending.wait()
+            # give the other workers a chance to join the same request
+            try:
+                await asyncio.wait_for(self.__full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'error flushing bulk actions: {e}')
+
+
+async def stream_bulk(client: AsyncElasticsearch, actions: list[dict],
+                      missing_ok: list[bool] | None = None) -> list[bool]:
+    """
+    Sends the actions in one streaming bulk call and returns the success of each action, in order.
+    The updates flagged in `missing_ok` succeed when their document does not exist.
+    """
+    results = [False] * len(actions)
+    first_error = None
+    start = time.perf_counter()
+    try:
+        position = 0
+        async for ok, item in helpers.async_streaming_bulk(
+                client,
+                actions,
+                chunk_size=max(len(actions), 1),
+                raise_on_error=False,
+                raise_on_exception=False,
+        ):
+            # creating a document that already exists is not an error for us
+            if not ok and item.get("create", {}).get("status") == 409:
+                ok = True
+            # nor updating a missing document, for the callers that allow it
+            if (not ok and missing_ok is not None and missing_ok[position]
+                    and item.get("update", {}).get("status") == 404):
+                ok = True
+            results[position] = ok
+            if not ok and first_error is None:
+                first_error = item
+            position += 1
+    except Exception as e:
+        first_error = e
+    bulk_latency.observe(time.perf_counter() - start)
+    bulk_size.observe(len(actions))
+    if first_error is not None:
+        bulk_failed_actions.inc(results.count(False))
+        print(f'{results.count(False)} of {len(actions)} bulk actions failed, first error: {first_error}')
+    return results
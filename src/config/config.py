@@ -0,0 +1,12 @@
+import os
+import yaml
+
+default_config_path = os.path.join(os.path.dirname(__file__), "../../config/config.yaml")
+
+
+def load_config(filepath: str = default_config_path) -> dict:
+    """
+    Loads the flat `key: value` yaml config file (e.g `elastic.user: elastic`)
+    """
+    with open(filepath, "r") as config_file:
+        return yaml.safe_load(config_file) or {}
@@ -1 +1,2 @@
 from .player_ranks import RANK_CHAMPION, RANK_LEGEND, RANK_EMPEROR, ALLOWED_PLAYER_RANKS
+from .names import UNKNOWN_NAME
@@ -0,0 +1,2 @@
+# name stored in the battles for the units and artifacts missing from the registries when they were converted
+UNKNOWN_NAME = "Unknown"
@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class CrawlState:
+    """
+    On-disk state of a crawl (its frontier, leases and completed tasks, plus the results gathered so far),
+    stored in a SQLite database in WAL mode, so that an interrupted run can be resumed where it stopped.
+    """
+    filepath: str
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.__connection = sqlite3.connect(filepath)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only risks losing the last transactions on power loss, never corrupting the database
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                position INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, position);
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL
+            );
+        """)
+        self.__position = self.__connection.execute("SELECT COALESCE(MAX(position), 0) FROM tasks").fetchone()[0]
+
+    def close(self):
+        self.__connection.close()
+
+    def add_task(self, key: str, payload: dict) -> bool:
+        """
+        Adds a pending task to the frontier, returns False if the task was already known (whatever its status).
+        """
+        self.__position += 1
+        cursor = self.__connection.execute(
+            "INSERT OR IGNORE INTO tasks (key, payload, status, position) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(payload), STATUS_PENDING, self.__position))
+        self.__connection.commit()
+        return cursor.rowcount > 0
+
+    def lease_task(self, key: str):
+        self.__set_status(key, STATUS_LEASED)
+
+    def complete_task(self, key: str):
+        self.__set_status(key, STATUS_DONE)
+
+    def fail_task(self, key: str):
+        self.__set_status(key, STATUS_FAILED)
+
+    def unfinished_tasks(self) -> list[dict]:
+        """
+        Returns the pending tasks, and the tasks that were leased by a run that did not complete them.
+        """
+        rows = self.__connection.execute(
+            "SELECT payload FROM tasks WHERE status IN (?, ?) ORDER BY position",
+            (STATUS_PENDING, STATUS_LEASED))
+        return [json.loads(payload) for (payload,) in rows]
+
+    def all_tasks(self) -> list[dict]:
+        rows = self.__connection.execute("SELECT payload FROM tasks ORDER BY position")
+        return [json.loads(payload) for (payload,) in rows]
+
+    def has_unfinished_tasks(self) -> bool:
+        row = self.__connection.execute(
+            "SELECT 1 FROM tasks WHERE status IN (?, ?) LIMIT 1", (STATUS_PENDING, STATUS_LEASED)).fetchone()
+        return row is not None
+
+    def count_tasks(self) -> int:
+        return self.__connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def add_result(self, key: str, payload: dict):
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO results (key, payload) VALUES (?, ?)", (key, json.dumps(payload)))
+        self.__connection.commit()
+
+    def result(self, key: str) -> dict | None:
+        row = self.__connection.execute("SELECT payload FROM results WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def has_results(self) -> bool:
+        return self.__connection.execute("SELECT 1 FROM results LIMIT 1").fetchone() is not None
+
+    def results(self) -> list[dict]:
+        rows = self.__connection.execute("SELECT payload FROM results")
+        return [json.loads(payload) for (payload,) in rows]
+
+    def clear(self):
+        self.__connection.execute("DELETE FROM tasks")
+        self.__connection.execute("DELETE FROM results")
+        self.__connection.commit()
+        self.__position = 0
+
+    def __set_status(self, key: str, status: str):
+        self.__connection.execute("UPDATE tasks SET status = ? WHERE key = ?", (status, key))
+        self.__connection.commit()
@@ -0,0 +1,280 @@
+import math
+import struct
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+
+from src.draft_stats import DraftStats
+from src.win_predictor import Draft, WinPredictor
+
+# who picks next, after N picks: p1 (the first picker) picks 1, then 2 each, and p2 picks the last unit
+pick_order = ["p1", "p2", "p2", "p1", "p1", "p2", "p2", "p1", "p1", "p2"]
+prebans_per_player = 2
+
+ACTION_PREBAN = "preban"
+ACTION_PICK = "pick"
+ACTION_POSTBAN = "postban"
+
+
+class DraftState(NamedTuple):
+    """
+    A draft, with units as predictor indexes (-1 for no postban yet). Hashable, so it is the key of the search cache.
+    """
+    p1_picks: tuple[int, ...]
+    p2_picks: tuple[int, ...]
+    p1_prebans: tuple[int, ...]
+    p2_prebans: tuple[int, ...]
+    # the p1 unit banned by p2, and the p2 unit banned by p1
+    p1_postban: int
+    p2_postban: int
+
+
+def next_action(state: DraftState) -> tuple[str, str] | None:
+    """
+    The (side, action) that comes next, None once the draft is complete. Prebans and postbans are simultaneous
+    in game, they are handled as p1 then p2 here.
+    """
+    if len(state.p1_prebans) < prebans_per_player:
+        return "p1", ACTION_PREBAN
+    if len(state.p2_prebans) < prebans_per_player:
+        return "p2", ACTION_PREBAN
+    pick_count = len(state.p1_picks) + len(state.p2_picks)
+    if pick_count < len(pick_order):
+        return pick_order[pick_count], ACTION_PICK
+    if state.p2_postban < 0:
+        return "p1", ACTION_POSTBAN
+    if state.p1_postban < 0:
+        return "p2", ACTION_POSTBAN
+    return None
+
+
+def apply_action(state: DraftState, side: str, action: str, unit: int) -> DraftState:
+    if action == ACTION_PREBAN:
+        field = f'{side}_prebans'
+        return state._replace(**{field: getattr(state, field) + (unit,)})
+    if action == ACTION_PICK:
+        field = f'{side}_picks'
+        return state._replace(**{field: getattr(state, field) + (unit,)})
+    # a player bans one of the opponent's units
+    return state._replace(p2_postban=unit) if side == "p1" else state._replace(p1_postban=unit)
+
+
+def state_key(state: DraftState, depth: int) -> bytes:
+    """
+    Cache key of a state: the order of the units within a turn does not matter (except for the first pick),
+    and bytes are not tracked by the garbage collector, unlike tuples, so a large cache does not slow its passes.
+    """
+    p1_picks = state.p1_picks[:1] + tuple(sorted(state.p1_picks[1:]))
+    units = (depth, len(p1_picks), *p1_picks, *sorted(state.p2_picks), -1, *sorted(state.p1_prebans), -1,
+             *sorted(state.p2_prebans), state.p1_postban, state.p2_postban)
+    return struct.pack(f'{len(units)}h', *units)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class DraftAssistant:
+    """
+    Ranks the next picks or bans of a draft by expected win rate of the side to play.
+
+    The win predictor is additive, so the p1 win logit of each candidate is the current logit plus the candidate's
+    weight, computed for all the units at once. When `stats` are provided, the unit pair synergies and counters add
+    interaction terms to the logit (for the picks only).
+
+    Candidates are then refined by a depth limited lookahead, where each side plays its best reply (which captures
+    e.g. denying a strong unit to the opponent): only the `beam_width` best candidates of each node are explored,
+    and the lookahead gain of each (state, depth) is memoized in an LRU cache shared by the calls.
+    The lookahead is deepened until the `time_budget` is spent, checked before each candidate: when a depth does not
+    complete in time, the candidates it searched keep their deeper value, and the others the value of the previous
+    depth.
+    """
+    predictor: WinPredictor
+    beam_width: int
+    max_depth: int
+    time_budget: float
+    cache_size: int
+
+    def __init__(self,
+                 predictor: WinPredictor,
+                 stats: DraftStats | None = None,
+                 interaction_weight: float = 1.0,
+                 beam_width: int = 6,
+                 max_depth: int = 3,
+                 time_budget: float = 0.005,
+                 cache_size: int = 200000):
+        self.predictor = predictor
+        self.beam_width = beam_width
+        self.max_depth = max_depth
+        self.time_budget = time_budget
+        self.cache_size = cache_size
+        self.__cache: OrderedDict[bytes, float] = OrderedDict()
+        self.__deadline = math.inf
+
+        num_units = len(predictor.unit_ids)
+        weights = predictor.weights.astype(np.float64)
+        self.__pick_weights = weights[predictor.pick_offset:predictor.pick_offset + num_units]
+        self.__first_pick_weights = weights[predictor.first_pick_offset:predictor.first_pick_offset + num_units]
+        self.__preban_weights = weights[predictor.preban_offset:predictor.preban_offset + num_units]
+        self.__postban_weights = weights[predictor.postban_offset:predictor.postban_offset + num_units]
+
+        self.__synergy = None
+        self.__counter = None
+        if stats is not None:
+            # align the stats matrices on the predictor's unit indexes, units unknown to the stats have no interaction
+            stats_indexes = stats.encode(predictor.unit_ids)
+            known = stats_indexes >= 0
+            aligned = np.ix_(stats_indexes.clip(0), stats_indexes.clip(0))
+            mask = np.outer(known, known)
+            counter = stats.counter_matrix()
+            # interactions are in win rate points, scale them to logits around 50%
+            self.__synergy = np.where(mask, stats.synergy_matrix()[aligned], 0) * 4 * interaction_weight
+            self.__counter = np.where(mask, ((counter - counter.T) / 2)[aligned], 0) * 4 * interaction_weight
+
+    def encode_state(self, draft: Draft) -> DraftState:
+        unit_index = self.predictor.unit_index
+
+        def indexes(unit_ids: list[str] | None) -> tuple[int, ...]:
+            return tuple(unit_index[unit_id] for unit_id in unit_ids or [] if unit_id in unit_index)
+
+        def index(unit_id: str | None) -> int:
+            return unit_index.get(unit_id, -1) if unit_id is not None else -1
+
+        return DraftState(
+            p1_picks=indexes(draft.get("p1_picks")),
+            p2_picks=indexes(draft.get("p2_picks")),
+            p1_prebans=indexes(draft.get("p1_prebans")),
+            p2_prebans=indexes(draft.get("p2_prebans")),
+            p1_postban=index(draft.get("p1_postban")),
+            p2_postban=index(draft.get("p2_postban")),
+        )
+
+    def suggest(self, draft: Draft, top_n: int = 5) -> dict:
+        """
+        Returns the side to play, its action, and its `top_n` best units with the expected win rate after them.
+        """
+        start = time.perf_counter()
+        state = self.encode_state(draft)
+        action = next_action(state)
+        if action is None:
+            return {"side": None, "action": None, "suggestions": []}
+        side, kind = action
+
+        logit = float(self.predictor.logits(*self.predictor.encode([draft]))[0]) + self.__interactions(state)
+        candidates, deltas = self.__candidates(state, side, kind)
+        sign = 1 if side == "p1" else -1
+        order = np.argsort(-sign * deltas)[:max(top_n, self.beam_width)]
+        values = logit + deltas[order]
+
+        # iterative deepening, until the time budget is spent
+        self.__deadline = start + self.time_budget
+        for depth in range(2, self.max_depth + 1):
+            deeper_values = values.copy()
+            try:
+                # best candidates first, so that a depth cut short has refined the ones that matter
+                for index in np.argsort(-sign * values):
+                    if time.perf_counter() > self.__deadline:
+                        raise SearchTimeout()
+                    position = order[index]
+                    deeper_values[index] = self.__search(apply_action(state, side, kind, int(candidates[position])),
+                                                         logit + float(deltas[position]), depth)
+            except SearchTimeout:
+                values = deeper_values
+                break
+            values = deeper_values
+
+        ranking = np.argsort(-sign * values)[:top_n]
+        unit_ids = self.predictor.unit_ids
+        return {
+            "side": side,
+            "action": kind,
+            "suggestions": [
+                {
+                    "unit_id": unit_ids[int(candidates[order[position]])],
+                    "win_rate": _sigmoid(sign * float(values[position])),
+                }
+                for position in ranking
+            ],
+        }
+
+    def __search(self, state: DraftState, logit: float, depth: int) -> float:
+        """
+        p1 win logit of the state after `depth` more actions, where each side plays its best reply.
+        """
+        action = next_action(state)
+        if depth <= 1 or action is None:
+            return logit
+        key = state_key(state, depth)
+        gain = self.__cache.get(key)
+        if gain is not None:
+            self.__cache.move_to_end(key)
+            return logit + gain
+
+        side, kind = action
+        candidates, deltas = self.__candidates(state, side, kind)
+        if len(candidates) == 0:
+            return logit
+        maximize = side == "p1"
+        if depth == 2:
+            # the replies are leaves, no need to expand them
+            return logit + float(deltas.max() if maximize else deltas.min())
+        beam = min(self.beam_width, len(candidates))
+        # only the most promising replies are explored
+        if maximize:
+            order = np.argpartition(-deltas, beam - 1)[:beam]
+        else:
+            order = np.argpartition(deltas, beam - 1)[:beam]
+
+        best = -math.inf if maximize else math.inf
+        for position in order:
+            if time.perf_counter() > self.__deadline:
+                raise SearchTimeout()
+            value = self.__search(apply_action(state, side, kind, int(candidates[position])),
+                                  logit + float(deltas[position]), depth - 1)
+            best = max(best, value) if maximize else min(best, value)
+
+        self.__cache[key] = best - logit
+        if len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+        return best
+
+    def __candidates(self, state: DraftState, side: str, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The units available for the action, and the change of the p1 win logit for each of them.
+        """
+        sign = 1.0 if side == "p1" else -1.0
+        if kind == ACTION_POSTBAN:
+            # a player bans one of the opponent's picks, p1's picks are on the positive side
+            candidates = np.array(state.p2_picks if side == "p1" else state.p1_picks, dtype=np.int64)
+            return candidates, sign * self.__postban_weights[candidates]
+
+        available = np.ones(len(self.__pick_weights), dtype=bool)
+        available[list(state.p1_prebans + state.p2_prebans)] = False
+        if kind == ACTION_PREBAN:
+            candidates = np.flatnonzero(available)
+            return candidates, sign * self.__preban_weights[candidates]
+
+        available[list(state.p1_picks + state.p2_picks)] = False
+        candidates = np.flatnonzero(available)
+        deltas = sign * self.__pick_weights[candidates]
+        if side == "p1" and len(state.p1_picks) == 0:
+            deltas = deltas + self.__first_pick_weights[candidates]
+        if self.__synergy is not None:
+            team, enemy_team = (state.p1_picks, state.p2_picks) if side == "p1" else (state.p2_picks, state.p1_picks)
+            interactions = self.__synergy[:, list(team)].sum(axis=1) + self.__counter[:, list(enemy_team)].sum(axis=1)
+            deltas = deltas + sign * interactions[candidates]
+        return candidates, deltas
+
+    def __interactions(self, state: DraftState) -> float:
+        if self.__synergy is None:
+            return 0.0
+        p1, p2 = list(state.p1_picks), list(state.p2_picks)
+        # each pair is counted twice in the symmetric synergy matrix
+        synergy = (self.__synergy[np.ix_(p1, p1)].sum() - self.__synergy[np.ix_(p2, p2)].sum()) / 2
+        return float(synergy + self.__counter[np.ix_(p1, p2)].sum())
+
+
+def _sigmoid(logit: float) -> float:
+    return 1 / (1 + math.exp(-logit))
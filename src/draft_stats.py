@@ -0,0 +1,261 @@
+import os
+import numpy as np
+
+team_size = 5
+# the 10 (i, j) position pairs of a team, i < j
+pair_positions = np.triu_indices(team_size, k=1)
+# fields of the battle documents used by the aggregation
+battle_source_fields = [
+    "battle_id", "battle_date", "indexed_at", "p1_win",
+    "p1_picks", "p2_picks", "p1_prebans", "p2_prebans", "p1_postban", "p2_postban",
+]
+
+
+class DraftStats:
+    """
+    Per unit pick, ban and win counts, plus unit pair (same team) and unit vs unit (opposite teams) count matrices,
+    aggregated from the battle documents.
+
+    Units are stored at a dense index (`unit_index`), so feature lookups are plain array accesses, and a batch of
+    battles is aggregated with a few vectorized operations. Battles are aggregated once: the ids of the aggregated
+    battles are kept (sorted), and battles already seen are ignored.
+
+    In the battle documents, p1 is always the player who picked first.
+    """
+    unit_ids: list[str]
+    unit_index: dict[str, int]
+    battle_count: int
+    # the most recent battle date aggregated (timestamp)
+    last_battle_date: int
+    # the most recent indexing time of the battles scanned (timestamp), the watermark of the next scan
+    last_indexed_at: int
+    battle_ids: np.ndarray
+    picks: np.ndarray
+    wins: np.ndarray
+    first_picks: np.ndarray
+    prebans: np.ndarray
+    postbans: np.ndarray
+    # pair_picks[a, b]: battles where a and b were in the same team, pair_wins[a, b]: ... and won
+    pair_picks: np.ndarray
+    pair_wins: np.ndarray
+    # matchups[a, b]: battles where a faced b, matchup_wins[a, b]: ... and a's team won
+    matchups: np.ndarray
+    matchup_wins: np.ndarray
+
+    def __init__(self, unit_ids: list[str]):
+        self.__features: dict[float, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self.unit_ids = []
+        self.unit_index = {}
+        self.battle_count = 0
+        self.last_battle_date = 0
+        self.last_indexed_at = 0
+        self.battle_ids = np.zeros(0, dtype=np.int64)
+        for name in ["picks", "wins", "first_picks", "prebans", "postbans"]:
+            setattr(self, name, np.zeros(0, dtype=np.int32))
+        for name in ["pair_picks", "pair_wins", "matchups", "matchup_wins"]:
+            setattr(self, name, np.zeros((0, 0), dtype=np.int32))
+        self.__add_units(unit_ids)
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def add_battles(self, battles: list[dict]) -> int:
+        """
+        Aggregates the battles that were not aggregated yet, returns their number.
+        """
+        if len(battles) == 0:
+            return 0
+        self.last_indexed_at = max(self.last_indexed_at, max(battle.get("indexed_at") or 0 for battle in battles))
+        battle_ids = np.fromiter((battle["battle_id"] for battle in battles), dtype=np.int64, count=len(battles))
+        # first occurrence of each id in the batch, minus the ids aggregated by previous batches: a binary search
+        # in the sorted ids, so a batch costs O(batch * log(total)) instead of sorting all the ids again
+        unique_ids, first_positions = np.unique(battle_ids, return_index=True)
+        insert_positions = np.searchsorted(self.battle_ids, unique_ids)
+        known = insert_positions < len(self.battle_ids)
+        known[known] = self.battle_ids[insert_positions[known]] == unique_ids[known]
+        new_positions = first_positions[~known]
+        if len(new_positions) == 0:
+            return 0
+        new_battles = [battles[position] for position in np.sort(new_positions)]
+
+        self.__add_units([unit["id"]
+                          for battle in new_battles
+                          for field in ["p1_picks", "p2_picks", "p1_prebans", "p2_prebans"]
+                          for unit in battle[field]]
+                         + [battle[field]["id"]
+                            for battle in new_battles
+                            for field in ["p1_postban", "p2_postban"]
+                            if battle.get(field) is not None])
+        p1_picks = self.__encode_units(new_battles, "p1_picks", team_size)
+        p2_picks = self.__encode_units(new_battles, "p2_picks", team_size)
+        prebans = np.concatenate([self.__encode_units(new_battles, "p1_prebans", 2),
+                                  self.__encode_units(new_battles, "p2_prebans", 2)], axis=1)
+        postbans = np.array([[self.__postban_index(battle, "p1_postban"), self.__postban_index(battle, "p2_postban")]
+                             for battle in new_battles], dtype=np.int32)
+        p1_wins = np.array([battle["p1_win"] for battle in new_battles], dtype=np.int32)
+        p2_wins = 1 - p1_wins
+
+        num_units = len(self.unit_ids)
+        self.picks += self.__count(p1_picks) + self.__count(p2_picks)
+        self.wins += self.__count(p1_picks, p1_wins) + self.__count(p2_picks, p2_wins)
+        self.first_picks += self.__count(p1_picks[:, :1])
+        self.prebans += self.__count(prebans)
+        self.postbans += self.__count(postbans)
+
+        for team, team_wins in [(p1_picks, p1_wins), (p2_picks, p2_wins)]:
+            first, second = team[:, pair_positions[0]], team[:, pair_positions[1]]
+            weights = np.broadcast_to(team_wins[:, None], first.shape)
+            # pairs are symmetric
+            for a, b in [(first, second), (second, first)]:
+                self.pair_picks += self.__count_pairs(a, b, num_units)
+                self.pair_wins += self.__count_pairs(a, b, num_units, weights)
+
+        # every unit of a team against every unit of the other one
+        p1_units = np.repeat(p1_picks, team_size, axis=1)
+        p2_units = np.tile(p2_picks, (1, team_size))
+        for a, b, team_wins in [(p1_units, p2_units, p1_wins), (p2_units, p1_units, p2_wins)]:
+            self.matchups += self.__count_pairs(a, b, num_units)
+            self.matchup_wins += self.__count_pairs(a, b, num_units, np.broadcast_to(team_wins[:, None], a.shape))
+
+        self.__features.clear()
+        self.battle_count += len(new_battles)
+        self.last_battle_date = max(self.last_battle_date, max(battle["battle_date"] for battle in new_battles))
+        # the new ids are sorted, and inserted in place with a single copy of the array
+        self.battle_ids = np.insert(self.battle_ids, insert_positions[~known], unique_ids[~known])
+        return len(new_battles)
+
+    # FEATURES
+
+    def pick_rates(self) -> np.ndarray:
+        return self.picks / max(self.battle_count, 1)
+
+    def ban_rates(self) -> np.ndarray:
+        return (self.prebans + self.postbans) / max(self.battle_count, 1)
+
+    def win_rates(self, prior_weight: float = 10) -> np.ndarray:
+        """
+        Win rates, smoothed toward 50% by `prior_weight` virtual battles, so rarely picked units do not get
+        extreme rates.
+        """
+        return (self.wins + 0.5 * prior_weight) / (self.picks + prior_weight)
+
+    def synergy_matrix(self, prior_weight: float = 10) -> np.ndarray:
+        """
+        Smoothed win rate of each unit pair when picked together, minus the mean of the units' own win rates.
+        """
+        win_rates = self.win_rates(prior_weight)
+        expected = (win_rates[:, None] + win_rates[None, :]) / 2
+        return (self.pair_wins + expected * prior_weight) / (self.pair_picks + prior_weight) - expected
+
+    def counter_matrix(self, prior_weight: float = 10) -> np.ndarray:
+        """
+        counter_matrix[a, b]: smoothed win rate of `a` when facing `b`, minus the win rate of `a`.
+        """
+        win_rates = self.win_rates(prior_weight)[:, None]
+        return (self.matchup_wins + win_rates * prior_weight) / (self.matchups + prior_weight) - win_rates
+
+    def draft_features(self, team: list[str], enemy_team: list[str], prior_weight: float = 10) -> dict[str, float]:
+        """
+        Mean win rate, pair synergy and counter score of a (possibly partial) team against the enemy team.
+        """
+        if prior_weight not in self.__features:
+            self.__features[prior_weight] = (self.win_rates(prior_weight), self.synergy_matrix(prior_weight),
+                                             self.counter_matrix(prior_weight))
+        win_rates, synergy, counter = self.__features[prior_weight]
+        team_indexes = self.encode(team)
+        team_indexes = team_indexes[team_indexes >= 0]
+        enemy_indexes = self.encode(enemy_team)
+        enemy_indexes = enemy_indexes[enemy_indexes >= 0]
+
+        pairs = synergy[np.ix_(team_indexes, team_indexes)]
+        pair_count = len(team_indexes) * (len(team_indexes) - 1)
+        return {
+            "win_rate": float(win_rates[team_indexes].mean()) if len(team_indexes) > 0 else 0.5,
+            # the diagonal holds no pair
+            "synergy": float((pairs.sum() - np.trace(pairs)) / pair_count) if pair_count > 0 else 0.0,
+            "counter": float(counter[np.ix_(team_indexes, enemy_indexes)].mean())
+            if len(team_indexes) > 0 and len(enemy_indexes) > 0 else 0.0,
+        }
+
+    def encode(self, unit_ids: list[str]) -> np.ndarray:
+        """
+        Dense indexes of the units, -1 for the unknown ones.
+        """
+        return np.array([self.unit_index.get(unit_id, -1) for unit_id in unit_ids], dtype=np.int32)
+
+    # PERSISTENCE
+
+    def save(self, filepath: str):
+        # write then rename, so an interrupted save never leaves a truncated file behind
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        temporary_path = f'{filepath}.tmp.npz'
+        np.savez(
+            temporary_path,
+            unit_ids=np.array(self.unit_ids, dtype=str),
+            counters=np.array([self.battle_count, self.last_battle_date, self.last_indexed_at], dtype=np.int64),
+            battle_ids=self.battle_ids,
+            picks=self.picks, wins=self.wins, first_picks=self.first_picks,
+            prebans=self.prebans, postbans=self.postbans,
+            pair_picks=self.pair_picks, pair_wins=self.pair_wins,
+            matchups=self.matchups, matchup_wins=self.matchup_wins,
+        )
+        os.replace(temporary_path, filepath)
+
+    @staticmethod
+    def load(filepath: str, unit_ids: list[str] | None = None) -> "DraftStats":
+        """
+        Units of `unit_ids` missing from the saved stats (e.g. new heroes) are added to them.
+        """
+        with np.load(filepath) as data:
+            stats = DraftStats(list(data["unit_ids"]))
+            # stats saved before the indexing watermark have 2 counters
+            stats.battle_count, stats.last_battle_date, stats.last_indexed_at = (
+                int(value) for value in [*data["counters"], 0][:3])
+            for name in ["battle_ids", "picks", "wins", "first_picks", "prebans", "postbans",
+                         "pair_picks", "pair_wins", "matchups", "matchup_wins"]:
+                setattr(stats, name, data[name])
+        if unit_ids is not None:
+            stats.__add_units(unit_ids)
+        return stats
+
+    def __add_units(self, unit_ids):
+        new_ids = [unit_id for unit_id in dict.fromkeys(unit_ids) if unit_id not in self.unit_index]
+        if len(new_ids) == 0:
+            return
+        for unit_id in new_ids:
+            self.unit_index[unit_id] = len(self.unit_ids)
+            self.unit_ids.append(unit_id)
+        growth = len(new_ids)
+        for name in ["picks", "wins", "first_picks", "prebans", "postbans"]:
+            setattr(self, name, np.pad(getattr(self, name), (0, growth)))
+        for name in ["pair_picks", "pair_wins", "matchups", "matchup_wins"]:
+            setattr(self, name, np.pad(getattr(self, name), ((0, growth), (0, growth))))
+
+    def __encode_units(self, battles: list[dict], field: str, width: int) -> np.ndarray:
+        """
+        (battles, width) matrix of unit indexes, padded with -1.
+        """
+        encoded = np.full((len(battles), width), -1, dtype=np.int32)
+        for row, battle in enumerate(battles):
+            units = battle[field][:width]
+            encoded[row, :len(units)] = [self.unit_index[unit["id"]] for unit in units]
+        return encoded
+
+    def __postban_index(self, battle: dict, field: str) -> int:
+        unit = battle.get(field)
+        return self.unit_index[unit["id"]] if unit is not None else -1
+
+    def __count(self, units: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        valid = units >= 0
+        if weights is not None:
+            weights = np.broadcast_to(weights[:, None], units.shape)[valid]
+        return np.bincount(units[valid], weights=weights, minlength=len(self.unit_ids)).astype(np.int32)
+
+    @staticmethod
+    def __count_pairs(a: np.ndarray, b: np.ndarray, num_units: int, weights: np.ndarray | None = None) -> np.ndarray:
+        valid = (a >= 0) & (b >= 0)
+        flat = a[valid].astype(np.int64) * num_units + b[valid]
+        if weights is not None:
+            weights = weights[valid]
+        counts = np.bincount(flat, weights=weights, minlength=num_units * num_units)
+        return counts.astype(np.int32).reshape(num_units, num_units)
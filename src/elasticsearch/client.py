@@ -0,0 +1,12 @@
+from elasticsearch import AsyncElasticsearch
+from src.config import load_config
+
+
+def create_client() -> "AsyncElasticsearch":
+    config = load_config()
+    return AsyncElasticsearch(
+        hosts=[config.get("elastic.host", "https://localhost:9200")],
+        basic_auth=(config.get("elastic.user"), config.get("elastic.password")),
+        ca_certs=config.get("elastic.ca_certs"),
+        verify_certs=config.get("elastic.verify_certs", True),
+    )
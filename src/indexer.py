@@ -1,5 +1,11 @@
+import contextlib
+import time
+from typing import AsyncIterator
 from elasticsearch import AsyncElasticsearch, helpers
-from src.model import RtaPlayer, RtaBattle, rta_battle_mappings, rta_player_mappings
+from src.bulk_writer import BulkWriter, stream_bulk
+from src.refresh_scheduler import RefreshSchedule, expected_new_battles_script
+from src.constants import UNKNOWN_NAME
+from src.model import RtaPlayer, RtaBattle, rta_battle_mappings, rta_player_mappings, character_fields
 from src.utils import get_user_uuid
 
 
@@ -11,11 +17,121 @@ def battle_index(season: str):
     return f'rta_battles_{season}'
 
 
+# aliases over the indices of all the seasons, for the queries across seasons
+players_alias = 'rta_players'
+battles_alias = 'rta_battles'
+
+# counts the battles newer than the player's watermark, the others were already returned by its own refresh
+add_covered_battles_script = """
+long watermark = ctx._source.last_updated_battle_id != null ? ctx._source.last_updated_battle_id : 0L;
+long covered_id = ctx._source.covered_battle_id != null ? ctx._source.covered_battle_id : 0L;
+int count = 0;
+for (def battle_id : params.battle_ids) {
+    long id = ((Number) battle_id).longValue();
+    if (id > watermark) {
+        count++;
+        covered_id = Math.max(covered_id, id);
+    }
+}
+if (count == 0) {
+    ctx.op = 'noop';
+} else {
+    ctx._source.covered_battle_count = (ctx._source.covered_battle_count != null ? ctx._source.covered_battle_count : 0)
+        + count;
+    ctx._source.covered_battle_id = covered_id;
+}
+"""
+
+
 class Indexer:
+    """
+    The season indices are created with `shards` primary shards and `replicas` replicas, and refreshed every
+    `refresh_interval`: these are also the settings restored at the end of the ingest mode.
+    """
     client: AsyncElasticsearch
+    bulk_writer: BulkWriter | None
+    shards: int
+    replicas: int
+    refresh_interval: str
 
-    def __init__(self, client: AsyncElasticsearch):
+    def __init__(self, client: AsyncElasticsearch, shards: int = 1, replicas: int = 1, refresh_interval: str = "1s"):
         self.client = client
+        self.bulk_writer = None
+        self.shards = shards
+        self.replicas = replicas
+        self.refresh_interval = refresh_interval
+
+    # BULK APIS
+
+    def start_bulk_writer(self, max_actions: int = 1000, flush_interval: float = 0.05):
+        """
+        Once started, all the writes are buffered and sent in shared bulk requests.
+        """
+        self.bulk_writer = BulkWriter(client=self.client, max_actions=max_actions, flush_interval=flush_interval)
+        self.bulk_writer.start()
+
+    async def close_bulk_writer(self):
+        if self.bulk_writer is not None:
+            await self.bulk_writer.close()
+            self.bulk_writer = None
+
+    async def __bulk(self, actions: list[dict], missing_ok: bool = False) -> list[bool]:
+        if len(actions) == 0:
+            return []
+        if self.bulk_writer is not None:
+            return await self.bulk_writer.submit(actions, missing_ok=missing_ok)
+        return await stream_bulk(self.client, actions, missing_ok=[missing_ok] * len(actions))
+
+    # INDEX LIFECYCLE
+
+    def __index_settings(self) -> dict:
+        return {
+            "number_of_shards": self.shards,
+            "number_of_replicas": self.replicas,
+            "refresh_interval": self.refresh_interval,
+        }
+
+    @contextlib.asynccontextmanager
+    async def ingest_mode(self, season: str, refresh_interval: str = "30s"):
+        """
+        Bulk ingestion settings for the indices of the season while the context runs: refreshes are spaced out, and
+        replicas are dropped, to be rebuilt from the primaries once at the end instead of replicating every write.
+
+        The default settings are restored on exit (rather than the settings found on entry), so an interrupted
+        run is also fixed by the next one.
+        """
+        indices = f'{battle_index(season)},{player_index(season)}'
+        # e.g. `fetch-users` only creates the player index
+        await self.client.indices.put_settings(index=indices, ignore_unavailable=True, settings={
+            "index": {"refresh_interval": refresh_interval, "number_of_replicas": 0}})
+        try:
+            yield
+        finally:
+            await self.client.indices.put_settings(index=indices, ignore_unavailable=True, settings={
+                "index": {"refresh_interval": self.refresh_interval, "number_of_replicas": self.replicas}})
+            await self.client.indices.refresh(index=indices, ignore_unavailable=True)
+
+    async def list_seasons(self) -> dict[str, bool]:
+        """
+        The seasons with a battle index, and whether the season is optimized (see `optimize_season`).
+        """
+        response = await self.client.indices.get_settings(index=battle_index("*"), name="index.blocks.write")
+        prefix = battle_index("")
+        return {
+            index[len(prefix):]: str(settings["settings"].get("index", {}).get("blocks", {}).get("write")) == "true"
+            for index, settings in response.body.items()
+        }
+
+    async def optimize_season(self, season: str, request_timeout: float = 3600):
+        """
+        Makes the indices of a closed season read-only, and merges each of their shards into a single segment:
+        smaller, and faster to search. Merging is expensive, it should only be done once a season is over.
+        """
+        indices = f'{battle_index(season)},{player_index(season)}'
+        await self.client.indices.put_settings(index=indices, settings={"index.blocks.write": True},
+                                               ignore_unavailable=True)
+        await self.client.options(request_timeout=request_timeout).indices.forcemerge(
+            index=indices, max_num_segments=1, ignore_unavailable=True)
 
     # BATTLE APIS
 
@@ -24,20 +140,211 @@ class Indexer:
         exists_check = await self.client.indices.exists(index=index_name)
         exists = exists_check.meta.status == 200
         if not exists:
-            await self.client.indices.create(index=index_name, mappings=rta_battle_mappings)
+            await self.client.indices.create(index=index_name, mappings=rta_battle_mappings,
+                                             settings=self.__index_settings(), aliases={battles_alias: {}})
+        else:
+            # new fields may have been added since the index was created
+            await self.client.indices.put_mapping(index=index_name, properties=rta_battle_mappings["properties"])
+            # indices created before the aliases
+            await self.client.indices.put_alias(index=index_name, name=battles_alias)
 
-    async def insert_battles(self, battles: list[RtaBattle], season: str):
+    async def insert_battles(self, battles: list[RtaBattle | dict], season: str) -> list[bool]:
+        """
+        Battles can either be models, or already converted documents (see `convert_raw_battle_source`).
+        Their `indexed_at` is set to now, the watermark of the incremental scans (see `iter_battles`).
+        """
         index_name = battle_index(season)
+        indexed_at = round(time.time() * 1000)
 
-        def bulk_generator():
-            for battle in battles:
-                yield {
-                    "_index": index_name,
-                    "_id": battle.battle_id,
-                    "_source": battle.model_dump()
-                }
+        def to_source(battle: RtaBattle | dict) -> dict:
+            source = battle.model_dump() if isinstance(battle, RtaBattle) else battle
+            return {**source, "indexed_at": indexed_at}
+
+        actions = [
+            {
+                "_index": index_name,
+                "_id": source["battle_id"],
+                "_source": source
+            }
+            for source in map(to_source, battles)
+        ]
+
+        return await self.__bulk(actions)
+
+    async def iter_battles(self, season: str | None, since: int | None = None, source: list[str] | None = None,
+                           page_size: int = 1000, indexed_since: int | None = None) -> AsyncIterator[dict]:
+        """
+        Streams the battle documents (or only their `source` fields) by battle date, starting at `since` if provided,
+        with `search_after` on a point in time. Without a season, the battles of all the seasons are streamed.
+
+        With `indexed_since`, only the battles indexed since then are streamed, whatever their battle date.
+        """
+        keep_alive = "5m"
+        index = battle_index(season) if season is not None else battles_alias
+        pit = await self.client.open_point_in_time(index=index, keep_alive=keep_alive)
+        pit_id = pit.body["id"]
+        search_after = None
+        filters = []
+        if since is not None:
+            filters.append({"range": {"battle_date": {"gte": since}}})
+        if indexed_since is not None:
+            filters.append({"range": {"indexed_at": {"gte": indexed_since}}})
+        query = {"bool": {"filter": filters}} if len(filters) > 0 else {"match_all": {}}
+
+        try:
+            while True:
+                response = await self.client.search(
+                    pit={"id": pit_id, "keep_alive": keep_alive},
+                    size=page_size,
+                    query=query,
+                    source=source if source is not None else True,
+                    sort=[{"battle_date": {"order": "asc"}}, {"_shard_doc": {"order": "asc"}}],
+                    search_after=search_after,
+                )
+                pit_id = response.body["pit_id"]
+                results = response.body['hits']['hits']
+                if len(results) == 0:
+                    break
+                for result in results:
+                    yield result["_source"]
+                search_after = results[-1]["sort"]
+        finally:
+            await self.client.close_point_in_time(id=pit_id)
+
+    async def iter_battles_with_unknown_names(self, season: str, after_battle_id: int | None = None,
+                                              page_size: int = 500) -> AsyncIterator[dict]:
+        """
+        Streams the battles with a unit or artifact that was missing from the registries when they were converted,
+        by battle id (after `after_battle_id` if provided), so an interrupted scan can be resumed from the last id.
+        """
+        # units are named "Unknown", except in the details, where the unit name is missing.
+        # units without an artifact have an empty artifact id, and an "Unknown" artifact name
+        unknown_details = {"bool": {"should": [
+            {"bool": {
+                "filter": {"term": {"units_details.artifact_name": UNKNOWN_NAME}},
+                "must_not": {"term": {"units_details.artifact_id": ""}},
+            }},
+            {"bool": {"must_not": {"exists": {"field": "units_details.name"}}}},
+            {"term": {"units_details.name": UNKNOWN_NAME}},
+        ]}}
+        query: dict = {"bool": {
+            "should": [{"term": {f'{field}.name': UNKNOWN_NAME}} for field in character_fields] +
+                      [{"nested": {"path": "units_details", "query": unknown_details}}],
+            "minimum_should_match": 1,
+        }}
+        if after_battle_id is not None:
+            query["bool"]["filter"] = [{"range": {"battle_id": {"gt": after_battle_id}}}]
 
-        await helpers.async_bulk(self.client, bulk_generator())
+        keep_alive = "5m"
+        pit = await self.client.open_point_in_time(index=battle_index(season), keep_alive=keep_alive)
+        pit_id = pit.body["id"]
+        search_after = None
+        try:
+            while True:
+                response = await self.client.search(
+                    pit={"id": pit_id, "keep_alive": keep_alive},
+                    size=page_size,
+                    query=query,
+                    source=["battle_id", "units_details"] + character_fields,
+                    sort=[{"battle_id": {"order": "asc"}}, {"_shard_doc": {"order": "asc"}}],
+                    search_after=search_after,
+                )
+                pit_id = response.body["pit_id"]
+                results = response.body['hits']['hits']
+                if len(results) == 0:
+                    break
+                for result in results:
+                    yield result["_source"]
+                search_after = results[-1]["sort"]
+        finally:
+            await self.client.close_point_in_time(id=pit_id)
+
+    async def update_battles(self, updates: list[tuple[int, dict]], season: str) -> list[bool]:
+        """
+        Partial updates of battles: only the given fields of each (battle id, fields) are replaced.
+        """
+        index_name = battle_index(season)
+        return await self.__bulk([
+            {
+                "_op_type": "update",
+                "_index": index_name,
+                "_id": battle_id,
+                "doc": fields,
+            }
+            for battle_id, fields in updates
+        ])
+
+    # BATTLE QUERIES
+
+    async def count_team_wins(self, unit_ids: list[str], season: str | None,
+                              rank: str | None = None) -> tuple[int, int]:
+        """
+        Number of teams (of either side) that picked all of the `unit_ids`, and how many of them won.
+        With a `rank`, only the teams of players of this rank are counted.
+        """
+        def team_aggregation(player: str) -> dict:
+            filters = [{"term": {f'{player}_picks.id': unit_id}} for unit_id in unit_ids]
+            if rank is not None:
+                filters.append({"term": {f'{player}_grade': rank}})
+            return {
+                "filter": {"bool": {"filter": filters}},
+                "aggs": {"wins": {"filter": {"term": {f'{player}_win': True}}}},
+            }
+
+        response = await self.client.search(
+            index=battle_index(season) if season is not None else battles_alias,
+            size=0,
+            aggs={"p1": team_aggregation("p1"), "p2": team_aggregation("p2")},
+            request_cache=True,
+        )
+        aggregations = response.body["aggregations"]
+        picks = aggregations["p1"]["doc_count"] + aggregations["p2"]["doc_count"]
+        wins = aggregations["p1"]["wins"]["doc_count"] + aggregations["p2"]["wins"]["doc_count"]
+        return picks, wins
+
+    async def count_unit_picks(self, season: str | None, rank: str | None = None,
+                               max_units: int = 1000) -> dict[str, tuple[int, int]]:
+        """
+        Number of teams that picked each unit, and how many of them won, by unit id.
+        With a `rank`, only the teams of players of this rank are counted.
+        """
+        def units_aggregation(player: str) -> dict:
+            query = {"term": {f'{player}_grade': rank}} if rank is not None else {"match_all": {}}
+            return {
+                "filter": query,
+                "aggs": {
+                    "units": {
+                        "terms": {"field": f'{player}_picks.id', "size": max_units},
+                        "aggs": {"wins": {"filter": {"term": {f'{player}_win': True}}}},
+                    },
+                },
+            }
+
+        response = await self.client.search(
+            index=battle_index(season) if season is not None else battles_alias,
+            size=0,
+            aggs={"p1": units_aggregation("p1"), "p2": units_aggregation("p2")},
+            request_cache=True,
+        )
+        counts: dict[str, tuple[int, int]] = {}
+        for side in ["p1", "p2"]:
+            for bucket in response.body["aggregations"][side]["units"]["buckets"]:
+                picks, wins = counts.get(bucket["key"], (0, 0))
+                counts[bucket["key"]] = (picks + bucket["doc_count"], wins + bucket["wins"]["doc_count"])
+        return counts
+
+    async def player_battles(self, user_id: int, season: str | None, size: int = 20) -> list[dict]:
+        """
+        The last `size` battles of a player, most recent first.
+        """
+        response = await self.client.search(
+            index=battle_index(season) if season is not None else battles_alias,
+            size=size,
+            query={"bool": {"should": [{"term": {"p1_id": user_id}}, {"term": {"p2_id": user_id}}],
+                            "minimum_should_match": 1}},
+            sort=[{"battle_date": {"order": "desc"}}],
+        )
+        return [hit["_source"] for hit in response.body["hits"]["hits"]]
 
     # PLAYER APIS
 
@@ -46,67 +353,142 @@ class Indexer:
         exists_check = await self.client.indices.exists(index=index_name)
         exists = exists_check.meta.status == 200
         if not exists:
-            await self.client.indices.create(index=index_name, mappings=rta_player_mappings)
+            await self.client.indices.create(index=index_name, mappings=rta_player_mappings,
+                                             settings=self.__index_settings(), aliases={players_alias: {}})
+        else:
+            # new fields may have been added since the index was created
+            await self.client.indices.put_mapping(index=index_name, properties=rta_player_mappings["properties"])
+            await self.client.indices.put_alias(index=index_name, name=players_alias)
 
-    async def insert_players(self, players: list[dict], season: str):
+    async def insert_players(self, players: list[dict], season: str) -> list[bool]:
         index = player_index(season)
 
-        def player_generator():
-            for player in players:
-                yield {
-                    "_index": index,
-                    "_id": get_user_uuid(player["id"], player["world"]),
-                    "user_id": player["id"],
-                    "user_name": player["name"],
-                    "user_world": player["world"],
-                    "last_known_rank": player.get("rank", None),
-                    "last_update_time": 0,
-                    "last_updated_battle_id": 0,
-                }
+        # players that already exist are left untouched, so their sync state is never reset
+        actions = [
+            {
+                "_op_type": "create",
+                "_index": index,
+                "_id": get_user_uuid(player["id"], player["world"]),
+                "user_id": player["id"],
+                "user_name": player["name"],
+                "user_world": player["world"],
+                "last_known_rank": player.get("rank", None),
+                "last_update_time": 0,
+                "last_updated_battle_id": 0,
+            }
+            for player in players
+        ]
 
-        await helpers.async_bulk(self.client, player_generator())
+        return await self.__bulk(actions)
 
     async def set_player_updated(self, user_id: int, user_world: str, season: str, date: int, last_updated_battle: int,
-                                 last_known_rank: str):
+                                 last_known_rank: str, battle_rate: float | None = None,
+                                 coverage: float | None = None) -> bool:
+        """
+        Also resets the battles covered through the player's opponents, they are all behind the new watermark.
+        """
         index = player_index(season)
         doc_id = f'{user_id}_{user_world}'
         updated_attributes = {
             "last_update_time": date,
             "last_updated_battle_id": last_updated_battle,
             "last_known_rank": last_known_rank,
+            "covered_battle_count": 0,
         }
+        if battle_rate is not None:
+            updated_attributes["battle_rate"] = battle_rate
+        if coverage is not None:
+            updated_attributes["coverage"] = coverage
 
-        await self.client.update(index=index, id=doc_id, doc=updated_attributes)
+        results = await self.__bulk([{
+            "_op_type": "update",
+            "_index": index,
+            "_id": doc_id,
+            "doc": updated_attributes,
+        }])
+        return results[0]
 
-    async def get_users_to_refresh(self, num_players: int, season: str):
-        response = await self.client.search(
-            index=player_index(season),
-            size=num_players,
-            sort=[
-                {"last_update_time": {"order": "asc"}}
-            ]
-        )
+    async def add_covered_battles(self, covered_battles: dict[tuple[int, str], list[int]], season: str) -> list[bool]:
+        """
+        Records on each (user_id, user_world) player the ids of its battles ingested through its opponents.
+        Players that are not in the index are ignored: their update fails with a 404, which is not counted as an error.
+        """
+        index = player_index(season)
+        return await self.__bulk([
+            {
+                "_op_type": "update",
+                "_index": index,
+                "_id": get_user_uuid(user_id, user_world),
+                # the player may be refreshed or covered by another worker at the same time
+                "retry_on_conflict": 3,
+                "script": {
+                    "source": add_covered_battles_script,
+                    "lang": "painless",
+                    "params": {"battle_ids": battle_ids},
+                },
+            }
+            for (user_id, user_world), battle_ids in covered_battles.items()
+        ], missing_ok=True)
 
+    async def iter_users_to_refresh(self, num_players: int, season: str, schedule: RefreshSchedule | None = None,
+                                    page_size: int = 500) -> AsyncIterator[RtaPlayer]:
         """
-                {
-          "size": 100,
-          "query": {
-            "bool": {
-              "filter": [
-                {
-                  "term": {"last_known_rank": "legend"} 
+        Streams the players to refresh: least recently updated first, or by decreasing number of expected
+        new battles when a `schedule` is provided.
+
+        Pages are fetched with `search_after` on a point in time, so this is not limited to the first 10k hits,
+        and the consumer can start working on the first page while the next ones are fetched.
+        """
+        keep_alive = "5m"
+        pit = await self.client.open_point_in_time(index=player_index(season), keep_alive=keep_alive)
+        pit_id = pit.body["id"]
+        search_after = None
+        count = 0
+
+        if schedule is None:
+            query = {"match_all": {}}
+            min_score = None
+            sort = [{"last_update_time": {"order": "asc"}}]
+        else:
+            query = {
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {
+                        "source": expected_new_battles_script,
+                        "params": schedule.script_params(now=round(time.time() * 1000)),
+                    },
                 }
-              ]
             }
-          }
-        }
-        """
+            # players expected to have (almost) nothing new are deferred to a later run
+            min_score = schedule.min_expected_battles
+            sort = [{"_score": {"order": "desc"}}]
 
-        results = response.body['hits']['hits']
-        return list(map(lambda r: RtaPlayer(**r["_source"]), results))
+        try:
+            while count < num_players:
+                response = await self.client.search(
+                    pit={"id": pit_id, "keep_alive": keep_alive},
+                    size=min(page_size, num_players - count),
+                    query=query,
+                    min_score=min_score,
+                    sort=sort + [{"_shard_doc": {"order": "asc"}}],
+                    search_after=search_after,
+                )
+                pit_id = response.body["pit_id"]
+                results = response.body['hits']['hits']
+                if len(results) == 0:
+                    break
+                for result in results:
+                    yield RtaPlayer(**result["_source"])
+                count += len(results)
+                search_after = results[-1]["sort"]
+        finally:
+            await self.client.close_point_in_time(id=pit_id)
 
-    async def get_all_players(self, season: str) -> list[RtaPlayer]:
+    async def iter_player_ids(self, season: str) -> AsyncIterator[tuple[int, str]]:
+        """
+        Streams the (user_id, user_world) of all the known players, without fetching their whole documents.
+        """
         index = player_index(season)
-        scan = helpers.async_scan(client=self.client, index=index)
-        players = [RtaPlayer(**doc["_source"]) async for doc in scan]
-        return players
+        scan = helpers.async_scan(client=self.client, index=index, _source=["user_id", "user_world"], size=5000)
+        async for doc in scan:
+            yield doc["_source"]["user_id"], doc["_source"]["user_world"]
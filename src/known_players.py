@@ -0,0 +1,220 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+
+file_magic = b'RTAKNOWN'
+header_format = '<8sQQI'
+# player ids are stored on the lower bits of the packed key, the world index on the upper ones
+user_id_bits = 40
+max_load_factor = 0.7
+hash_multiplier = 0x9E3779B97F4A7C15
+uint64_mask = (1 << 64) - 1
+
+
+class BloomFilter:
+    """
+    A small probabilistic set: never gives false negatives, gives false positives with a rate depending on
+    the number of bits per key (~1% for 10 bits per key).
+    """
+    num_bits: int
+    num_hashes: int
+    bits: bytearray
+
+    def __init__(self, num_bits: int, num_hashes: int = 7):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = num_hashes
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: int):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+    def __positions(self, key: int):
+        h1 = (key * hash_multiplier) & uint64_mask
+        h2 = ((key ^ (key >> 29)) * 0xBF58476D1CE4E5B9 | 1) & uint64_mask
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+
+class KnownPlayers:
+    """
+    Compact membership set of the known players.
+
+    Each player is packed as a single integer (world index + user id) and stored in an open addressing
+    hash table backed by an `array('Q')`, so each player costs 8 bytes / load factor instead of a python string.
+
+    The table can be saved to disk, and is mmapped when loaded back, so startup does not need to scan the player index.
+    An optional bloom filter can be put in front of the table, to answer most negative lookups without touching
+    the (possibly cold) mmapped pages.
+    """
+    worlds: list[str]
+    bloom: BloomFilter | None
+
+    def __init__(self, capacity: int = 1024, bloom_bits_per_key: int = 0):
+        self.worlds = []
+        self.__world_indices: dict[str, int] = {}
+        self.__count = 0
+        self.__table = array('Q', bytes(8 * _table_size(capacity)))
+        self.__mmap: mmap.mmap | None = None
+        self.__bloom_bits_per_key = bloom_bits_per_key
+        self.bloom = None
+        if bloom_bits_per_key > 0:
+            self.__rebuild_bloom()
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __contains__(self, player: tuple[int, str]) -> bool:
+        user_id, user_world = player
+        world_index = self.__world_indices.get(user_world)
+        if world_index is None:
+            return False
+        key = _pack(user_id, world_index)
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        return self.__table[self.__slot(key)] == key
+
+    def add(self, user_id: int, user_world: str) -> bool:
+        """
+        Adds the player to the set, returns True if it was not already known.
+        """
+        key = _pack(user_id, self.__world_index(user_world))
+        slot = self.__slot(key)
+        if self.__table[slot] == key:
+            return False
+
+        self.__table[slot] = key
+        self.__count += 1
+        if self.bloom is not None:
+            self.bloom.add(key)
+        if self.__count > len(self.__table) * max_load_factor:
+            self.__resize(len(self.__table) * 2)
+        return True
+
+    def remove(self, user_id: int, user_world: str) -> bool:
+        """
+        Removes the player from the set, returns True if it was known.
+        The bloom filter keeps the key, it only costs a false positive until the next resize.
+        """
+        world_index = self.__world_indices.get(user_world)
+        if world_index is None:
+            return False
+        key = _pack(user_id, world_index)
+        table = self.__table
+        slot = self.__slot(key)
+        if table[slot] != key:
+            return False
+
+        # backward shift deletion: move back the following keys of the cluster that can no longer be reached
+        mask = len(table) - 1
+        table[slot] = 0
+        current = (slot + 1) & mask
+        while table[current] != 0:
+            home = _home_slot(table[current], mask)
+            if (current - home) & mask >= (current - slot) & mask:
+                table[slot] = table[current]
+                table[current] = 0
+                slot = current
+            current = (current + 1) & mask
+        self.__count -= 1
+        return True
+
+    def save(self, filepath: str):
+        worlds = json.dumps(self.worlds).encode("utf-8")
+        header = struct.pack(header_format, file_magic, self.__count, len(self.__table), len(worlds)) + worlds
+        # keep the table aligned on 8 bytes, so it can be mapped as an array of uint64 when loading it back
+        header += b'\0' * (-len(header) % 8)
+
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        tmp_path = f'{filepath}.tmp'
+        with open(tmp_path, "wb") as target_file:
+            target_file.write(header)
+            target_file.write(self.__table.tobytes())
+        os.replace(tmp_path, filepath)
+
+    @staticmethod
+    def load(filepath: str, bloom_bits_per_key: int = 0) -> "KnownPlayers":
+        with open(filepath, "rb") as source_file:
+            # copy-on-write mapping: players added during the run never touch the file until it is saved again
+            mapped = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, count, table_size, worlds_length = struct.unpack_from(header_format, mapped, 0)
+        if magic != file_magic:
+            raise ValueError(f'{filepath} is not a known players file')
+        offset = struct.calcsize(header_format)
+        worlds = json.loads(mapped[offset:offset + worlds_length].decode("utf-8"))
+        offset += worlds_length
+        offset += -offset % 8
+
+        known_players = KnownPlayers(capacity=0)
+        known_players.worlds = worlds
+        known_players.__world_indices = {world: index for index, world in enumerate(worlds)}
+        known_players.__count = count
+        known_players.__mmap = mapped
+        known_players.__table = memoryview(mapped)[offset:offset + 8 * table_size].cast('Q')
+        known_players.__bloom_bits_per_key = bloom_bits_per_key
+        if bloom_bits_per_key > 0:
+            known_players.__rebuild_bloom()
+        return known_players
+
+    def __world_index(self, user_world: str) -> int:
+        world_index = self.__world_indices.get(user_world)
+        if world_index is None:
+            world_index = len(self.worlds)
+            self.worlds.append(user_world)
+            self.__world_indices[user_world] = world_index
+        return world_index
+
+    def __slot(self, key: int) -> int:
+        """
+        Returns the slot containing the key, or the empty slot where it should be inserted.
+        """
+        table = self.__table
+        mask = len(table) - 1
+        slot = _home_slot(key, mask)
+        while True:
+            current = table[slot]
+            if current == key or current == 0:
+                return slot
+            slot = (slot + 1) & mask
+
+    def __resize(self, table_size: int):
+        previous = self.__table
+        self.__table = array('Q', bytes(8 * table_size))
+        for key in previous:
+            if key != 0:
+                self.__table[self.__slot(key)] = key
+        if self.__mmap is not None:
+            previous.release()
+            self.__mmap.close()
+            self.__mmap = None
+        if self.__bloom_bits_per_key > 0:
+            self.__rebuild_bloom()
+
+    def __rebuild_bloom(self):
+        self.bloom = BloomFilter(int(len(self.__table) * max_load_factor) * self.__bloom_bits_per_key)
+        for key in self.__table:
+            if key != 0:
+                self.bloom.add(key)
+
+
+def _table_size(capacity: int) -> int:
+    size = 8
+    while size * max_load_factor < capacity:
+        size *= 2
+    return size
+
+
+def _home_slot(key: int, mask: int) -> int:
+    return ((key * hash_multiplier) & uint64_mask) >> 32 & mask
+
+
+def _pack(user_id: int, world_index: int) -> int:
+    if user_id < 0 or user_id >= 1 << user_id_bits:
+        raise ValueError(f'user id {user_id} does not fit in {user_id_bits} bits')
+    # world indices are shifted by one, so that no valid key is 0 (the empty slot marker)
+    return ((world_index + 1) << user_id_bits) | user_id
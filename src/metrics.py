@@ -0,0 +1,302 @@
+import asyncio
+import bisect
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as FrequencyCounter
+from contextlib import contextmanager
+from aiohttp import web
+
+LabelValues = tuple[str, ...]
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Metric:
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+    type: str
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+
+    def label_values(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def format_labels(self, values: LabelValues, extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.label_names, values)) + list((extra or {}).items())
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+    values: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{self.format_labels(key)} {value}' for key, value in self.values.items()]
+
+    def to_dict(self) -> list[dict]:
+        return [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        self.values[self.label_values(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Cumulative buckets, as in Prometheus: `counts[i]` is the number of observations in `(buckets[i-1], buckets[i]]`,
+    plus a last count for the observations above the highest bucket.
+    """
+    type = "histogram"
+    buckets: tuple[float, ...]
+    counts: dict[LabelValues, list[int]]
+    sums: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = latency_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels: str) -> float | None:
+        """
+        Upper bound of the bucket holding the `q` quantile (None when above the highest bucket or without data).
+        """
+        counts = self.counts.get(self.label_values(labels))
+        if counts is None:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bucket
+        return None
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.format_labels(key, {"le": str(bucket)})} {cumulative}')
+            total = cumulative + counts[-1]
+            lines.append(f'{self.name}_bucket{self.format_labels(key, {"le": "+Inf"})} {total}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {self.sums[key]}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {total}')
+        return lines
+
+    def to_dict(self) -> list[dict]:
+        return [
+            {
+                "labels": dict(zip(self.label_names, key)),
+                "count": sum(counts),
+                "sum": self.sums[key],
+                "buckets": dict(zip(list(map(str, self.buckets)) + ["+Inf"], counts)),
+            }
+            for key, counts in self.counts.items()
+        ]
+
+
+class MetricsRegistry:
+    metrics: list[Metric]
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self.__register(Counter(name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self.__register(Gauge(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = latency_buckets) -> Histogram:
+        return self.__register(Histogram(name, help, label_names, buckets))
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        return {"time": time.time(), "metrics": {metric.name: metric.to_dict() for metric in self.metrics}}
+
+    def __register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+# the metrics of the ingestion pipeline, all the workers of a process share them
+registry = MetricsRegistry()
+api_latency = registry.histogram(
+    "rta_api_call_seconds", "Game api call latency, each retry counted as a call", ("endpoint",))
+conversion_latency = registry.histogram(
+    "rta_battle_conversion_seconds", "Conversion time of the battles of one player")
+bulk_latency = registry.histogram(
+    "rta_es_bulk_seconds", "Elasticsearch bulk request latency")
+bulk_size = registry.histogram(
+    "rta_es_bulk_actions", "Number of actions per Elasticsearch bulk request", buckets=size_buckets)
+bulk_failed_actions = registry.counter(
+    "rta_es_bulk_failed_actions_total", "Bulk actions that failed")
+queue_depth = registry.gauge(
+    "rta_queue_depth", "Tasks waiting in the work queue", ("command",))
+tasks_processed = registry.counter(
+    "rta_tasks_processed_total", "Tasks (players or recommend lists) processed by the workers", ("command",))
+battles_processed = registry.counter(
+    "rta_battles_total", "Battles returned by the api, by outcome", ("outcome",))
+players_discovered = registry.counter(
+    "rta_players_discovered_total", "Players seen for the first time", ("command",))
+errors = registry.counter(
+    "rta_errors_total", "Failed tasks, by exception type", ("command", "type"))
+query_requests = registry.counter(
+    "rta_query_requests_total", "Query service requests, by cache outcome (hit, miss or coalesced)",
+    ("endpoint", "cache"))
+query_latency = registry.histogram(
+    "rta_query_seconds", "Query service computations (cache misses), by source", ("endpoint", "source"))
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """
+    Serves the metrics in the Prometheus text format on `/metrics`, and as json on `/metrics.json`.
+    """
+    async def prometheus_metrics(request: web.Request):
+        return web.Response(text=registry.prometheus_text(), content_type="text/plain", charset="utf-8")
+
+    async def json_metrics(request: web.Request):
+        return web.json_response(registry.to_dict())
+
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus_metrics)
+    app.router.add_get("/metrics.json", json_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f'serving metrics on http://{host}:{port}/metrics')
+    return runner
+
+
+def dump_metrics(filepath: str):
+    # write then rename, so readers never see a partial file
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    temporary_path = f'{filepath}.tmp'
+    with open(temporary_path, "w") as metrics_file:
+        json.dump(registry.to_dict(), metrics_file)
+    os.replace(temporary_path, filepath)
+
+
+async def dump_metrics_periodically(filepath: str, interval: float = 10):
+    while True:
+        await asyncio.sleep(interval)
+        dump_metrics(filepath)
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every `interval` seconds, from a background thread, and aggregates the samples
+    in the "folded stacks" format read by flamegraph.pl and speedscope.
+
+    Much cheaper than cProfile, so it can stay enabled on a full run (py-spy does the same from outside the process,
+    when it can be installed).
+    """
+    interval: float
+    samples: FrequencyCounter
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = FrequencyCounter()
+        self.__thread_id = threading.get_ident()
+        self.__stopped = threading.Event()
+        self.__thread: threading.Thread | None = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def write_folded(self, filepath: str):
+        with open(filepath, "w") as folded_file:
+            for stack, count in self.samples.most_common():
+                folded_file.write(f'{stack} {count}\n')
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.__thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.samples[";".join(reversed(stack))] += 1
+
+
+@contextmanager
+def profiling(profile_filepath: str | None = None, stack_samples_filepath: str | None = None):
+    """
+    Optionally profiles the enclosed block with cProfile (read the output with `python -m pstats` or snakeviz),
+    and/or with a `StackSampler`.
+    """
+    profiler = cProfile.Profile() if profile_filepath else None
+    sampler = StackSampler() if stack_samples_filepath else None
+    if profiler is not None:
+        profiler.enable()
+    if sampler is not None:
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_filepath)
+            print(f'profile written to {profile_filepath}')
+        if sampler is not None:
+            sampler.stop()
+            sampler.write_folded(stack_samples_filepath)
+            print(f'stack samples written to {stack_samples_filepath}')
@@ -1,2 +1,2 @@
-from .battles import RtaBattle, RtaBattleUnit, rta_battle_mappings
+from .battles import RtaBattle, RtaBattleUnit, rta_battle_mappings, character_fields
 from .players import RtaPlayer, rta_player_mappings
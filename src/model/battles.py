@@ -119,6 +119,8 @@ rta_battle_mappings = {
         "season_code": {"type": "keyword"},
         "battle_date": {"type": "date"},
         "turn_count": {"type": "integer"},
+        # set by the indexer on each write (not part of the converted battle)
+        "indexed_at": {"type": "date"},
         # fp / win
         "p1_win": {"type": "boolean"},
         "p2_win": {"type": "boolean"},
@@ -164,3 +166,8 @@ rta_battle_mappings = {
         }
     }
 }
+
+# fields holding units (a unit or a list of units)
+character_fields = [
+    field for field, mapping in rta_battle_mappings["properties"].items() if mapping is character_mapping
+]
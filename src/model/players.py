@@ -9,6 +9,13 @@ class RtaPlayer(pydantic.BaseModel):
     last_known_rank: str
     last_update_time: Optional[int] = None
     last_updated_battle_id: Optional[int] = None
+    # estimated number of battles played per hour, see `refresh_scheduler`
+    battle_rate: Optional[float] = None
+    # battles ingested through the player's opponents since its last refresh, and the highest of their ids
+    covered_battle_count: Optional[int] = None
+    covered_battle_id: Optional[int] = None
+    # estimated share of the player's battles ingested through its opponents
+    coverage: Optional[float] = None
 
 
 rta_player_mappings = {
@@ -20,5 +27,9 @@ rta_player_mappings = {
         "last_known_rank": {"type": "keyword"},
         "last_update_time": {"type": "date"},
         "last_updated_battle_id": {"type": "long"},
+        "battle_rate": {"type": "float"},
+        "covered_battle_count": {"type": "integer"},
+        "covered_battle_id": {"type": "long"},
+        "coverage": {"type": "float"},
     }
 }
@@ -0,0 +1,67 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class QueryCache:
+    """
+    Results of the recent queries, kept `ttl` seconds (up to `max_size` of them, least recently used evicted first).
+
+    Concurrent requests for a key that is not cached wait for the same computation, so a burst of identical requests
+    runs a single query. Failures are not cached: the next request runs the query again.
+    """
+    ttl: float
+    max_size: int
+
+    def __init__(self, ttl: float = 30, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expiry time, result), in least recently used order
+        self.__results: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.__pending: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.__results)
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        """
+        (True, result) if the key is cached and not expired yet, else (False, None).
+        """
+        cached = self.__results.get(key)
+        if cached is None:
+            return False, None
+        expires_at, result = cached
+        if expires_at <= time.monotonic():
+            del self.__results[key]
+            return False, None
+        self.__results.move_to_end(key)
+        return True, result
+
+    def is_pending(self, key: Hashable) -> bool:
+        return key in self.__pending
+
+    async def get(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        cached, result = self.lookup(key)
+        if cached:
+            return result
+        pending = self.__pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(compute())
+            self.__pending[key] = pending
+            pending.add_done_callback(lambda done: self.__store(key, done))
+        # a waiter that gives up (e.g. the client disconnected) does not cancel the query for the others
+        return await asyncio.shield(pending)
+
+    def clear(self):
+        self.__results.clear()
+
+    def __store(self, key: Hashable, done: asyncio.Future):
+        del self.__pending[key]
+        # retrieving the exception also marks it as handled, when all the waiters are gone
+        if done.cancelled() or done.exception() is not None:
+            return
+        self.__results[key] = (time.monotonic() + self.ttl, done.result())
+        self.__results.move_to_end(key)
+        while len(self.__results) > self.max_size:
+            self.__results.popitem(last=False)
@@ -0,0 +1,296 @@
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+from aiohttp import web
+
+from src.draft_assistant import DraftAssistant
+from src.draft_stats import DraftStats
+from src.indexer import Indexer
+from src.metrics import query_latency, query_requests
+from src.query_cache import QueryCache
+from src.unit_registry import UnitRegistry
+from src.utils import file_version
+from src.win_predictor import Draft, WinPredictor
+
+SOURCE_AGGREGATES = "aggregates"
+SOURCE_ELASTICSEARCH = "elasticsearch"
+SOURCE_WIN_PREDICTOR = "win_predictor"
+# the largest `size` of the meta and player battles queries
+max_size = 100
+draft_list_fields = ["p1_picks", "p2_picks", "p1_prebans", "p2_prebans", "p1_artifacts", "p2_artifacts"]
+draft_value_fields = ["p1_postban", "p2_postban", "p1_grade", "p2_grade"]
+
+
+class QueryService:
+    """
+    Read-only queries over the battles of a season, for the dashboards.
+
+    Queries over all the ranks are answered from the draft stats aggregated by `aggregate-stats` (reloaded when the
+    file changes, checked at most every `reload_interval` seconds), the others from Elasticsearch aggregations.
+    Drafts are scored, and their next action suggested, by the win predictor trained by `train-predictor` (reloaded
+    the same way).
+    All the answers go through the `cache`, as serialized json.
+    """
+    indexer: Indexer
+    season: str
+    unit_registry: UnitRegistry
+    cache: QueryCache
+    draft_stats_path: str | None
+    draft_stats: DraftStats | None
+    win_predictor_path: str | None
+    win_predictor: WinPredictor | None
+    draft_assistant: DraftAssistant | None
+    reload_interval: float
+
+    def __init__(self, indexer: Indexer, season: str, unit_registry: UnitRegistry, cache: QueryCache,
+                 draft_stats_path: str | None = None, win_predictor_path: str | None = None,
+                 reload_interval: float = 60):
+        self.indexer = indexer
+        self.season = season
+        self.unit_registry = unit_registry
+        self.cache = cache
+        self.draft_stats_path = draft_stats_path
+        self.draft_stats = None
+        self.win_predictor_path = win_predictor_path
+        self.win_predictor = None
+        self.draft_assistant = None
+        self.reload_interval = reload_interval
+        self.__file_versions: dict[str, tuple] = {}
+        self.__next_reload_check = 0.0
+
+    # QUERIES
+
+    async def unit_win_rate(self, unit_id: str, rank: str | None = None) -> bytes:
+        self.__check_units([unit_id])
+        return await self.__cached("unit", (unit_id, rank), lambda: self.__team_win_rate([unit_id], rank))
+
+    async def pair_win_rate(self, unit_id: str, other_unit_id: str, rank: str | None = None) -> bytes:
+        # the same pair in either order
+        unit_ids = sorted([unit_id, other_unit_id])
+        self.__check_units(unit_ids)
+        return await self.__cached("pair", (*unit_ids, rank), lambda: self.__team_win_rate(unit_ids, rank))
+
+    async def player_battles(self, user_id: int, size: int = 20) -> bytes:
+        async def compute() -> dict:
+            battles = await self.indexer.player_battles(user_id, self.season, size=size)
+            return {"user_id": user_id, "battles": battles, "source": SOURCE_ELASTICSEARCH}
+
+        return await self.__cached("player_battles", (user_id, size), compute)
+
+    async def meta(self, rank: str | None = None, size: int = 20) -> bytes:
+        async def compute() -> dict:
+            draft_stats = self.__current_draft_stats() if rank is None else None
+            if draft_stats is not None:
+                counts = {unit_id: (int(draft_stats.picks[index]), int(draft_stats.wins[index]))
+                          for index, unit_id in enumerate(draft_stats.unit_ids)}
+                source = SOURCE_AGGREGATES
+            else:
+                counts = await self.indexer.count_unit_picks(self.season, rank=rank)
+                source = SOURCE_ELASTICSEARCH
+            top = sorted(counts.items(), key=lambda item: (-item[1][0], item[0]))[:size]
+            return {
+                "rank": rank,
+                "units": [self.__unit_stats(unit_id, picks, wins) for unit_id, (picks, wins) in top if picks > 0],
+                "source": source,
+            }
+
+        return await self.__cached("meta", (rank, size), compute)
+
+    async def draft_suggestions(self, draft: Draft, size: int = 5) -> bytes:
+        """
+        The p1 win rate of a (partial) draft, and the `size` best units for its next action.
+        """
+        unit_ids = [unit_id for field in ["p1_picks", "p2_picks", "p1_prebans", "p2_prebans"]
+                    for unit_id in draft.get(field) or []]
+        unit_ids += [draft[field] for field in ["p1_postban", "p2_postban"] if draft.get(field) is not None]
+        self.__check_units(unit_ids)
+        self.__reload_files()
+        if self.draft_assistant is None:
+            raise web.HTTPServiceUnavailable(text=json.dumps({"error": "no win predictor trained for the season"}),
+                                             content_type="application/json")
+        draft_assistant = self.draft_assistant
+
+        async def compute() -> dict:
+            return {
+                "p1_win_rate": float(draft_assistant.predictor.predict([draft])[0]),
+                **draft_assistant.suggest(draft, top_n=size),
+                "source": SOURCE_WIN_PREDICTOR,
+            }
+
+        return await self.__cached("draft", (json.dumps(draft, sort_keys=True), size), compute)
+
+    def __check_units(self, unit_ids: list[str]):
+        unknown = [unit_id for unit_id in unit_ids if unit_id not in self.unit_registry]
+        if len(unknown) > 0:
+            raise web.HTTPNotFound(text=json.dumps({"error": f'unknown units: {", ".join(unknown)}'}),
+                                   content_type="application/json")
+
+    async def __team_win_rate(self, unit_ids: list[str], rank: str | None) -> dict:
+        draft_stats = self.__current_draft_stats() if rank is None else None
+        indexes = draft_stats.encode(unit_ids) if draft_stats is not None else None
+        if indexes is not None and (indexes >= 0).all():
+            if len(unit_ids) == 1:
+                picks, wins = draft_stats.picks[indexes[0]], draft_stats.wins[indexes[0]]
+            else:
+                pair = (indexes[0], indexes[1])
+                picks, wins = draft_stats.pair_picks[pair], draft_stats.pair_wins[pair]
+            source = SOURCE_AGGREGATES
+        else:
+            picks, wins = await self.indexer.count_team_wins(unit_ids, self.season, rank=rank)
+            source = SOURCE_ELASTICSEARCH
+        return {
+            "units": [{"id": unit_id, "name": self.unit_registry.name_from_id(unit_id)} for unit_id in unit_ids],
+            "rank": rank,
+            "picks": int(picks),
+            "wins": int(wins),
+            "win_rate": int(wins) / int(picks) if picks > 0 else None,
+            "source": source,
+        }
+
+    def __unit_stats(self, unit_id: str, picks: int, wins: int) -> dict:
+        return {
+            "id": unit_id,
+            "name": self.unit_registry.name_from_id(unit_id),
+            "picks": picks,
+            "wins": wins,
+            "win_rate": wins / picks if picks > 0 else None,
+        }
+
+    async def __cached(self, endpoint: str, key: tuple, compute: Callable[[], Awaitable[dict]]) -> bytes:
+        cache_key = (endpoint, *key)
+        cached, body = self.cache.lookup(cache_key)
+        if cached:
+            query_requests.inc(endpoint=endpoint, cache="hit")
+            return body
+        query_requests.inc(endpoint=endpoint, cache="coalesced" if self.cache.is_pending(cache_key) else "miss")
+
+        async def compute_body() -> bytes:
+            start = time.perf_counter()
+            result = await compute()
+            query_latency.observe(time.perf_counter() - start, endpoint=endpoint, source=result["source"])
+            return json.dumps(result).encode()
+
+        return await self.cache.get(cache_key, compute_body)
+
+    # AGGREGATES
+
+    def __current_draft_stats(self) -> DraftStats | None:
+        self.__reload_files()
+        return self.draft_stats
+
+    def __reload_files(self):
+        if time.monotonic() < self.__next_reload_check:
+            return
+        self.__next_reload_check = time.monotonic() + self.reload_interval
+        draft_stats = self.__load_if_changed(self.draft_stats_path, "draft stats", DraftStats.load)
+        if draft_stats is not None:
+            self.draft_stats = draft_stats
+            print(f'loaded the draft stats: {draft_stats.battle_count} battles')
+        win_predictor = self.__load_if_changed(self.win_predictor_path, "win predictor", WinPredictor.load)
+        if win_predictor is not None:
+            self.win_predictor = win_predictor
+            print(f'loaded the win predictor: {len(win_predictor.unit_ids)} units')
+        if (draft_stats is not None or win_predictor is not None) and self.win_predictor is not None:
+            # the assistant aligns the stats on the units of the predictor when created
+            self.draft_assistant = DraftAssistant(self.win_predictor, stats=self.draft_stats)
+
+    def __load_if_changed(self, filepath: str | None, name: str, load: Callable[[str], object]):
+        """
+        Loads the file if it changed since its last load, else (or if it cannot be loaded) returns None.
+        """
+        if filepath is None or not os.path.exists(filepath):
+            return None
+        version = file_version(filepath)
+        if version == self.__file_versions.get(filepath):
+            return None
+        try:
+            loaded = load(filepath)
+        except (OSError, ValueError) as e:
+            # keep answering from the previous version
+            print(f'failed to load the {name}: {e}')
+            return None
+        self.__file_versions[filepath] = version
+        return loaded
+
+
+def create_query_app(service: QueryService) -> web.Application:
+    """
+    GET /units/{unit_id}, /pairs/{unit_id}/{other_unit_id}, /meta (with an optional `rank`),
+    and /players/{user_id}/battles. /meta and /players/{user_id}/battles take an optional `size` (1 to 100).
+    POST /draft/suggestions, with a (partial) draft as json body and an optional `size` (1 to 100, 5 by default).
+    """
+    def json_response(body: bytes) -> web.Response:
+        return web.Response(body=body, content_type="application/json")
+
+    def bad_request(error: str) -> web.HTTPBadRequest:
+        return web.HTTPBadRequest(text=json.dumps({"error": error}), content_type="application/json")
+
+    def int_parameter(request: web.Request, name: str, default: int | None = None) -> int:
+        value = request.match_info.get(name) or request.query.get(name)
+        if value is None and default is not None:
+            return default
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise bad_request(f'{name} must be an integer')
+
+    async def unit(request: web.Request):
+        return json_response(await service.unit_win_rate(request.match_info["unit_id"], request.query.get("rank")))
+
+    async def pair(request: web.Request):
+        return json_response(await service.pair_win_rate(request.match_info["unit_id"],
+                                                         request.match_info["other_unit_id"],
+                                                         request.query.get("rank")))
+
+    def size_parameter(request: web.Request, default: int = 20) -> int:
+        size = int_parameter(request, "size", default)
+        if size < 1:
+            raise bad_request("size must be positive")
+        # bounds the responses, and the cache entries
+        return min(size, max_size)
+
+    async def player_battles(request: web.Request):
+        size = size_parameter(request)
+        return json_response(await service.player_battles(int_parameter(request, "user_id"), size=size))
+
+    async def meta(request: web.Request):
+        return json_response(await service.meta(request.query.get("rank"), size=size_parameter(request)))
+
+    async def draft_suggestions(request: web.Request):
+        size = size_parameter(request, 5)
+        try:
+            body = await request.json()
+        except ValueError:
+            raise bad_request("the body must be a json draft")
+        if not isinstance(body, dict):
+            raise bad_request("the body must be a json draft")
+        draft: Draft = {}
+        for field in draft_list_fields:
+            value = body.get(field) or []
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise bad_request(f'{field} must be a list of ids')
+            draft[field] = value
+        for field in draft_value_fields:
+            value = body.get(field)
+            if value is not None and not isinstance(value, str):
+                raise bad_request(f'{field} must be a string')
+            draft[field] = value
+        return json_response(await service.draft_suggestions(draft, size=size))
+
+    app = web.Application()
+    app.router.add_get("/units/{unit_id}", unit)
+    app.router.add_get("/pairs/{unit_id}/{other_unit_id}", pair)
+    app.router.add_get("/players/{user_id}/battles", player_battles)
+    app.router.add_get("/meta", meta)
+    app.router.add_post("/draft/suggestions", draft_suggestions)
+    return app
+
+
+async def start_query_server(service: QueryService, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(create_query_app(service), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f'serving queries on http://{host}:{port}')
+    return runner
@@ -0,0 +1,75 @@
+import os
+import struct
+import time
+from array import array
+from collections import OrderedDict
+
+file_magic = b'RTARECNT'
+header_format = '<8sQ'
+
+
+class RecentBattles:
+    """
+    Ids of the recently indexed battles, so the battles found again in the opponent's battle list are neither
+    converted nor written again.
+
+    The least recently indexed battles are evicted first once there are `max_size` of them, and battles are
+    forgotten `ttl` seconds after they were indexed (their opponent has most likely been refreshed by then).
+    The set can be saved to disk at the end of a run, and loaded back by the next one.
+    """
+    max_size: int
+    ttl: float
+
+    def __init__(self, max_size: int = 200000, ttl: float = 2 * 24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        # battle id -> wall clock time it was indexed at, in indexing order
+        self.__indexed_at: OrderedDict[int, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__indexed_at)
+
+    def __contains__(self, battle_id: int) -> bool:
+        indexed_at = self.__indexed_at.get(battle_id)
+        return indexed_at is not None and indexed_at > time.time() - self.ttl
+
+    def add(self, battle_ids: list[int]):
+        now = time.time()
+        indexed_at = self.__indexed_at
+        for battle_id in battle_ids:
+            indexed_at[battle_id] = now
+            indexed_at.move_to_end(battle_id)
+        while len(indexed_at) > self.max_size:
+            indexed_at.popitem(last=False)
+        # the oldest battles are first
+        expired_at = now - self.ttl
+        while len(indexed_at) > 0 and next(iter(indexed_at.values())) <= expired_at:
+            indexed_at.popitem(last=False)
+
+    def save(self, filepath: str):
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        tmp_path = f'{filepath}.tmp'
+        with open(tmp_path, "wb") as target_file:
+            target_file.write(struct.pack(header_format, file_magic, len(self.__indexed_at)))
+            target_file.write(array('q', self.__indexed_at.keys()).tobytes())
+            target_file.write(array('d', self.__indexed_at.values()).tobytes())
+        os.replace(tmp_path, filepath)
+
+    @staticmethod
+    def load(filepath: str, max_size: int = 200000, ttl: float = 2 * 24 * 3600) -> "RecentBattles":
+        with open(filepath, "rb") as source_file:
+            content = source_file.read()
+        magic, count = struct.unpack_from(header_format, content, 0)
+        if magic != file_magic:
+            raise ValueError(f'{filepath} is not a recent battles file')
+        offset = struct.calcsize(header_format)
+        battle_ids = array('q', content[offset:offset + 8 * count])
+        indexed_at = array('d', content[offset + 8 * count:offset + 16 * count])
+
+        recent_battles = RecentBattles(max_size=max_size, ttl=ttl)
+        expired_at = time.time() - ttl
+        # only the most recent ones, if the size was reduced since
+        for battle_id, battle_indexed_at in zip(battle_ids[-max_size:], indexed_at[-max_size:]):
+            if battle_indexed_at > expired_at:
+                recent_battles.__indexed_at[battle_id] = battle_indexed_at
+        return recent_battles
@@ -0,0 +1,130 @@
+from src.constants import RANK_CHAMPION, RANK_EMPEROR, RANK_LEGEND
+
+# prior battle rates (battles per hour) for players we never observed, higher ranks play more
+rank_prior_rates = {
+    RANK_LEGEND: 1.0,
+    RANK_EMPEROR: 0.6,
+    RANK_CHAMPION: 0.4,
+}
+default_prior_rate = 0.2
+# lowest battle rate of a player (coverage included), so every player is due at least every
+# `min_expected_battles / min_battle_rate` hours, even the ones that stopped playing. When the api budget does not
+# cover all the due players, the ones with the fewest expected battles wait longer
+min_battle_rate = 0.01
+# weight of the latest observation in the rate's moving average
+rate_smoothing = 0.5
+# ignore observation windows shorter than this, they are too noisy
+min_window_hours = 1.0
+# the battle list api never returns more than this number of battles
+max_battles_per_call = 100
+# share of a player's battles already ingested through its opponents above which we stop trusting the estimate,
+# so even the fully covered players are refreshed (at most 1 / (1 - max_coverage) times less often)
+max_coverage = 0.9
+
+# painless version of `expected_new_battles`, used to sort the players directly in the index
+expected_new_battles_script = """
+double max_battles = params.max_battles;
+double rate = params.default_rate;
+if (doc['battle_rate'].size() > 0) {
+    rate = Math.max(doc['battle_rate'].value, params.min_rate);
+} else if (doc['last_known_rank'].size() > 0) {
+    rate = params.rank_rates.getOrDefault(doc['last_known_rank'].value, params.default_rate);
+}
+long last_update = doc['last_update_time'].size() > 0 ? doc['last_update_time'].value.toInstant().toEpochMilli() : 0L;
+if (last_update <= 0L) {
+    return max_battles;
+}
+long now = params.now;
+double hours = Math.max(0L, now - last_update) / 3600000.0;
+double unseen = rate * hours;
+if (params.use_coverage) {
+    double expected = unseen;
+    double covered = doc['covered_battle_count'].size() > 0 ? doc['covered_battle_count'].value : 0;
+    double coverage = doc['coverage'].size() > 0 ? doc['coverage'].value : 0;
+    if (coverage > 0) {
+        expected = Math.max(expected, covered / coverage);
+    }
+    unseen = Math.max(expected - covered, expected * (1 - Math.min(coverage, params.max_coverage)));
+}
+return Math.min(max_battles, Math.max(unseen, params.min_rate * hours));
+"""
+
+
+class RefreshSchedule:
+    """
+    Refreshes players by decreasing number of expected new battles, so each api call returns as many new
+    battles as possible, and defers the ones expected to have less than `min_expected_battles`
+    (which gives each player a refresh interval of `min_expected_battles / rate`).
+
+    With `use_coverage`, the battles already ingested through the player's opponents since its last refresh are not
+    counted as new: players whose opponents are all tracked are deferred until they are likely to have played against
+    untracked ones. It is off by default: when the api calls are scarce, the deferred players overflow the last 100
+    battles returned by the api, and fewer battles are captured overall (see `benchmarks.refresh_scheduler`).
+    """
+    min_expected_battles: float
+    use_coverage: bool
+
+    def __init__(self, min_expected_battles: float = 1.0, use_coverage: bool = False):
+        self.min_expected_battles = min_expected_battles
+        self.use_coverage = use_coverage
+
+    def script_params(self, now: int) -> dict:
+        return {
+            "now": now,
+            "rank_rates": rank_prior_rates,
+            "default_rate": default_prior_rate,
+            "min_rate": min_battle_rate,
+            "max_battles": max_battles_per_call,
+            "max_coverage": max_coverage,
+            "use_coverage": self.use_coverage,
+        }
+
+
+def prior_battle_rate(rank: str | None) -> float:
+    return rank_prior_rates.get(rank, default_prior_rate)
+
+
+def expected_new_battles(battle_rate: float | None, rank: str | None, last_update_time: int | None, now: int,
+                         covered_battle_count: int = 0, coverage: float | None = None) -> float:
+    """
+    Number of battles played since the last refresh that were not ingested through the player's opponents yet
+    (all of them, without a `coverage`).
+    """
+    if not last_update_time:
+        return max_battles_per_call
+    rate = max(battle_rate, min_battle_rate) if battle_rate is not None else prior_battle_rate(rank)
+    hours = max(0, now - last_update_time) / 3600000
+    expected = rate * hours
+    coverage = coverage or 0
+    if coverage > 0:
+        # the covered battles are this share of all the battles played
+        expected = max(expected, covered_battle_count / coverage)
+    unseen = max(expected - covered_battle_count, expected * (1 - min(coverage, max_coverage)))
+    return min(max_battles_per_call, max(unseen, min_battle_rate * hours))
+
+
+def estimate_battle_rate(previous_rate: float | None, new_battle_count: int, window_hours: float,
+                         rank: str | None = None) -> float | None:
+    """
+    Updates the moving average of a player's battles per hour, after observing `new_battle_count` battles
+    over the last `window_hours`. The first observation is smoothed against the prior rate of the player's rank.
+    """
+    if window_hours < min_window_hours:
+        return previous_rate
+    observed = new_battle_count / window_hours
+    if previous_rate is None:
+        previous_rate = prior_battle_rate(rank)
+    return max(min_battle_rate, rate_smoothing * observed + (1 - rate_smoothing) * previous_rate)
+
+
+def estimate_coverage(previous_coverage: float | None, covered_battle_count: int, new_battle_count: int) -> float | None:
+    """
+    Updates the moving average of the share of a player's battles that were already ingested through its opponents,
+    after a refresh returning `new_battle_count` battles, `covered_battle_count` of which were covered.
+    """
+    if new_battle_count == 0:
+        return previous_coverage
+    observed = min(1.0, covered_battle_count / new_battle_count)
+    if previous_coverage is None:
+        return observed
+    return rate_smoothing * observed + (1 - rate_smoothing) * previous_coverage
@@ -1,5 +1,10 @@
-import pydantic
 import json
+import sys
+
+import numpy as np
+import pydantic
+
+from src.utils import file_version, read_only
 
 
 class Unit(pydantic.BaseModel):
@@ -11,18 +16,82 @@ class Unit(pydantic.BaseModel):
 
 
 class UnitRegistry:
-    registry: dict[str, Unit] = {}
+    """
+    Immutable registry of the units of `units.json`.
 
-    def __init__(self, filepath: str):
-        self.__load(filepath)
+    Each unit gets a dense index (in file order), and its attributes are stored in read-only arrays at that index,
+    so features can be encoded with vectorized lookups (e.g. `registry.role_codes[indexes]`). Grades, roles and
+    elements are small vocabularies, stored as int8 codes into `grades`, `roles` and `elements`.
 
-    def name_from_id(self, unit_id: str):
-        if unit_id in self.registry:
-            return self.registry[unit_id].name
-        return None
+    Ids and names are interned, so the documents built from the registry share the same strings.
+    """
+    filepath: str
+    # version of the file the registry was loaded from
+    version: tuple[int, int, int]
+    ids: np.ndarray
+    names: np.ndarray
+    grade_codes: np.ndarray
+    role_codes: np.ndarray
+    element_codes: np.ndarray
+    grades: tuple[str, ...]
+    roles: tuple[str, ...]
+    elements: tuple[str, ...]
 
-    def __load(self, filepath: str):
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.version = file_version(filepath)
         with open(filepath, "r") as unit_file:
             data: dict = json.load(unit_file)
-            for key, value in data.items():
-                self.registry[key] = Unit(**value)
+
+        units = list(data.values())
+        self.ids = read_only(np.array([sys.intern(unit["id"]) for unit in units], dtype=object))
+        self.names = read_only(np.array([sys.intern(unit["name"]) for unit in units], dtype=object))
+        self.grades, self.grade_codes = _vocabulary([unit["grade"] for unit in units])
+        self.roles, self.role_codes = _vocabulary([unit["role"] for unit in units])
+        self.elements, self.element_codes = _vocabulary([unit["element"] for unit in units])
+        self.__index = {unit_id: index for index, unit_id in enumerate(self.ids)}
+        self.__names = dict(zip(self.ids, self.names))
+
+    def reloaded(self) -> "UnitRegistry":
+        """
+        A registry of the current file if it changed since this one was loaded, else this registry.
+        """
+        if file_version(self.filepath) == self.version:
+            return self
+        return UnitRegistry(self.filepath)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, unit_id: str) -> bool:
+        return unit_id in self.__index
+
+    def index_of(self, unit_id: str) -> int:
+        """
+        Dense index of the unit, -1 if unknown.
+        """
+        return self.__index.get(unit_id, -1)
+
+    def encode(self, unit_ids: list[str]) -> np.ndarray:
+        return np.array([self.__index.get(unit_id, -1) for unit_id in unit_ids], dtype=np.int32)
+
+    def name_from_id(self, unit_id: str) -> str | None:
+        return self.__names.get(unit_id)
+
+    def unit(self, index: int) -> Unit:
+        return Unit(
+            id=self.ids[index],
+            name=self.names[index],
+            grade=self.grades[self.grade_codes[index]],
+            role=self.roles[self.role_codes[index]],
+            element=self.elements[self.element_codes[index]],
+        )
+
+
+def _vocabulary(values: list[str]) -> tuple[tuple[str, ...], np.ndarray]:
+    """
+    The distinct values (in order of appearance), and the int8 code of each value.
+    """
+    vocabulary = tuple(dict.fromkeys(sys.intern(value) for value in values))
+    codes = {value: code for code, value in enumerate(vocabulary)}
+    return vocabulary, read_only(np.array([codes[value] for value in values], dtype=np.int8))
@@ -1 +1,3 @@
 from .serialization import get_user_uuid
+from .files import file_version
+from .arrays import read_only
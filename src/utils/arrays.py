@@ -0,0 +1,9 @@
+import numpy as np
+
+
+def read_only(array: np.ndarray) -> np.ndarray:
+    """
+    Freezes the array in place, and returns it.
+    """
+    array.flags.writeable = False
+    return array
@@ -0,0 +1,9 @@
+import os
+
+
+def file_version(filepath: str) -> tuple[int, int, int]:
+    """
+    Changes whenever the file is rewritten, including when it is atomically replaced by another file.
+    """
+    stat = os.stat(filepath)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,236 @@
+import os
+from typing import TypedDict
+
+import numpy as np
+
+from src.constants import RANK_CHAMPION, RANK_EMPEROR, RANK_LEGEND
+
+grades = [RANK_CHAMPION, RANK_EMPEROR, RANK_LEGEND]
+# fields of the battle documents used to train the predictor
+battle_source_fields = [
+    "p1_win", "p1_grade", "p2_grade",
+    "p1_picks", "p2_picks", "p1_prebans", "p2_prebans", "p1_postban", "p2_postban", "units_details",
+]
+# upper bound of the number of active features of a draft: 10 picks, 1 first pick, 4 prebans, 2 postbans,
+# 2 grades and 10 artifacts
+max_draft_features = 29
+
+
+class Draft(TypedDict, total=False):
+    """
+    A (possibly partial) draft, with the unit and artifact ids of each side. p1 is the player who picks first.
+    """
+    p1_picks: list[str]
+    p2_picks: list[str]
+    p1_prebans: list[str]
+    p2_prebans: list[str]
+    p1_postban: str | None
+    p2_postban: str | None
+    p1_grade: str | None
+    p2_grade: str | None
+    p1_artifacts: list[str]
+    p2_artifacts: list[str]
+
+
+def draft_from_battle(battle: dict) -> Draft:
+    p1_picks = [unit["id"] for unit in battle["p1_picks"]]
+    p1_ids = set(p1_picks)
+    details = battle.get("units_details") or []
+    return {
+        "p1_picks": p1_picks,
+        "p2_picks": [unit["id"] for unit in battle["p2_picks"]],
+        "p1_prebans": [unit["id"] for unit in battle["p1_prebans"]],
+        "p2_prebans": [unit["id"] for unit in battle["p2_prebans"]],
+        "p1_postban": battle["p1_postban"]["id"] if battle.get("p1_postban") else None,
+        "p2_postban": battle["p2_postban"]["id"] if battle.get("p2_postban") else None,
+        "p1_grade": battle.get("p1_grade"),
+        "p2_grade": battle.get("p2_grade"),
+        # a unit can only be picked by one of the players
+        "p1_artifacts": [detail["artifact_id"] for detail in details if detail["id"] in p1_ids],
+        "p2_artifacts": [detail["artifact_id"] for detail in details if detail["id"] not in p1_ids],
+    }
+
+
+class WinPredictor:
+    """
+    Logistic regression of the probability that p1 (the first picker) wins, over a sparse encoding of the draft.
+
+    Each side's units, bans, grade and artifacts are one-hot encoded in the same feature blocks, +1 for p1 and -1 for
+    p2, so a feature's weight is the advantage it gives to the side that has it. The bias holds the first pick
+    advantage, and a separate block the value of each unit as first pick.
+
+    A draft is encoded as the (index, sign) of its active features, at most `max_draft_features`, so a batch of drafts
+    is two small (drafts, max_draft_features) matrices, and scoring it is a gather and a row sum.
+    """
+    unit_ids: list[str]
+    artifact_ids: list[str]
+    weights: np.ndarray
+    bias: float
+
+    def __init__(self, unit_ids: list[str], artifact_ids: list[str]):
+        self.unit_ids = list(unit_ids)
+        self.artifact_ids = list(artifact_ids)
+        self.unit_index = {unit_id: index for index, unit_id in enumerate(self.unit_ids)}
+        self.artifact_index = {artifact_id: index for index, artifact_id in enumerate(self.artifact_ids)}
+        self.grade_index = {grade: index for index, grade in enumerate(grades)}
+
+        num_units = len(self.unit_ids)
+        self.pick_offset = 0
+        self.first_pick_offset = num_units
+        self.preban_offset = 2 * num_units
+        self.postban_offset = 3 * num_units
+        self.grade_offset = 4 * num_units
+        self.artifact_offset = self.grade_offset + len(grades)
+        self.num_features = self.artifact_offset + len(self.artifact_ids)
+
+        self.weights = np.zeros(self.num_features, dtype=np.float32)
+        self.bias = 0.0
+
+    # ENCODING
+
+    def encode(self, drafts: list[Draft]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the (drafts, max_draft_features) matrices of feature indexes and signs (padded with 0 signs).
+        """
+        indexes = np.zeros((len(drafts), max_draft_features), dtype=np.int32)
+        signs = np.zeros((len(drafts), max_draft_features), dtype=np.float32)
+        for row, draft in enumerate(drafts):
+            features = self.__draft_features(draft)
+            if len(features) > 0:
+                row_indexes, row_signs = zip(*features[:max_draft_features])
+                indexes[row, :len(row_indexes)] = row_indexes
+                signs[row, :len(row_signs)] = row_signs
+        return indexes, signs
+
+    def __draft_features(self, draft: Draft) -> list[tuple[int, float]]:
+        unit_index = self.unit_index
+        features = []
+
+        def add_units(offset: int, unit_ids: list[str] | None, sign: float):
+            for unit_id in unit_ids or []:
+                index = unit_index.get(unit_id)
+                if index is not None:
+                    features.append((offset + index, sign))
+
+        def add_unit(offset: int, unit_id: str | None, sign: float):
+            if unit_id is not None:
+                add_units(offset, [unit_id], sign)
+
+        for side, sign in [("p1", 1.0), ("p2", -1.0)]:
+            add_units(self.pick_offset, draft.get(f'{side}_picks'), sign)
+            add_units(self.preban_offset, draft.get(f'{side}_prebans'), sign)
+            add_unit(self.postban_offset, draft.get(f'{side}_postban'), sign)
+            grade = self.grade_index.get(draft.get(f'{side}_grade'))
+            if grade is not None:
+                features.append((self.grade_offset + grade, sign))
+            for artifact_id in draft.get(f'{side}_artifacts') or []:
+                artifact = self.artifact_index.get(artifact_id)
+                if artifact is not None:
+                    features.append((self.artifact_offset + artifact, sign))
+        p1_picks = draft.get("p1_picks") or []
+        if len(p1_picks) > 0:
+            add_unit(self.first_pick_offset, p1_picks[0], 1.0)
+        return features
+
+    # SCORING
+
+    def predict(self, drafts: list[Draft]) -> np.ndarray:
+        """
+        Probability that p1 wins, for each draft.
+        """
+        return self.predict_encoded(*self.encode(drafts))
+
+    def predict_encoded(self, indexes: np.ndarray, signs: np.ndarray) -> np.ndarray:
+        return _sigmoid(self.logits(indexes, signs))
+
+    def logits(self, indexes: np.ndarray, signs: np.ndarray) -> np.ndarray:
+        return (self.weights[indexes] * signs).sum(axis=1) + self.bias
+
+    # TRAINING
+
+    def train(self, drafts: list[Draft], p1_wins: np.ndarray, epochs: int = 20, batch_size: int = 512,
+              learning_rate: float = 0.05, l2: float = 1e-4, seed: int = 42) -> list[float]:
+        """
+        Fits the weights with mini batch Adam on the log loss, returns the training loss of each epoch.
+        """
+        indexes, signs = self.encode(drafts)
+        labels = np.asarray(p1_wins, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        parameters = np.append(self.weights, np.float32(self.bias)).astype(np.float64)
+        first_moment = np.zeros_like(parameters)
+        second_moment = np.zeros_like(parameters)
+        beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+        bias_position = self.num_features
+        step = 0
+        losses = []
+
+        for _ in range(epochs):
+            order = rng.permutation(len(labels))
+            epoch_loss = 0.0
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                batch_indexes, batch_signs, batch_labels = indexes[batch], signs[batch], labels[batch]
+                logits = (parameters[batch_indexes] * batch_signs).sum(axis=1) + parameters[bias_position]
+                probabilities = _sigmoid(logits)
+                epoch_loss += _log_loss(probabilities, batch_labels) * len(batch)
+
+                errors = (probabilities - batch_labels) / len(batch)
+                gradient = np.bincount(batch_indexes.ravel(), weights=(batch_signs * errors[:, None]).ravel(),
+                                       minlength=bias_position + 1)
+                gradient[bias_position] = errors.sum()
+                gradient[:bias_position] += l2 * parameters[:bias_position]
+
+                step += 1
+                first_moment = beta1 * first_moment + (1 - beta1) * gradient
+                second_moment = beta2 * second_moment + (1 - beta2) * gradient ** 2
+                corrected_first = first_moment / (1 - beta1 ** step)
+                corrected_second = second_moment / (1 - beta2 ** step)
+                parameters -= learning_rate * corrected_first / (np.sqrt(corrected_second) + epsilon)
+            losses.append(epoch_loss / max(len(labels), 1))
+
+        self.weights = parameters[:bias_position].astype(np.float32)
+        self.bias = float(parameters[bias_position])
+        return losses
+
+    def evaluate(self, drafts: list[Draft], p1_wins: np.ndarray) -> dict[str, float]:
+        probabilities = self.predict(drafts)
+        labels = np.asarray(p1_wins, dtype=np.float32)
+        return {
+            "log_loss": _log_loss(probabilities, labels),
+            "accuracy": float(((probabilities >= 0.5) == (labels == 1)).mean()) if len(labels) > 0 else 0.0,
+            "p1_win_rate": float(labels.mean()) if len(labels) > 0 else 0.0,
+        }
+
+    # PERSISTENCE
+
+    def save(self, filepath: str):
+        # write then rename, so an interrupted save never leaves a truncated file behind
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        temporary_path = f'{filepath}.tmp.npz'
+        np.savez(
+            temporary_path,
+            unit_ids=np.array(self.unit_ids, dtype=str),
+            artifact_ids=np.array(self.artifact_ids, dtype=str),
+            weights=self.weights,
+            bias=np.array([self.bias]),
+        )
+        os.replace(temporary_path, filepath)
+
+    @staticmethod
+    def load(filepath: str) -> "WinPredictor":
+        with np.load(filepath) as data:
+            predictor = WinPredictor(list(data["unit_ids"]), list(data["artifact_ids"]))
+            predictor.weights = data["weights"]
+            predictor.bias = float(data["bias"][0])
+        return predictor
+
+
+def _sigmoid(logits: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-logits))
+
+
+def _log_loss(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    if len(labels) == 0:
+        return 0.0
+    probabilities = np.clip(probabilities, 1e-7, 1 - 1e-7)
+    return float(-(labels * np.log(probabilities) + (1 - labels) * np.log(1 - probabilities)).mean())